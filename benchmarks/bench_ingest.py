@@ -0,0 +1,85 @@
+"""
+Compares ingesting in-memory claim batches with `hippo.aggregator` against the file round trip
+it replaces: writing each batch to a JSON file, then reading and validating it with
+`data_loader.load_files` before merging it into the same aggregates.
+
+Usage:
+    python -m benchmarks.bench_ingest --claims 1000000 --batch-size 10000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks import generator
+from hippo import aggregator, data_loader, metrics, quantities, state
+
+
+def make_batches(n_claims: int, batch_size: int, n_npis: int, n_ndcs: int, seed: int) -> list:
+    """
+    Builds synthetic claims as lists of dictionaries, as a gateway would hold them.
+    """
+    claims_df, _ = generator.make_claims(n_claims, n_npis, n_ndcs, 0.0, seed)
+    claims_df["timestamp"] = claims_df["timestamp"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    records = claims_df.astype(object).to_dict("records")
+    return [records[start:start + batch_size] for start in range(0, len(records), batch_size)]
+
+
+def ingest_files(batches: list, tmp_dir: str) -> dict:
+    """
+    Writes each batch to a JSON file, then loads it and merges it into a state, as a `--state`
+    run would.
+    """
+    aggregates = state.empty_state()
+    for i, batch in enumerate(batches):
+        path = os.path.join(tmp_dir, f"claims-{i:05d}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(batch, f)
+        claims_df = data_loader.load_files([path], "claims", "json")
+        state.merge_events(aggregates, claims_df, pd.DataFrame(), sketch=False)
+    return {
+        "metrics": metrics.finalize_metrics(aggregates["metrics"], net=True),
+        "quantities": quantities.finalize_common_quantities(aggregates["quantities"], net=True),
+    }
+
+
+def ingest_memory(batches: list) -> dict:
+    """
+    Adds each batch to an aggregator directly.
+    """
+    agg = aggregator.Aggregator()
+    for batch in batches:
+        agg.add_claims(batch)
+    return agg.results()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark in-memory ingestion against the JSON file round trip.")
+    parser.add_argument("--claims", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--pharmacies", type=int, default=200)
+    parser.add_argument("--drugs", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    batches = make_batches(args.claims, args.batch_size, args.pharmacies, args.drugs, args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        file_results = ingest_files(batches, tmp_dir)
+        file_time = time.perf_counter() - start
+    start = time.perf_counter()
+    memory_results = ingest_memory(batches)
+    memory_time = time.perf_counter() - start
+
+    same = file_results["metrics"].equals(memory_results["metrics"]) and file_results["quantities"] == memory_results["quantities"]
+    print(f"{len(batches)} batches of {args.batch_size} claims")
+    print(f"file round trip: {file_time:.2f} s ({args.claims / file_time:,.0f} claims/s)")
+    print(f"in memory:       {memory_time:.2f} s ({args.claims / memory_time:,.0f} claims/s)")
+    print(f"speedup: {file_time / memory_time:.1f}x, same results: {same}")
+
+
+if __name__ == "__main__":
+    main()
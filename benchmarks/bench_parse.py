@@ -0,0 +1,78 @@
+"""
+Compares per-shard parsing and schema coercion of claims against the previous implementation
+(`pd.read_json` with type inference, then `pd.to_datetime`, `pd.to_numeric` and
+`astype("string")` on every column).
+
+Usage:
+    python -m benchmarks.bench_parse --shard-sizes 10000 100000 1000000
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks import generator
+from hippo import data_loader
+
+
+def previous_parse(item: str, layout: str) -> pd.DataFrame:
+    """
+    Parsing and coercion as implemented before the typed readers.
+    """
+    df = pd.read_json(item)
+    coerced = {}
+    for col, col_type in data_loader.SCHEMAS[layout].items():
+        if col_type == "datetime":
+            coerced[col] = pd.to_datetime(df[col], errors="coerce")
+        elif col_type in ["float", "int"]:
+            coerced[col] = pd.to_numeric(df[col], errors="coerce")
+        else:
+            coerced[col] = df[col].astype("string")
+    return pd.DataFrame(coerced, index=df.index)
+
+
+def current_parse(item: str, layout: str) -> pd.DataFrame:
+    """
+    Parsing and coercion with `data_loader.FILE_FORMATS` and `data_loader.coerce_column`.
+    """
+    df = data_loader.FILE_FORMATS["json"](item, layout)
+    return pd.DataFrame(
+        {col: data_loader.coerce_column(df[col], col_type) for col, col_type in data_loader.SCHEMAS[layout].items()},
+        index=df.index
+    )
+
+
+def best_time(func, *args, repeat: int = 3) -> float:
+    """
+    Returns the best wall time of `repeat` calls.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-shard parsing and coercion of claims.")
+    parser.add_argument("--shard-sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--malformed-ratio", type=float, default=0.001)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'claims':>12} {'previous (s)':>14} {'current (s)':>12} {'speedup':>8}")
+    for size in args.shard_sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            generator.generate(tmp_dir, size, malformed_ratio=args.malformed_ratio)
+            item = glob.glob(os.path.join(tmp_dir, "claims", "*.json"))[0]
+            previous_time = best_time(previous_parse, item, "claims", repeat=args.repeat)
+            current_time = best_time(current_parse, item, "claims", repeat=args.repeat)
+        print(f"{size:>12} {previous_time:>14.3f} {current_time:>12.3f} {previous_time / current_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
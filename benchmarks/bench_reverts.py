@@ -0,0 +1,59 @@
+"""
+Compares revert counting in `metrics.partial_metrics` against the previous implementation
+(left merge of claims to reverts followed by `groupby(...).apply`).
+
+Usage:
+    python -m benchmarks.bench_reverts --sizes 100000 1000000 10000000
+"""
+import argparse
+import time
+import warnings
+
+import pandas as pd
+
+from benchmarks.generator import make_claims
+from hippo import metrics
+
+
+def previous_revert_count(claims_df: pd.DataFrame, reverts_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Revert counting as implemented before the claim-id index.
+    """
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    claims_reverts = claims_df[["id", "npi", "ndc"]].merge(
+        reverts_df, left_on="id", right_on="claim_id", how="left"
+    )
+    return claims_reverts.groupby(["npi", "ndc"]).apply(
+        lambda df: df["claim_id"].notna().sum()
+    ).reset_index(name="reverted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark revert counting in compute_metrics.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--npis", type=int, default=100)
+    parser.add_argument("--ndcs", type=int, default=1_000)
+    parser.add_argument("--revert-ratio", type=float, default=0.05)
+    parser.add_argument("--skip-previous", action="store_true", help="Only time the current implementation.")
+    args = parser.parse_args()
+
+    print(f"{'claims':>12} {'previous (s)':>14} {'current (s)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        claims_df, reverts_df = make_claims(size, args.npis, args.ndcs, args.revert_ratio)
+
+        start = time.perf_counter()
+        current = metrics.partial_metrics(claims_df, reverts_df)
+        current_time = time.perf_counter() - start
+
+        previous_time = float("nan")
+        if not args.skip_previous:
+            start = time.perf_counter()
+            previous = previous_revert_count(claims_df, reverts_df)
+            previous_time = time.perf_counter() - start
+            assert previous["reverted"].sum() == current["reverted"].sum()
+
+        print(f"{size:>12} {previous_time:>14.3f} {current_time:>12.3f} {previous_time / current_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
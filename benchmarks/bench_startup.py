@@ -0,0 +1,107 @@
+"""
+Checks the startup budget of the CLI: the time to import `hippo.cli`, as reported by
+`python -X importtime`, and the wall time of `python -m hippo.cli --help`. Exits with status 1
+if the import time is over budget or if pandas or NumPy are imported, so it can run in CI.
+
+The budget is relative to the time to import pandas on the same machine, which is what a lazy
+CLI avoids paying, so it holds on slow and fast machines alike. An absolute budget can be
+added with `--max-import-ms`. The lazy-import requirement itself is covered by
+`tests/test_startup.py`.
+
+Usage:
+    python -m benchmarks.bench_startup --max-import-ratio 0.25
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must not be imported before a command runs
+HEAVY_MODULES = ["pandas", "numpy"]
+
+# Module whose import time is the baseline of the relative budget
+BASELINE_MODULE = "pandas"
+
+
+def import_times(module: str) -> dict:
+    """
+    Imports a module in a fresh interpreter with `-X importtime`.
+
+    Parameters:
+        module (str): Name of the module to import.
+
+    Returns:
+        dict: Cumulative import time in microseconds of every imported module, by name.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def median_import_ms(module: str, runs: int) -> tuple:
+    """
+    Imports a module in `runs` fresh interpreters and returns the median of its cumulative
+    import time in milliseconds, with the modules imported along with it.
+    """
+    samples, imported = [], set()
+    for _ in range(runs):
+        times = import_times(module)
+        samples.append(times[module] / 1000)
+        imported.update(times)
+    return statistics.median(samples), imported
+
+
+def help_wall_times(runs: int) -> list:
+    """
+    Runs `python -m hippo.cli --help` and returns the wall time of each run in seconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "hippo.cli", "--help"], capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the startup time of the CLI.")
+    parser.add_argument(
+        "--max-import-ratio", type=float, default=0.25,
+        help=f"Budget for importing hippo.cli, as a fraction of the time to import {BASELINE_MODULE}."
+    )
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Optional absolute budget for importing hippo.cli.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of timed imports and `--help` runs.")
+    args = parser.parse_args()
+
+    import_ms, imported = median_import_ms("hippo.cli", args.runs)
+    baseline_ms, _ = median_import_ms(BASELINE_MODULE, args.runs)
+    budget_ms = args.max_import_ratio * baseline_ms
+    if args.max_import_ms is not None:
+        budget_ms = min(budget_ms, args.max_import_ms)
+    heavy = [name for name in HEAVY_MODULES if name in imported]
+    wall_ms = statistics.median(help_wall_times(args.runs)) * 1000
+
+    print(f"import {BASELINE_MODULE}: {baseline_ms:.1f} ms (median of {args.runs} runs)")
+    print(f"import hippo.cli: {import_ms:.1f} ms (median of {args.runs} runs, budget {budget_ms:.1f} ms)")
+    print(f"python -m hippo.cli --help: {wall_ms:.1f} ms (median of {args.runs} runs)")
+    failures = []
+    if import_ms > budget_ms:
+        failures.append(f"importing hippo.cli took {import_ms:.1f} ms")
+    if heavy:
+        failures.append(f"importing hippo.cli imported {', '.join(heavy)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Seeded synthetic generator of claims, reverts and pharmacies in the input layout read by `hippo`.
+
+Usage:
+    python -m benchmarks.generator data/synthetic --claims 1000000 --shards 20 --malformed-ratio 0.001
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+CHAINS = ["health", "saint", "doctor", "pharmacy", "care", "wellness", "med", "rx"]
+START_TIMESTAMP = np.datetime64("2024-01-01T00:00:00")
+SECONDS_IN_YEAR = 365 * 24 * 3600
+
+# Malformed values injected into claims, one kind chosen at random per malformed row
+MALFORMED_VALUES = {
+    "price": "not-a-number",
+    "quantity": 0,
+    "timestamp": "not-a-timestamp",
+    "npi": None,
+}
+
+_UUID_POSITIONS = np.r_[0:8, 9:13, 14:18, 19:23, 24:36]
+
+
+def random_uuids(rng: np.random.Generator, n: int) -> np.ndarray:
+    """
+    Generates random UUID strings in canonical form without a Python-level loop.
+
+    Parameters:
+        rng (np.random.Generator): Random generator.
+        n (int): Number of UUIDs.
+
+    Returns:
+        np.ndarray: Array of `n` UUID strings.
+    """
+    digits = np.frombuffer(rng.bytes(16 * n).hex().encode("ascii"), dtype=np.uint8).reshape(n, 32)
+    chars = np.full((n, 36), ord("-"), dtype=np.uint8)
+    chars[:, _UUID_POSITIONS] = digits
+    return np.frombuffer(chars.tobytes(), dtype="S36").astype(str)
+
+
+def make_keys(n: int, width: int) -> np.ndarray:
+    """
+    Builds `n` distinct zero-padded identifiers, as used for pharmacies (npi) and drugs (ndc).
+
+    Parameters:
+        n (int): Number of identifiers.
+        width (int): Number of digits.
+
+    Returns:
+        np.ndarray: Array of strings.
+    """
+    return np.char.zfill(np.arange(1, n + 1).astype(str), width)
+
+
+def make_claims(n_claims: int, n_npis: int, n_ndcs: int, revert_ratio: float, seed: int = 0) -> tuple:
+    """
+    Builds synthetic validated claims and reverts DataFrames in memory.
+
+    Parameters:
+        n_claims (int): Number of claims.
+        n_npis (int): Number of distinct pharmacies.
+        n_ndcs (int): Number of distinct drugs.
+        revert_ratio (float): Fraction of claims that are reverted.
+        seed (int): Random seed.
+
+    Returns:
+        tuple: `(claims_df, reverts_df)`.
+    """
+    rng = np.random.default_rng(seed)
+    npis, ndcs = make_keys(n_npis, 10), make_keys(n_ndcs, 11)
+    claims_df = pd.DataFrame({
+        "id": pd.array(random_uuids(rng, n_claims), dtype="string"),
+        "npi": pd.array(npis[rng.integers(0, n_npis, n_claims)], dtype="string"),
+        "ndc": pd.array(ndcs[rng.integers(0, n_ndcs, n_claims)], dtype="string"),
+        "price": rng.uniform(1, 1000, n_claims).round(2),
+        "quantity": rng.integers(1, 180, n_claims).astype(float),
+        "timestamp": START_TIMESTAMP + rng.integers(0, SECONDS_IN_YEAR, n_claims).astype("timedelta64[s]"),
+    })
+    reverted = rng.choice(n_claims, int(n_claims * revert_ratio), replace=False)
+    reverts_df = pd.DataFrame({
+        "id": pd.array(random_uuids(rng, len(reverted)), dtype="string"),
+        "claim_id": claims_df["id"].iloc[reverted].to_numpy(),
+        "timestamp": claims_df["timestamp"].iloc[reverted].to_numpy() + np.timedelta64(1, "h"),
+    })
+    return claims_df, reverts_df
+
+
+def make_pharmacies(n_npis: int, n_chains: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Builds the pharmacies DataFrame, assigning every pharmacy to a chain.
+
+    Parameters:
+        n_npis (int): Number of distinct pharmacies.
+        n_chains (int): Number of chains.
+        seed (int): Random seed.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns chain and npi.
+    """
+    rng = np.random.default_rng(seed)
+    chains = np.array([f"{CHAINS[i % len(CHAINS)]}{i // len(CHAINS) or ''}" for i in range(n_chains)])
+    return pd.DataFrame({"chain": chains[rng.integers(0, n_chains, n_npis)], "npi": make_keys(n_npis, 10)})
+
+
+def corrupt(claims_df: pd.DataFrame, malformed_ratio: float, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Replaces one field of a fraction of the claims with a value rejected by validation.
+
+    Parameters:
+        claims_df (pd.DataFrame): Claims of one shard, with timestamps already formatted as strings.
+        malformed_ratio (float): Fraction of claims to corrupt.
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        pd.DataFrame: Claims with malformed rows.
+    """
+    rows = rng.choice(len(claims_df), int(len(claims_df) * malformed_ratio), replace=False)
+    if not len(rows):
+        return claims_df
+
+    claims_df = claims_df.astype(object)
+    fields = np.array(list(MALFORMED_VALUES))[rng.integers(0, len(MALFORMED_VALUES), len(rows))]
+    for field, value in MALFORMED_VALUES.items():
+        claims_df.iloc[rows[fields == field], claims_df.columns.get_loc(field)] = value
+    return claims_df
+
+
+def _write_json(df: pd.DataFrame, path: str):
+    df.to_json(path, orient="records", double_precision=2)
+
+
+def generate(
+    output_dir: str,
+    n_claims: int,
+    n_npis: int = 100,
+    n_ndcs: int = 1_000,
+    n_chains: int = 8,
+    revert_ratio: float = 0.05,
+    malformed_ratio: float = 0.0,
+    shards: int = 1,
+    seed: int = 0,
+) -> dict:
+    """
+    Writes synthetic input data to `output_dir/{pharmacies,claims,reverts}`.
+
+    Each shard is generated from its own seed, so memory use depends on the shard size and
+    the output is identical for the same arguments. Reverts of the claims of a shard are
+    written to the reverts shard of the same number.
+
+    Parameters:
+        output_dir (str): Base directory of the generated data.
+        n_claims (int): Total number of claims.
+        n_npis (int): Number of distinct pharmacies.
+        n_ndcs (int): Number of distinct drugs.
+        n_chains (int): Number of pharmacy chains.
+        revert_ratio (float): Fraction of claims that are reverted.
+        malformed_ratio (float): Fraction of claims with a malformed field.
+        shards (int): Number of claims and reverts files.
+        seed (int): Random seed.
+
+    Returns:
+        dict: Number of claims, reverts and malformed claims written, and the size in bytes of the data.
+    """
+    for layout in ["pharmacies", "claims", "reverts"]:
+        os.makedirs(os.path.join(output_dir, layout), exist_ok=True)
+
+    pharmacies_df = make_pharmacies(n_npis, n_chains, seed)
+    pharmacies_df.to_csv(os.path.join(output_dir, "pharmacies", "pharmacies.csv"), index=False)
+
+    summary = {"claims": 0, "reverts": 0, "malformed": 0, "bytes": 0}
+    shard_sizes = np.diff(np.linspace(0, n_claims, shards + 1).astype(int))
+    for shard, shard_size in enumerate(shard_sizes):
+        claims_df, reverts_df = make_claims(shard_size, n_npis, n_ndcs, revert_ratio, seed=(seed, shard))
+        claims_df["timestamp"] = claims_df["timestamp"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+        reverts_df["timestamp"] = reverts_df["timestamp"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+        rng = np.random.default_rng((seed, shard, 1))
+        claims = corrupt(claims_df, malformed_ratio, rng)
+        summary["malformed"] += int(shard_size * malformed_ratio)
+
+        for layout, df in [("claims", claims), ("reverts", reverts_df)]:
+            path = os.path.join(output_dir, layout, f"{layout}-{shard:05d}.json")
+            _write_json(df, path)
+            summary[layout] += len(df)
+            summary["bytes"] += os.path.getsize(path)
+        logging.info(f"Shard {shard + 1}/{shards}: {shard_size} claims, {len(reverts_df)} reverts.")
+
+    return summary
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Generate synthetic claims, reverts and pharmacies.")
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--claims", type=int, default=100_000)
+    parser.add_argument("--npis", type=int, default=100)
+    parser.add_argument("--ndcs", type=int, default=1_000)
+    parser.add_argument("--chains", type=int, default=8)
+    parser.add_argument("--revert-ratio", type=float, default=0.05)
+    parser.add_argument("--malformed-ratio", type=float, default=0.0)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate(
+        args.output_dir, args.claims, args.npis, args.ndcs, args.chains,
+        args.revert_ratio, args.malformed_ratio, args.shards, args.seed
+    )
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Load-tests a running query service (`python -m hippo.cli serve`) and reports latency percentiles
+and throughput.
+
+Each connection sends requests back to back over a keep-alive HTTP/1.1 connection, cycling
+through top-chains, metrics and quantities queries for keys listed by the service. Client
+latency includes the network and the client itself; the handler time is the time the service
+reports in its `X-Handler-Time-Us` header.
+
+Usage:
+    python -m benchmarks.load_test --port 8080 --connections 16 --requests 50000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.request
+
+import numpy as np
+
+
+def fetch_keys(host: str, port: int, limit: int) -> dict:
+    """
+    Returns the ndcs and (npi, ndc) pairs the service has answers for.
+    """
+    with urllib.request.urlopen(f"http://{host}:{port}/keys?limit={limit}") as response:
+        return json.load(response)
+
+
+def make_paths(keys: dict, n: int, seed: int) -> list:
+    """
+    Builds `n` request paths, one third of each query type.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            paths.append(f"/top-chains/{rng.choice(keys['ndcs'])}")
+        elif kind == 1:
+            npi, ndc = rng.choice(keys["pairs"])
+            paths.append(f"/metrics/{npi}/{ndc}")
+        else:
+            paths.append(f"/quantities/{rng.choice(keys['ndcs'])}")
+    return paths
+
+
+async def run_connection(host: str, port: int, paths: list, latencies: list, handler_times: list, statuses: dict):
+    """
+    Sends the requests of one connection and records the latency of each response.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for path in paths:
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            lines = head.decode("latin-1").split("\r\n")
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get("content-length", 0)))
+            latencies.append(time.perf_counter() - start)
+            handler_times.append(int(headers.get("x-handler-time-us", 0)))
+            status = lines[0].split(" ")[1]
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(host: str, port: int, paths: list, connections: int) -> dict:
+    """
+    Runs the requests over `connections` concurrent connections.
+
+    Returns:
+        dict: Throughput, latency percentiles and status counts.
+    """
+    latencies, handler_times, statuses = [], [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_connection(host, port, paths[i::connections], latencies, handler_times, statuses)
+        for i in range(connections)
+    ])
+    seconds = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    handler_us = np.array(handler_times)
+    return {
+        "requests": len(latencies),
+        "connections": connections,
+        "seconds": round(seconds, 3),
+        "requests_per_s": round(len(latencies) / seconds, 1),
+        "latency_ms": {f"p{q}": round(float(np.percentile(latencies_ms, q)), 3) for q in (50, 90, 99)},
+        "handler_us": {f"p{q}": round(float(np.percentile(handler_us, q)), 1) for q in (50, 90, 99)},
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the query service.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--keys", type=int, default=1_000, help="Number of keys sampled from the service.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    paths = make_paths(fetch_keys(args.host, args.port, args.keys), args.requests, args.seed)
+    results = asyncio.run(run(args.host, args.port, paths, args.connections))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
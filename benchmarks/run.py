@@ -0,0 +1,145 @@
+"""
+Times and memory-profiles each stage of the pipeline on synthetic data of increasing size and
+writes the results as JSON, so runs of different releases can be diffed.
+
+Usage:
+    python -m benchmarks.run --sizes 10000 100000 1000000 --output benchmarks/results.json
+    python -m benchmarks.run --sizes 100000000 --shards-per-million 1 --no-memory
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import generator
+from hippo import data_loader, metrics, quantities, recommendations
+
+
+def measure(stage: str, func, *args, trace_memory: bool = True, **kwargs) -> tuple:
+    """
+    Runs one stage and measures its wall time and peak traced memory.
+
+    Parameters:
+        stage (str): Name of the stage.
+        func (callable): Function running the stage.
+        trace_memory (bool): If set, peak memory allocated during the stage is traced; this slows it down.
+
+    Returns:
+        tuple: `(result, record)` where `record` is a dict with stage, seconds, peak_bytes and rows.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak_bytes = None
+    if trace_memory:
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    rows = len(result) if isinstance(result, pd.DataFrame) else None
+    return result, {"stage": stage, "seconds": round(seconds, 4), "peak_bytes": peak_bytes, "rows": rows}
+
+
+def run_size(data_dir: str, trace_memory: bool = True) -> list:
+    """
+    Runs every stage of the pipeline on the data generated in `data_dir`.
+
+    Parameters:
+        data_dir (str): Base directory of the generated data.
+        trace_memory (bool): If set, peak memory of each stage is traced.
+
+    Returns:
+        list: One record per stage, as returned by `measure`.
+    """
+    data_path = os.path.join(data_dir, "{layout}")
+    data, records = {}, []
+    for layout, file_format in [("pharmacies", "csv"), ("claims", "json"), ("reverts", "json")]:
+        data[layout], record = measure(
+            f"load_{layout}", data_loader.load_data, layout, file_format, data_path, trace_memory=trace_memory
+        )
+        records.append(record)
+
+    stages = [
+        ("metrics", metrics.compute_metrics, data["claims"], data["reverts"]),
+        ("top_chains", recommendations.compute_top_chains, data["claims"], data["pharmacies"]),
+        ("quantities", quantities.compute_common_quantities, data["claims"]),
+    ]
+    for stage, func, *args in stages:
+        _, record = measure(stage, func, *args, trace_memory=trace_memory)
+        records.append(record)
+    return records
+
+
+def environment() -> dict:
+    """
+    Describes the environment of a benchmark run.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Numbers of claims.")
+    parser.add_argument("--npis", type=int, default=100)
+    parser.add_argument("--ndcs", type=int, default=1_000)
+    parser.add_argument("--chains", type=int, default=8)
+    parser.add_argument("--revert-ratio", type=float, default=0.05)
+    parser.add_argument("--malformed-ratio", type=float, default=0.001)
+    parser.add_argument("--shards-per-million", type=int, default=10, help="Number of shards per million claims.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=str, default=None, help="Keep the generated data in this directory.")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory; faster at large sizes.")
+    parser.add_argument("--output", type=str, default="benchmarks/results.json")
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "data_dir")}
+    results = {"environment": environment(), "params": params, "runs": []}
+    for size in args.sizes:
+        shards = max(1, size * args.shards_per_million // 1_000_000)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = os.path.join(args.data_dir, str(size)) if args.data_dir else tmp_dir
+            start = time.perf_counter()
+            generated = generator.generate(
+                data_dir, size, args.npis, args.ndcs, args.chains,
+                args.revert_ratio, args.malformed_ratio, shards, args.seed
+            )
+            generated["seconds"] = round(time.perf_counter() - start, 4)
+            records = run_size(data_dir, trace_memory=not args.no_memory)
+
+        results["runs"].append({"claims": size, "shards": shards, "generated": generated, "stages": records})
+        for record in records:
+            peak = f"{record['peak_bytes'] / 2**20:.1f} MiB" if record["peak_bytes"] is not None else "-"
+            print(f"{size:>12} {record['stage']:>16} {record['seconds']:>10.3f}s {peak:>12}")
+
+    results["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+from collections.abc import Mapping
+
+import pandas as pd
+
+from hippo import data_loader, dedup, metrics, quantities, recommendations, sketches, state
+from hippo.constants import DEDUP_KEEP
+
+# Claims are buffered and merged into the aggregates this many at a time, since a merge costs
+# as much as the aggregates are large, however few claims it adds
+FLUSH_ROWS = 50_000
+
+def to_frame(batch) -> pd.DataFrame:
+    """
+    Converts a batch of records to a raw DataFrame.
+
+    Parameters:
+        batch: A DataFrame, a mapping of column names to arrays, an object with a `to_pandas`
+            method (e.g. an Arrow record batch or table) or an iterable of dictionaries.
+
+    Returns:
+        pd.DataFrame: The records of the batch.
+    """
+    if isinstance(batch, pd.DataFrame):
+        return batch
+    if isinstance(batch, Mapping):
+        return pd.DataFrame(dict(batch))
+    if hasattr(batch, "to_pandas"):
+        return batch.to_pandas()
+    return pd.DataFrame.from_records(list(batch))
+
+class Aggregator:
+    """
+    In-memory aggregator, to feed claims, reverts and pharmacies to hippo without going through
+    input files.
+
+    Batches are validated with the same `data_loader.SCHEMAS` rules as input files and merged
+    into running aggregates the way `--state` runs merge new shards (see `state.merge_events`),
+    so reverts may arrive before or after their claim and the cost of a batch does not grow with
+    the number of claims already added.
+
+    Parameters:
+        net (bool): If set, reverted claims are excluded from the results.
+        top_k (int): Maximum number of chains per drug in the recommendations.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be recommended.
+        top_n (int): If set, maximum number of common quantities listed per drug.
+        deduplicate (str): If set, claims whose id was already added are dropped, and among the
+            claims of a batch, the "first" one or the "latest" one by timestamp is kept (see
+            `dedup.drop_duplicates`).
+        sketch (bool): If set, unit price quantiles are added to the results and quantities are
+            listed from a bounded heavy-hitter sketch (see `sketches`).
+        quarantine_dir (str): Directory where rejected rows are written.
+    """
+
+    def __init__(self, net: bool = True, top_k: int = 2, min_fills: int = 1, top_n: int = None, deduplicate: str = None, sketch: bool = False, quarantine_dir: str = None):
+        if deduplicate and deduplicate not in DEDUP_KEEP:
+            raise ValueError(f"Unknown de-duplication policy: {deduplicate}")
+        self.net = net
+        self.top_k = top_k
+        self.min_fills = min_fills
+        self.top_n = top_n
+        self.deduplicate = deduplicate
+        self.sketch = sketch
+        self.quarantine_dir = quarantine_dir
+
+        self._state = state.empty_state()
+        self._pharmacies = pd.DataFrame(columns=list(data_loader.SCHEMAS["pharmacies"]))
+        self._batches = {"pharmacies": 0, "claims": 0, "reverts": 0}
+        self._pending = []
+        self._pending_rows = 0
+        self._pending_ids = dedup.empty_index()
+
+    def _validate(self, batch, layout: str) -> pd.DataFrame:
+        """
+        Validates a batch of a layout with `data_loader.validate_frame`, naming it by its position.
+        """
+        self._batches[layout] += 1
+        df = to_frame(batch)
+        columns = [col for col in data_loader.SCHEMAS[layout] if col in df.columns]
+        source = f"{layout} batch {self._batches[layout]}"
+        return data_loader.validate_frame(df[columns].reset_index(drop=True), layout, source, self.quarantine_dir)
+
+    def _flush(self):
+        """
+        Merges the buffered claims into the aggregates.
+        """
+        if not self._pending:
+            return
+        claims_df = pd.concat(self._pending, ignore_index=True)
+        self._pending, self._pending_rows = [], 0
+        self._pending_ids = dedup.empty_index()
+        state.merge_events(self._state, claims_df, pd.DataFrame(), sketch=self.sketch)
+
+    def set_pharmacies(self, batch) -> int:
+        """
+        Replaces the pharmacies used to map pharmacies to chains in the recommendations.
+
+        Parameters:
+            batch: Pharmacy records, in any format accepted by `to_frame`.
+
+        Returns:
+            int: Number of valid pharmacies.
+        """
+        self._pharmacies = self._validate(batch, "pharmacies")
+        return len(self._pharmacies)
+
+    def add_claims(self, batch) -> int:
+        """
+        Validates a batch of claims and adds it to the aggregates.
+
+        Parameters:
+            batch: Claim records, in any format accepted by `to_frame`.
+
+        Returns:
+            int: Number of claims added, after dropping invalid and, if enabled, duplicated claims.
+        """
+        claims_df = self._validate(batch, "claims")
+        if self.deduplicate and not claims_df.empty:
+            claims_df = state.drop_consumed(self._state, claims_df, self.deduplicate)
+            claims_df, self._pending_ids = dedup.drop_duplicates(claims_df, self.deduplicate, self._pending_ids)
+        if not claims_df.empty:
+            self._pending.append(claims_df)
+            self._pending_rows += len(claims_df)
+        if self._pending_rows >= FLUSH_ROWS:
+            self._flush()
+        return len(claims_df)
+
+    def add_reverts(self, batch) -> int:
+        """
+        Validates a batch of reverts and adds it to the aggregates.
+
+        A revert of a claim that was not added yet is kept until the claim is.
+
+        Parameters:
+            batch: Revert records, in any format accepted by `to_frame`.
+
+        Returns:
+            int: Number of valid reverts.
+        """
+        reverts_df = self._validate(batch, "reverts")
+        if not reverts_df.empty:
+            state.merge_events(self._state, pd.DataFrame(), reverts_df, sketch=self.sketch)
+        return len(reverts_df)
+
+    def results(self) -> dict:
+        """
+        Computes the outputs from the current aggregates. The aggregator can keep receiving
+        batches afterwards.
+
+        Returns:
+            dict: A dictionary with keys:
+                - 'metrics': metrics DataFrame, as returned by `metrics.compute_metrics`
+                - 'top_chains': list of top chains per drug, as returned by `recommendations.compute_top_chains`
+                - 'quantities': list of common quantities per drug, as returned by `quantities.compute_common_quantities`
+        """
+        self._flush()
+        aggregates = self._state
+        top_chains_partial = recommendations.partial_top_chains_from_metrics(aggregates["metrics"], self._pharmacies)
+
+        if self.sketch:
+            price_sketch = aggregates["price_sketch"]
+            return {
+                "metrics": sketches.finalize_metrics(aggregates["metrics"], price_sketch, self.net),
+                "top_chains": sketches.finalize_top_chains(
+                    top_chains_partial, sketches.chain_price_sketch(price_sketch, self._pharmacies),
+                    self.top_k, self.min_fills, self.net
+                ),
+                "quantities": quantities.finalize_common_quantities(
+                    sketches.truncate_quantities(aggregates["quantities"]), self.top_n, self.net
+                ),
+            }
+        return {
+            "metrics": metrics.finalize_metrics(aggregates["metrics"], self.net),
+            "top_chains": recommendations.finalize_top_chains(top_chains_partial, self.top_k, self.min_fills, self.net),
+            "quantities": quantities.finalize_common_quantities(aggregates["quantities"], self.top_n, self.net),
+        }
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_DIR = "data/cache"
+HASH_CHUNK_SIZE = 1 << 20
+# Version of the validated data; entries written by an older version are not read
+CACHE_VERSION = 2
+
+def file_digest(item: str) -> str:
+    """
+    Computes the SHA-1 digest of a file's content.
+
+    Parameters:
+        item (str): Path to the file.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    with open(item, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def filters_digest(filters: dict) -> str:
+    """
+    Computes a digest of row filters, so data read with different filters is cached separately.
+
+    Parameters:
+        filters (dict): Allowed values per column, see `data_loader.filter_rows`.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    for col in sorted(filters):
+        digest.update(col.encode("utf-8") + b"\0")
+        for value in sorted(str(value) for value in filters[col]):
+            digest.update(value.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+def _index_path(item: str, cache_dir: str) -> str:
+    key = hashlib.sha1(os.path.abspath(item).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "index", f"{key}.json")
+
+def _entry_dir(cache_dir: str, layout: str, digest: str) -> str:
+    return os.path.join(cache_dir, layout, f"{digest}.v{CACHE_VERSION}")
+
+def content_key(item: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """
+    Returns the content digest of a file, hashing it only if its size or mtime changed since
+    the last time it was seen.
+
+    Parameters:
+        item (str): Path to the file.
+        cache_dir (str): Directory of the cache.
+
+    Returns:
+        str: Hexadecimal digest of the file's content.
+    """
+    stat = os.stat(item)
+    index_path = _index_path(item, cache_dir)
+    if os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            entry = json.load(f)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["hash"]
+
+    digest = file_digest(item)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"path": item, "size": stat.st_size, "mtime": stat.st_mtime, "hash": digest}, f)
+    os.replace(tmp_path, index_path)
+    return digest
+
+def read_entry(layout: str, digest: str, cache_dir: str = DEFAULT_CACHE_DIR) -> tuple:
+    """
+    Reads the validated data of a file from the cache.
+
+    Numeric and datetime columns are memory-mapped instead of copied; string columns are
+    converted back to the pandas "string" dtype.
+
+    Parameters:
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        digest (str): Content digest of the file, as returned by `content_key`.
+        cache_dir (str): Directory of the cache.
+
+    Returns:
+        tuple: `(df_valid, total_rows)`; `df_valid` is `None` if the file is not cached.
+    """
+    entry_dir = _entry_dir(cache_dir, layout, digest)
+    meta_path = os.path.join(entry_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None, 0
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+
+    columns = {}
+    for col in meta["columns"]:
+        values = np.load(os.path.join(entry_dir, f"{col}.npy"), mmap_mode="r")
+        if values.dtype.kind == "U":
+            columns[col] = pd.array(values, dtype="string")
+        else:
+            columns[col] = values
+    return pd.DataFrame(columns, copy=False), meta["total_rows"]
+
+def write_entry(df: pd.DataFrame, total_rows: int, layout: str, digest: str, cache_dir: str = DEFAULT_CACHE_DIR):
+    """
+    Writes the validated data of a file to the cache, one `.npy` file per column.
+
+    The entry is written to a temporary directory and renamed, so concurrent workers never see
+    a partial entry.
+
+    Parameters:
+        df (pd.DataFrame): Validated data of the file.
+        total_rows (int): Number of rows in the file before validation.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        digest (str): Content digest of the file, as returned by `content_key`.
+        cache_dir (str): Directory of the cache.
+    """
+    entry_dir = _entry_dir(cache_dir, layout, digest)
+    if os.path.exists(entry_dir):
+        return
+
+    tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col].dtype):
+            values = df[col].to_numpy(dtype=str)
+        else:
+            values = df[col].to_numpy()
+        np.save(os.path.join(tmp_dir, f"{col}.npy"), values)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"columns": list(df.columns), "rows": len(df), "total_rows": total_rows}, f)
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        logging.debug(f"Cache entry {entry_dir} already written by another worker.")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
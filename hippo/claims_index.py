@@ -0,0 +1,236 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from hippo import dedup
+
+INDEX_DIR = "index"
+COLUMNS = ["row", "npi", "ndc", "quantity", "price", "unit_price"]
+
+# The last two chunks are merged while the older one is at most this many times larger, so
+# chunk sizes grow geometrically and a claim is rewritten O(log n) times
+COMPACTION_RATIO = 2
+
+def empty_index() -> dict:
+    """
+    Creates an index of consumed claims with no claims.
+
+    Claims are stored in append-only chunks, each with its packed ids (see `dedup.pack_ids`)
+    sorted for binary searches and the columns needed to attribute late reverts. Chunks are
+    never modified once written: the number of reverts attributed to each claim is kept apart,
+    by row number, since only a small fraction of claims is ever reverted.
+
+    Returns:
+        dict: A dictionary with keys:
+            - 'chunks': list of chunks, each with keys 'keys' (sorted ids), 'rows' (`COLUMNS` of
+              the claims, aligned with 'keys') and 'number' (file number once persisted)
+            - 'reverted': number of attributed reverts, indexed by row number, of reverted claims
+            - 'rows': number of claims added so far
+            - 'next_chunk': number of the next chunk file
+    """
+    return {
+        "chunks": [],
+        "reverted": pd.Series(dtype="int64"),
+        "rows": 0,
+        "next_chunk": 0,
+    }
+
+def _chunk_rows(chunk: dict) -> pd.DataFrame:
+    """
+    Returns the rows of a chunk, reading them from disk on first use.
+    """
+    if chunk["rows"] is None:
+        chunk["rows"] = pd.read_pickle(chunk["path"])
+    return chunk["rows"]
+
+def _merge_chunks(chunks: list) -> dict:
+    """
+    Merges chunks into a single chunk, sorted by id.
+    """
+    keys = np.concatenate([chunk["keys"] for chunk in chunks])
+    rows = pd.concat([_chunk_rows(chunk) for chunk in chunks], ignore_index=True)
+    order = np.argsort(keys, kind="stable")
+    rows = rows.iloc[order].reset_index(drop=True)
+    # Categories of different chunks differ, so keys come out of the concatenation as objects
+    rows = rows.astype({"npi": "category", "ndc": "category"})
+    return {"keys": keys[order], "rows": rows, "number": None}
+
+def append(index: dict, keys: np.ndarray, claims_df: pd.DataFrame):
+    """
+    Adds claims to the index as a new chunk, then merges the last chunks (see `COMPACTION_RATIO`).
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        keys (np.ndarray): Packed ids of the claims.
+        claims_df (pd.DataFrame): Claims, with `unit_price` and `reverted` columns.
+    """
+    rows_df = claims_df[COLUMNS[1:]].reset_index(drop=True)
+    rows_df.insert(0, "row", np.arange(index["rows"], index["rows"] + len(claims_df), dtype="int64"))
+    index["rows"] += len(claims_df)
+    reverted = claims_df["reverted"].to_numpy()
+    if (reverted > 0).any():
+        index["reverted"] = pd.concat([
+            index["reverted"] if not index["reverted"].empty else None,
+            pd.Series(reverted[reverted > 0], index=rows_df["row"].to_numpy()[reverted > 0], dtype="int64"),
+        ])
+
+    chunk = _merge_chunks([{"keys": keys, "rows": rows_df}])
+    chunks = index["chunks"]
+    chunks.append(chunk)
+    while len(chunks) > 1 and len(chunks[-2]["keys"]) <= COMPACTION_RATIO * len(chunks[-1]["keys"]):
+        chunks[-2:] = [_merge_chunks(chunks[-2:])]
+
+def contains(index: dict, keys: np.ndarray) -> np.ndarray:
+    """
+    Checks which ids are in the index.
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        keys (np.ndarray): Packed ids to look up.
+
+    Returns:
+        np.ndarray: Boolean mask, `True` for ids found in the index.
+    """
+    # Chunks are sorted runs of ids, searched like a `dedup` id index
+    return dedup.contains([chunk["keys"] for chunk in index["chunks"]], keys)
+
+def find(index: dict, keys: np.ndarray) -> pd.DataFrame:
+    """
+    Finds the claims with the given ids, with a binary search per id and chunk.
+
+    Only the rows of the chunks holding one of the ids are read.
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        keys (np.ndarray): Packed ids to look up.
+
+    Returns:
+        pd.DataFrame: `COLUMNS` of every claim found, with its number of attributed reverts in
+            `reverted` and the position of its id in `keys` in `query`.
+    """
+    found = []
+    for chunk in index["chunks"]:
+        starts = np.searchsorted(chunk["keys"], keys, side="left")
+        ends = np.searchsorted(chunk["keys"], keys, side="right")
+        counts = ends - starts
+        if not counts.any():
+            continue
+        queries = np.repeat(np.arange(len(keys)), counts)
+        positions = np.repeat(ends - counts.cumsum(), counts) + np.arange(counts.sum())
+        found.append(_chunk_rows(chunk).iloc[positions].assign(query=queries))
+
+    if not found:
+        return pd.DataFrame(columns=COLUMNS + ["reverted", "query"])
+    matched = pd.concat(found, ignore_index=True)
+    matched = matched.astype({"npi": "string", "ndc": "string"})
+    reverted = index["reverted"].reindex(matched["row"].to_numpy())
+    return matched.assign(reverted=reverted.fillna(0).to_numpy(dtype="int64"))
+
+def attributed_reverts(index: dict, keys: np.ndarray) -> np.ndarray:
+    """
+    Returns the number of reverts attributed to claims of the index with the given ids.
+
+    Only ids found in the index are looked up with `find`, and nothing is looked up while no
+    claim is reverted.
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        keys (np.ndarray): Packed ids to look up.
+
+    Returns:
+        np.ndarray: Number of reverts attributed to each id, 0 for ids not in the index.
+    """
+    attributed = np.zeros(len(keys), dtype="int64")
+    if index["reverted"].empty:
+        return attributed
+    consumed = np.flatnonzero(contains(index, keys))
+    if len(consumed):
+        matched = find(index, keys[consumed])
+        # Copies of a claim receive the same reverts, so any of them gives the count of the id
+        counts = matched.groupby("query")["reverted"].max()
+        attributed[consumed[counts.index.to_numpy()]] = counts.to_numpy()
+    return attributed
+
+def add_reverted(index: dict, rows: np.ndarray, added: np.ndarray):
+    """
+    Adds reverts to the number of reverts attributed to claims.
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        rows (np.ndarray): Row numbers of the claims, as returned by `find`.
+        added (np.ndarray): Number of reverts to add to each claim.
+    """
+    added = pd.Series(added, index=rows, dtype="int64")
+    added = added[added > 0].groupby(level=0).sum()
+    if not added.empty:
+        index["reverted"] = index["reverted"].add(added, fill_value=0).astype("int64")
+
+def _paths(directory: str, number: int) -> tuple:
+    name = os.path.join(directory, f"chunk={number:06d}")
+    return f"{name}.keys.npy", f"{name}.pkl"
+
+def save(index: dict, directory: str) -> dict:
+    """
+    Writes the chunks that are not on disk yet and returns the index without its chunk data, to
+    be persisted with the state.
+
+    Chunk files are never overwritten, so the previous state stays readable until the new one is
+    committed; `remove_stale` then deletes the files it no longer references.
+
+    Parameters:
+        index (dict): Index, as returned by `empty_index`.
+        directory (str): Directory of the chunk files.
+
+    Returns:
+        dict: The index, with only the number and size of each chunk.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for chunk in index["chunks"]:
+        if chunk["number"] is not None:
+            continue
+        chunk["number"] = index["next_chunk"]
+        index["next_chunk"] += 1
+        keys_path, rows_path = _paths(directory, chunk["number"])
+        with open(keys_path + ".tmp", "wb") as f:
+            np.save(f, chunk["keys"])
+        os.replace(keys_path + ".tmp", keys_path)
+        pd.to_pickle(chunk["rows"], rows_path + ".tmp")
+        os.replace(rows_path + ".tmp", rows_path)
+    chunks = [{"number": chunk["number"], "size": len(chunk["keys"])} for chunk in index["chunks"]]
+    return {**index, "chunks": chunks}
+
+def load(index: dict, directory: str) -> dict:
+    """
+    Opens the chunks of an index persisted with `save`. Ids are memory-mapped and rows are read
+    when first needed, so lookups only read the pages they touch.
+
+    Parameters:
+        index (dict): Index as returned by `save`.
+        directory (str): Directory of the chunk files.
+
+    Returns:
+        dict: Index in the format described in `empty_index`.
+    """
+    chunks = []
+    for chunk in index["chunks"]:
+        keys_path, rows_path = _paths(directory, chunk["number"])
+        chunks.append({"keys": np.load(keys_path, mmap_mode="r"), "rows": None, "path": rows_path, "number": chunk["number"]})
+    return {**index, "chunks": chunks}
+
+def remove_stale(index: dict, directory: str):
+    """
+    Deletes the chunk files of a directory that the index does not reference.
+
+    Parameters:
+        index (dict): Index, as returned by `save`.
+        directory (str): Directory of the chunk files.
+    """
+    live = {path for chunk in index["chunks"] for path in _paths(directory, chunk["number"])}
+    for entry in os.scandir(directory):
+        if entry.name.startswith("chunk=") and entry.path not in live:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logging.warning(f"Could not remove stale index file {entry.path}: {e}")
@@ -2,17 +2,25 @@ import argparse
 import logging
 import os
 
-from hippo import data_loader, metrics, quantities, recommendations
+# Modules that import pandas are imported by the functions that need them, so that `--help` and
+# argument errors do not pay for importing pandas and NumPy
+from hippo import instrumentation
+from hippo.constants import DEDUP_KEEP, GRANULARITIES, OUTPUT_FORMATS
 
 
-def validate_data() -> bool:
+def validate_data(load_options: dict = None) -> bool:
     """
     Loads all data and logs the number of valid rows for each dataset.
 
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+
     Returns:
         bool: `True` if all datasets have valid data, `False` otherwise.
     """
-    data = data_loader.load_all_data()
+    from hippo import data_loader
+
+    data = data_loader.load_all_data(**(load_options or {}))
     valid = True
     for key, df in data.items():
         if df.empty:
@@ -27,82 +35,590 @@ def validate_data() -> bool:
     return valid
 
 
-def generate_metrics(output_dir: str):
+def load_partials(load_options: dict = None, batch_size: int = None, state_dir: str = None, sketch: bool = False, exchange_dir: str = None) -> dict:
     """
-    Generates metrics from claims and reverts data and saves the result to a JSON file.
+    Computes the partial aggregates of all outputs, either incrementally from a persisted state
+    or by streaming the input files in batches, or merges those written by map tasks.
+
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        batch_size (int): Maximum number of records per batch when streaming.
+        state_dir (str): Directory of the persisted state; takes precedence over `batch_size`.
+        sketch (bool): If set, the unit price and quantity sketches are also computed.
+        exchange_dir (str): If set, the partial aggregates written there by map tasks are reduced
+            instead (see `mapreduce.reduce_partials`); takes precedence over `state_dir`.
+
+    Returns:
+        dict: A dictionary with keys 'metrics', 'top_chains' and 'quantities', and with `sketch`,
+            'price_sketch', 'chain_price_sketch' and 'quantity_sketch'.
+    """
+    from hippo import data_loader, mapreduce, state, streaming
+
+    load_options = load_options or {}
+    data_path = load_options.get("data_path", data_loader.DEFAULT_DATA_PATH)
+    mode = "reduce" if exchange_dir else "state" if state_dir else "streaming"
+    with instrumentation.stage("load_partials", mode=mode) as record:
+        if exchange_dir:
+            partials = mapreduce.reduce_partials(exchange_dir, load_options.get("workers", 1))
+        elif state_dir:
+            partials = state.incremental_aggregates(
+                state_dir,
+                data_path,
+                workers=load_options.get("workers", 1),
+                cache_dir=load_options.get("cache_dir"),
+                quarantine_dir=load_options.get("quarantine_dir"),
+                pharmacy_only=load_options.get("pharmacy_only", False),
+                deduplicate=load_options.get("deduplicate"),
+                sketch=sketch
+            )
+        else:
+            partials = streaming.stream_aggregates(
+                batch_size,
+                data_path,
+                quarantine_dir=load_options.get("quarantine_dir"),
+                pharmacy_only=load_options.get("pharmacy_only", False),
+                deduplicate=load_options.get("deduplicate"),
+                sketch=sketch
+            )
+        record["rows_out"] = len(partials["metrics"])
+    return partials
+
+
+def load_data(load_options: dict = None, window: dict = None) -> dict:
+    """
+    Loads the validated data, restricted to the claims of a time window if one is given, and
+    flags reverted claims once for all outputs (see `metrics.flag_reverts`).
+
+    With a `partition_dir` in the window, claims and reverts are read only from the date
+    partitions overlapping the window instead of from the input files.
+
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        window (dict): Optional keys 'since', 'until', 'granularity' and 'partition_dir'.
+
+    Returns:
+        dict: A dictionary with keys 'pharmacies', 'claims', and 'reverts'.
+    """
+    from hippo import data_loader, metrics, partitions
+
+    load_options = load_options or {}
+    if not window:
+        data = data_loader.load_all_data(**load_options)
+    elif not window.get("partition_dir"):
+        data = data_loader.load_all_data(**load_options)
+        data["claims"] = partitions.filter_window(data["claims"], window.get("since"), window.get("until"))
+    else:
+        data = load_partitioned_data(load_options, window)
+
+    if not data["claims"].empty:
+        data["claims"] = metrics.flag_reverts(data["claims"], data["reverts"])
+    return data
+
+
+def load_partitioned_data(load_options: dict, window: dict) -> dict:
+    """
+    Loads pharmacies from the input files, and claims and reverts from the date partitions that
+    overlap a time window.
+
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        window (dict): Keys 'since', 'until' and 'partition_dir'.
+
+    Returns:
+        dict: A dictionary with keys 'pharmacies', 'claims', and 'reverts'.
+    """
+    from hippo import data_loader, dedup, partitions
+
+    since, until = window.get("since"), window.get("until")
+    data = {
+        "pharmacies": data_loader.load_data(
+            "pharmacies", "csv",
+            load_options.get("data_path", data_loader.DEFAULT_DATA_PATH),
+            workers=load_options.get("workers", 1),
+            cache_dir=load_options.get("cache_dir"),
+            quarantine_dir=load_options.get("quarantine_dir")
+        ),
+        "claims": partitions.read_partitions("claims", window["partition_dir"], since, until),
+        "reverts": partitions.read_partitions("reverts", window["partition_dir"], since, until),
+    }
+    if load_options.get("pharmacy_only") and not data["claims"].empty:
+        data["claims"] = data_loader.filter_rows(data["claims"], data_loader.pharmacy_filter(data["pharmacies"]))
+    if load_options.get("deduplicate"):
+        data["claims"], _ = dedup.drop_duplicates(data["claims"], load_options["deduplicate"])
+    if load_options.get("encode"):
+        data = data_loader.encode_data(data)
+    return data
+
+
+def compute_windowed(compute, claims_df, window: dict, *args):
+    """
+    Runs a computation on the claims, once per period if the window sets a granularity.
+
+    Parameters:
+        compute (callable): Computation taking the claims as first argument.
+        claims_df (pd.DataFrame): Validated claims data.
+        window (dict): Optional keys 'since', 'until', 'granularity' and 'partition_dir'.
+        *args: Remaining arguments of the computation.
+
+    Returns:
+        pd.DataFrame | list: Result of the computation, see `partitions.rollup`.
+    """
+    from hippo import partitions
+
+    if window and window.get("granularity"):
+        return partitions.rollup(compute, claims_df, window["granularity"], *args)
+    return compute(claims_df, *args)
+
+
+def save_metrics(metrics_df, output_dir: str, output_options: dict = None):
+    """
+    Saves computed metrics to `metrics.json` in the output directory, or the file of the
+    requested output format (see `writers.output_path`).
 
     Parameters:
+        metrics_df (pd.DataFrame): Computed metrics.
         output_dir (str): Directory where the output file will be saved.
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
     """
-    data = data_loader.load_all_data()
-    claims_df = data.get("claims")
-    reverts_df = data.get("reverts")
-    if claims_df.empty:
-        logging.error("No claims data available for metrics computation.")
-        return
-    metrics_df = metrics.compute_metrics(claims_df, reverts_df)
+    from hippo import writers
+
     if metrics_df.empty:
         logging.error("Metrics computation resulted in an empty dataset.")
     else:
         os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "metrics.json")
-        metrics_df.to_json(output_path, orient="records", indent=4)
+        output_options = output_options or {}
+        output_path = writers.output_path(output_dir, "metrics", **output_options)
+        writers.write_records(metrics_df, output_path, **output_options)
         logging.info(f"Metrics saved to {output_path}")
 
 
-def generate_recommendations(output_dir: str):
+def save_recommendations(top_chains: list, output_dir: str, output_options: dict = None):
     """
-    Generates top 2 chain recommendations per drug and saves the result to a JSON file.
+    Saves top chains per drug to `top_chains.json` in the output directory, or the file of
+    the requested output format (see `writers.output_path`).
 
     Parameters:
+        top_chains (list): List of top chains per drug.
         output_dir (str): Directory where the output file will be saved.
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
     """
-    data = data_loader.load_all_data()
-    pharmacies_df = data.get("pharmacies")
-    claims_df = data.get("claims")
-    if claims_df.empty or pharmacies_df.empty:
-        logging.error("Insufficient data to compute recommendations.")
-        return
-    top_chains = recommendations.compute_top_chains(claims_df, pharmacies_df)
+    from hippo import writers
+
     if not top_chains:
         logging.error("Recommendations computation resulted in an empty dataset.")
     else:
         os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "top_chains.json")
-        recommendations.save_top_chains(top_chains, output_path)
+        output_options = output_options or {}
+        output_path = writers.output_path(output_dir, "top_chains", **output_options)
+        writers.write_records(top_chains, output_path, **output_options)
         logging.info(f"Recommendations saved to {output_path}")
 
 
-def generate_common_quantities(output_dir: str):
+def save_common_quantities(common_quantities: list, output_dir: str, output_options: dict = None):
     """
-    Generates the most common prescription quantities per drug and saves the result to a JSON file.
+    Saves the most common quantities per drug to `most_prescribed_quantities.json` in the output
+    directory, or the file of the requested output format (see `writers.output_path`).
 
     Parameters:
+        common_quantities (list): List of prescription quantities per drug.
         output_dir (str): Directory where the output file will be saved.
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
     """
-    data = data_loader.load_all_data()
-    claims_df = data.get("claims")
-    if claims_df.empty:
-        logging.error("No claims data available for common quantities computation.")
-        return
-    common_quantities = quantities.compute_common_quantities(claims_df)
+    from hippo import writers
+
     if not common_quantities:
         logging.error("Common quantities computation resulted in an empty dataset.")
     else:
         os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, "most_prescribed_quantities.json")
-        quantities.save_common_quantities(common_quantities, output_path)
+        output_options = output_options or {}
+        output_path = writers.output_path(output_dir, "most_prescribed_quantities", **output_options)
+        writers.write_records(common_quantities, output_path, **output_options)
         logging.info(f"Common quantities saved to {output_path}")
 
 
+def generate_metrics(output_dir: str, load_options: dict = None, batch_size: int = None, state_dir: str = None, window: dict = None, net: bool = True, sketch: bool = False, output_options: dict = None):
+    """
+    Generates metrics from claims and reverts data and saves the result to a JSON file.
+
+    Parameters:
+        output_dir (str): Directory where the output file will be saved.
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        batch_size (int): If set, claims are streamed in batches of this size instead of loaded whole.
+        state_dir (str): If set, only new input files are processed and merged into the state persisted there.
+        window (dict): If set, time window and granularity of the outputs (see `load_data`); the data
+            is then loaded whole and `batch_size` and `state_dir` are ignored.
+        net (bool): If set, reverted claims are excluded from the outputs; otherwise gross numbers are kept.
+        sketch (bool): If set, the median and 90th percentile unit price of each (npi, ndc) are added
+            (see `sketches`).
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
+    """
+    from hippo import metrics, sketches
+
+    if (batch_size or state_dir) and not window:
+        partials = load_partials(load_options, batch_size, state_dir, sketch)
+        partial = partials["metrics"]
+        if partial.empty:
+            logging.error("No claims data available for metrics computation.")
+            return
+        with instrumentation.stage("metrics", rows_in=len(partial)) as record:
+            if sketch:
+                metrics_df = sketches.finalize_metrics(partial, partials["price_sketch"], net)
+            else:
+                metrics_df = metrics.finalize_metrics(partial, net)
+            record["rows_out"] = len(metrics_df)
+    else:
+        data = load_data(load_options, window)
+        claims_df = data.get("claims")
+        reverts_df = data.get("reverts")
+        if claims_df.empty:
+            logging.error("No claims data available for metrics computation.")
+            return
+        with instrumentation.stage("metrics", rows_in=len(claims_df)) as record:
+            compute = sketches.compute_metrics if sketch else metrics.compute_metrics
+            metrics_df = compute_windowed(compute, claims_df, window, reverts_df, "drop", net)
+            record["rows_out"] = len(metrics_df)
+    save_metrics(metrics_df, output_dir, output_options)
+
+
+def generate_recommendations(output_dir: str, load_options: dict = None, batch_size: int = None, state_dir: str = None, top_k: int = 2, min_fills: int = 1, window: dict = None, net: bool = True, sketch: bool = False, output_options: dict = None):
+    """
+    Generates top chain recommendations per drug and saves the result to a JSON file.
+
+    Parameters:
+        output_dir (str): Directory where the output file will be saved.
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        batch_size (int): If set, claims are streamed in batches of this size instead of loaded whole.
+        state_dir (str): If set, only new input files are processed and merged into the state persisted there.
+        top_k (int): Maximum number of chains per drug.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        window (dict): If set, time window and granularity of the outputs (see `load_data`); the data
+            is then loaded whole and `batch_size` and `state_dir` are ignored.
+        net (bool): If set, reverted claims are excluded from the outputs; otherwise gross numbers are kept.
+        sketch (bool): If set, the median and 90th percentile unit price of each chain are added
+            (see `sketches`).
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
+    """
+    from hippo import recommendations, sketches
+
+    if (batch_size or state_dir) and not window:
+        partials = load_partials(load_options, batch_size, state_dir, sketch)
+        partial = partials["top_chains"]
+        if partial.empty:
+            logging.error("Insufficient data to compute recommendations.")
+            return
+        with instrumentation.stage("recommendations", rows_in=len(partial)) as record:
+            if sketch:
+                top_chains = sketches.finalize_top_chains(partial, partials["chain_price_sketch"], top_k, min_fills, net)
+            else:
+                top_chains = recommendations.finalize_top_chains(partial, top_k, min_fills, net)
+            record["rows_out"] = len(top_chains)
+    else:
+        data = load_data(load_options, window)
+        pharmacies_df = data.get("pharmacies")
+        claims_df = data.get("claims")
+        if claims_df.empty or pharmacies_df.empty:
+            logging.error("Insufficient data to compute recommendations.")
+            return
+        with instrumentation.stage("recommendations", rows_in=len(claims_df)) as record:
+            compute = sketches.compute_top_chains if sketch else recommendations.compute_top_chains
+            top_chains = compute_windowed(compute, claims_df, window, pharmacies_df, top_k, min_fills, None, net)
+            record["rows_out"] = len(top_chains)
+    save_recommendations(top_chains, output_dir, output_options)
+
+
+def generate_common_quantities(output_dir: str, load_options: dict = None, batch_size: int = None, state_dir: str = None, top_n: int = None, window: dict = None, net: bool = True, sketch: bool = False, output_options: dict = None):
+    """
+    Generates the most common prescription quantities per drug and saves the result to a JSON file.
+
+    Parameters:
+        output_dir (str): Directory where the output file will be saved.
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        batch_size (int): If set, claims are streamed in batches of this size instead of loaded whole.
+        state_dir (str): If set, only new input files are processed and merged into the state persisted there.
+        top_n (int): If set, maximum number of quantities listed per drug.
+        window (dict): If set, time window and granularity of the outputs (see `load_data`); the data
+            is then loaded whole and `batch_size` and `state_dir` are ignored.
+        net (bool): If set, reverted claims are excluded from the outputs; otherwise gross numbers are kept.
+        sketch (bool): If set, quantities are counted with a bounded heavy-hitter sketch (see `sketches`).
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
+    """
+    from hippo import quantities, sketches
+
+    if (batch_size or state_dir) and not window:
+        partial = load_partials(load_options, batch_size, state_dir, sketch)["quantity_sketch" if sketch else "quantities"]
+        if partial.empty:
+            logging.error("No claims data available for common quantities computation.")
+            return
+        with instrumentation.stage("quantities", rows_in=len(partial)) as record:
+            common_quantities = quantities.finalize_common_quantities(partial, top_n, net)
+            record["rows_out"] = len(common_quantities)
+    else:
+        data = load_data(load_options, window)
+        claims_df = data.get("claims")
+        if claims_df.empty:
+            logging.error("No claims data available for common quantities computation.")
+            return
+        with instrumentation.stage("quantities", rows_in=len(claims_df)) as record:
+            compute = sketches.compute_common_quantities if sketch else quantities.compute_common_quantities
+            common_quantities = compute_windowed(compute, claims_df, window, top_n, None, net)
+            record["rows_out"] = len(common_quantities)
+    save_common_quantities(common_quantities, output_dir, output_options)
+
+
+def run_pipeline(output_dir: str, load_options: dict = None, batch_size: int = None, state_dir: str = None, exchange_dir: str = None, top_k: int = 2, min_fills: int = 1, top_n: int = None, window: dict = None, net: bool = True, sketch: bool = False, output_options: dict = None) -> dict:
+    """
+    Loads and validates the data once, then computes and saves metrics, recommendations and
+    common quantities, running the three computations concurrently.
+
+    Parameters:
+        output_dir (str): Directory where the output files will be saved.
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        batch_size (int): If set, claims are streamed in batches of this size instead of loaded whole.
+        state_dir (str): If set, only new input files are processed and merged into the state persisted there.
+        exchange_dir (str): If set, the outputs are computed from the partial aggregates written
+            there by map tasks (see `mapreduce`) instead of from the input files.
+        top_k (int): Maximum number of chains per drug in the recommendations.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be recommended.
+        top_n (int): If set, maximum number of common quantities listed per drug.
+        window (dict): If set, time window and granularity of the outputs (see `load_data`); the data
+            is then loaded whole and `batch_size` and `state_dir` are ignored.
+        net (bool): If set, reverted claims are excluded from the outputs; otherwise gross numbers are kept.
+        sketch (bool): If set, unit price quantiles are added to the metrics and recommendations and
+            quantities are counted with a bounded heavy-hitter sketch (see `sketches`).
+        output_options (dict): Keyword arguments passed to `writers.write_records` (output_format, compress).
+
+    Returns:
+        dict: Wall time in seconds of each stage ('load', 'metrics', 'recommendations', 'quantities', 'save').
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from hippo import metrics, quantities, recommendations, sketches
+
+    timings = {}
+
+    def timed(stage, func, *args, rows_in=None):
+        with instrumentation.stage(stage, rows_in=rows_in) as record:
+            result = func(*args)
+            record["rows_out"] = len(result) if result is not None else None
+        timings[stage] = record["wall_s"]
+        return result
+
+    with instrumentation.stage("load") as load_record:
+        if exchange_dir or ((batch_size or state_dir) and not window):
+            partials = load_partials(load_options, batch_size, state_dir, sketch, exchange_dir)
+            if sketch and "price_sketch" not in partials:
+                logging.warning("The map tasks did not compute sketches. Ignoring --sketch.")
+                sketch = False
+            quantities_partial = partials["quantity_sketch" if sketch else "quantities"]
+            rows_in = {
+                "metrics": len(partials["metrics"]),
+                "recommendations": len(partials["top_chains"]),
+                "quantities": len(quantities_partial),
+            }
+            tasks = {
+                "metrics": (metrics.finalize_metrics, partials["metrics"], net),
+                "recommendations": (recommendations.finalize_top_chains, partials["top_chains"], top_k, min_fills, net),
+                "quantities": (quantities.finalize_common_quantities, quantities_partial, top_n, net),
+            }
+            if sketch:
+                tasks["metrics"] = (sketches.finalize_metrics, partials["metrics"], partials["price_sketch"], net)
+                tasks["recommendations"] = (
+                    sketches.finalize_top_chains, partials["top_chains"], partials["chain_price_sketch"],
+                    top_k, min_fills, net
+                )
+        else:
+            data = load_data(load_options, window)
+            pharmacies_df = data.get("pharmacies")
+            claims_df = data.get("claims")
+            reverts_df = data.get("reverts")
+            if not claims_df.empty:
+                claims_df["unit_price"] = claims_df["price"] / claims_df["quantity"]
+            rows_in = dict.fromkeys(["metrics", "recommendations", "quantities"], len(claims_df))
+            compute_metrics = sketches.compute_metrics if sketch else metrics.compute_metrics
+            compute_top_chains = sketches.compute_top_chains if sketch else recommendations.compute_top_chains
+            compute_quantities = sketches.compute_common_quantities if sketch else quantities.compute_common_quantities
+            tasks = {
+                "metrics": (compute_windowed, compute_metrics, claims_df, window, reverts_df, "drop", net),
+                "recommendations": (
+                    compute_windowed, compute_top_chains, claims_df, window, pharmacies_df, top_k, min_fills, None, net
+                ),
+                "quantities": (compute_windowed, compute_quantities, claims_df, window, top_n, None, net),
+            }
+    timings["load"] = load_record["wall_s"]
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {
+            stage: executor.submit(timed, stage, *task, rows_in=rows_in[stage]) for stage, task in tasks.items()
+        }
+        results = {stage: future.result() for stage, future in futures.items()}
+
+    with instrumentation.stage("save") as save_record:
+        save_metrics(results["metrics"], output_dir, output_options)
+        save_recommendations(results["recommendations"], output_dir, output_options)
+        save_common_quantities(results["quantities"], output_dir, output_options)
+    timings["save"] = save_record["wall_s"]
+
+    logging.info("Stage timings (s): " + ", ".join(f"{stage}={seconds}" for stage, seconds in timings.items()))
+    return timings
+
+
+def positive_int(value: str) -> int:
+    """
+    Parses a count given on the command line, rejecting values below 1.
+
+    Parameters:
+        value (str): Value of the option.
+
+    Returns:
+        int: The count.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not an integer of at least 1.
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {count}")
+    return count
+
+
 def main():
     parser = argparse.ArgumentParser(description="Hippo - Data Processing CLI")
+    parser.add_argument(
+        "--data",
+        type=str,
+        default="data/input",
+        help="Base directory of the input data; each dataset is read from the subdirectory of its name.",
+    )
+    for layout in ["pharmacies", "claims", "reverts"]:
+        parser.add_argument(
+            f"--{layout}",
+            action="append",
+            default=None,
+            metavar="PATH",
+            help=f"Directory (searched recursively) or glob pattern of {layout} files, which may be "
+                 f"gzip- or bz2-compressed. Can be repeated. Overrides --data for {layout}.",
+        )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to read input files.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Directory of the validated-data cache; unchanged input files are not parsed again.",
+    )
+    parser.add_argument(
+        "--encode",
+        action="store_true",
+        help="Dictionary-encode pharmacy, drug and chain ids and pack claim ids to reduce memory and speed up joins.",
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=str,
+        default=None,
+        help="Directory where rejected rows are written as NDJSON, one file per input file.",
+    )
+    parser.add_argument(
+        "--pharmacy-only",
+        action="store_true",
+        help="Drop claims of pharmacies missing from the pharmacy dataset, and their reverts, while reading.",
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=DEDUP_KEEP,
+        default=None,
+        help="Count claims with the same id once, keeping the first one in shard order or the one with the latest timestamp.",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="pretty",
+        help="Format of the output files: indented JSON, compact JSON or one JSON record per line (.ndjson).",
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Gzip-compress the output files ('.gz' is appended to their names).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile each stage with cProfile; stats are written to the 'profiles' folder of the output directory.",
+    )
+    parser.add_argument(
+        "--gross",
+        action="store_true",
+        help="Keep reverted claims in fills, prices, chain averages and quantity counts.",
+    )
+    parser.add_argument(
+        "--sketch",
+        action="store_true",
+        help="Add median and 90th percentile unit prices to metrics and recommendations, and count "
+             "quantities with a bounded heavy-hitter sketch.",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=str,
+        default=None,
+        help="Directory of the date-partitioned claims and reverts, written by the 'partition' command.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Stream claims in batches of this many records instead of loading them whole.",
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        default=None,
+        help="Directory of the incremental state; only input files not seen before are processed.",
+    )
     subparsers = parser.add_subparsers(dest="command", required=True)
 
+    parser_run = subparsers.add_parser(
+        "run",
+        aliases=["all"],
+        help="Load the data once and generate metrics, recommendations and common quantities.",
+    )
+    parser_run.add_argument(
+        "--output",
+        type=str,
+        default="data/output",
+        help="Output directory for all output files.",
+    )
+    parser_run.add_argument(
+        "--top-k",
+        type=positive_int,
+        default=2,
+        help="Maximum number of chains recommended per drug.",
+    )
+    parser_run.add_argument(
+        "--min-fills",
+        type=int,
+        default=1,
+        help="Minimum number of claims of a drug a chain needs to be recommended.",
+    )
+    parser_run.add_argument(
+        "--top-n",
+        type=positive_int,
+        default=None,
+        help="Maximum number of quantities listed per drug.",
+    )
+
     parser_validate = subparsers.add_parser(
         "validate", help="Validate input data files."
     )
 
+    parser_partition = subparsers.add_parser(
+        "partition", help="Write validated claims and reverts to date-partitioned storage."
+    )
+
     parser_metrics = subparsers.add_parser(
         "metrics", help="Generate metrics from data."
     )
@@ -111,7 +627,7 @@ def main():
     )
 
     parser_recommend = subparsers.add_parser(
-        "recommend", help="Generate top 2 chain recommendations per drug."
+        "recommend", help="Generate top chain recommendations per drug (2 by default)."
     )
     parser_recommend.add_argument(
         "--output",
@@ -119,6 +635,18 @@ def main():
         default="data/output",
         help="Output directory for recommendations.",
     )
+    parser_recommend.add_argument(
+        "--top-k",
+        type=positive_int,
+        default=2,
+        help="Maximum number of chains recommended per drug.",
+    )
+    parser_recommend.add_argument(
+        "--min-fills",
+        type=int,
+        default=1,
+        help="Minimum number of claims of a drug a chain needs to be recommended.",
+    )
 
     parser_common = subparsers.add_parser(
         "common", help="Generate most common prescription quantities per drug."
@@ -129,6 +657,127 @@ def main():
         default="data/output",
         help="Output directory for common quantities.",
     )
+    parser_common.add_argument(
+        "--top-n",
+        type=positive_int,
+        default=None,
+        help="Maximum number of quantities listed per drug.",
+    )
+
+    parser_serve = subparsers.add_parser(
+        "serve", help="Answer recommendation, metrics and quantity queries over HTTP from in-memory aggregates."
+    )
+    parser_serve.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address to listen on.",
+    )
+    parser_serve.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="Port to listen on.",
+    )
+    parser_serve.add_argument(
+        "--top-k",
+        type=positive_int,
+        default=2,
+        help="Number of chains returned when a query does not give k.",
+    )
+    parser_serve.add_argument(
+        "--min-fills",
+        type=int,
+        default=1,
+        help="Minimum number of claims of a drug a chain needs to be recommended.",
+    )
+    parser_serve.add_argument(
+        "--reload-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between checks for new or changed input files; 0 disables hot reload.",
+    )
+
+    parser_map = subparsers.add_parser(
+        "map", help="Aggregate a subset of the claims shards into partial aggregates per hash partition of ndc."
+    )
+    parser_map.add_argument(
+        "--task",
+        type=int,
+        default=0,
+        help="Index of this map task, from 0; the task reads every --tasks-th claims shard starting at this one.",
+    )
+    parser_reduce = subparsers.add_parser(
+        "reduce", help="Merge the partial aggregates written by map tasks and generate all three outputs."
+    )
+    parser_mapreduce = subparsers.add_parser(
+        "mapreduce", help="Run the map tasks in local processes, then the reduce."
+    )
+    for subparser in [parser_map, parser_mapreduce]:
+        subparser.add_argument(
+            "--tasks",
+            type=int,
+            default=4,
+            help="Number of map tasks sharing the claims shards.",
+        )
+        subparser.add_argument(
+            "--hash-partitions",
+            type=int,
+            default=16,
+            help="Number of hash partitions of ndc the partial aggregates are split into.",
+        )
+    for subparser in [parser_map, parser_reduce, parser_mapreduce]:
+        subparser.add_argument(
+            "--exchange",
+            type=str,
+            default="data/exchange",
+            help="Directory where map tasks write partial aggregates and the reduce reads them.",
+        )
+    for subparser in [parser_reduce, parser_mapreduce]:
+        subparser.add_argument(
+            "--output",
+            type=str,
+            default="data/output",
+            help="Output directory for all output files.",
+        )
+        subparser.add_argument(
+            "--top-k",
+            type=positive_int,
+            default=2,
+            help="Maximum number of chains recommended per drug.",
+        )
+        subparser.add_argument(
+            "--min-fills",
+            type=int,
+            default=1,
+            help="Minimum number of claims of a drug a chain needs to be recommended.",
+        )
+        subparser.add_argument(
+            "--top-n",
+            type=positive_int,
+            default=None,
+            help="Maximum number of quantities listed per drug.",
+        )
+
+    for subparser in [parser_run, parser_metrics, parser_recommend, parser_common]:
+        subparser.add_argument(
+            "--since",
+            type=str,
+            default=None,
+            help="Only include claims from this date or timestamp on (e.g. 2024-01-01).",
+        )
+        subparser.add_argument(
+            "--until",
+            type=str,
+            default=None,
+            help="Only include claims before this date or timestamp (exclusive).",
+        )
+        subparser.add_argument(
+            "--granularity",
+            choices=GRANULARITIES,
+            default=None,
+            help="Compute the outputs per day, week or month.",
+        )
 
     args = parser.parse_args()
 
@@ -136,20 +785,107 @@ def main():
         level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
     )
 
+    load_options = {
+        "workers": args.workers,
+        "cache_dir": args.cache,
+        "encode": args.encode,
+        "quarantine_dir": args.quarantine,
+        "pharmacy_only": args.pharmacy_only,
+        "deduplicate": args.dedup,
+        "data_path": {
+            layout: getattr(args, layout) or os.path.join(args.data, layout)
+            for layout in ["pharmacies", "claims", "reverts"]
+        }
+    }
+    output_options = {"output_format": args.output_format, "compress": args.gzip}
+    instrumentation.reset(profile=args.profile)
+
+    window = None
+    if any(getattr(args, option, None) for option in ["since", "until", "granularity"]) or args.partitions:
+        window = {
+            "since": getattr(args, "since", None),
+            "until": getattr(args, "until", None),
+            "granularity": getattr(args, "granularity", None),
+            "partition_dir": args.partitions,
+        }
+        if args.command in ("map", "reduce", "mapreduce"):
+            logging.warning("Map/reduce runs aggregate all claims; ignoring --partitions.")
+            window = None
+        elif args.command != "partition" and (args.batch_size or args.state):
+            logging.warning("Time windows and partitions load the data whole; ignoring --batch-size and --state.")
+
+    # Options shared by every command that computes outputs
+    compute_options = {"window": window, "net": not args.gross, "sketch": args.sketch, "output_options": output_options}
+
     if args.command == "validate":
-        valid = validate_data()
+        valid = validate_data(load_options)
         if valid:
             logging.info("Data validation completed successfully.")
         else:
             logging.error("Data validation encountered issues.")
+    elif args.command == "partition":
+        from hippo import data_loader, partitions
+
+        data = data_loader.load_all_data(**{**load_options, "encode": False})
+        partitions.write_partitions(data["claims"], data["reverts"], args.partitions or partitions.DEFAULT_PARTITION_DIR)
+    elif args.command in ("run", "all"):
+        run_pipeline(
+            args.output, load_options=load_options, batch_size=args.batch_size, state_dir=args.state,
+            top_k=args.top_k, min_fills=args.min_fills, top_n=args.top_n, **compute_options
+        )
     elif args.command == "metrics":
-        generate_metrics(args.output)
+        generate_metrics(
+            args.output, load_options=load_options, batch_size=args.batch_size, state_dir=args.state, **compute_options
+        )
     elif args.command == "recommend":
-        generate_recommendations(args.output)
+        generate_recommendations(
+            args.output, load_options=load_options, batch_size=args.batch_size, state_dir=args.state,
+            top_k=args.top_k, min_fills=args.min_fills, **compute_options
+        )
     elif args.command == "common":
-        generate_common_quantities(args.output)
+        generate_common_quantities(
+            args.output, load_options=load_options, batch_size=args.batch_size, state_dir=args.state,
+            top_n=args.top_n, **compute_options
+        )
+    elif args.command in ("map", "mapreduce"):
+        from hippo import mapreduce
+
+        map_options = {
+            "exchange_dir": args.exchange,
+            "hash_partitions": args.hash_partitions,
+            "data_path": load_options["data_path"],
+            "cache_dir": args.cache,
+            "quarantine_dir": args.quarantine,
+            "pharmacy_only": args.pharmacy_only,
+            "deduplicate": args.dedup,
+            "sketch": args.sketch,
+        }
+        if args.command == "map":
+            mapreduce.map_task(args.task, args.tasks, workers=args.workers, **map_options)
+        else:
+            mapreduce.run_local(args.tasks, workers=args.workers, **map_options)
+            run_pipeline(
+                args.output, load_options=load_options, exchange_dir=args.exchange,
+                top_k=args.top_k, min_fills=args.min_fills, top_n=args.top_n, **compute_options
+            )
+    elif args.command == "reduce":
+        run_pipeline(
+            args.output, load_options=load_options, exchange_dir=args.exchange,
+            top_k=args.top_k, min_fills=args.min_fills, top_n=args.top_n, **compute_options
+        )
+    elif args.command == "serve":
+        from hippo import service
+
+        service.serve(
+            load_options, state_dir=args.state, host=args.host, port=args.port, top_k=args.top_k,
+            min_fills=args.min_fills, net=not args.gross, reload_interval=args.reload_interval
+        )
     else:
         parser.print_help()
+        return
+
+    if args.command not in ("validate", "partition", "serve", "map"):
+        instrumentation.write_report(args.output, args.command)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+# Option values shared by the CLI and the modules that implement them. This module has no
+# dependencies, so the CLI can build its argument parser without importing pandas or NumPy.
+
+# Which occurrence of a duplicated claim is kept, see `dedup.drop_duplicates`
+DEDUP_KEEP = ("first", "latest")
+
+# Output file formats, see `writers.write_records`
+OUTPUT_FORMATS = ("pretty", "compact", "ndjson")
+
+# Periods of rollups, see `partitions.periods`
+GRANULARITIES = ("day", "week", "month")
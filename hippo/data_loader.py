@@ -1,13 +1,32 @@
+import bz2
 import glob
+import gzip
+import json
+import numpy as np
 import pandas as pd
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 
-FILE_FORMATS = {
-    "json": pd.read_json,
-    "csv": pd.read_csv
+from hippo import cache, dedup, instrumentation, validation
+
+DEFAULT_DATA_PATH = "data/input/{layout}"
+
+# Openers of compressed input files, by extension
+COMPRESSIONS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open
 }
 
+# Number of threads listing input directories
+LISTING_THREADS = 8
+
+# Files smaller than SMALL_FILE_BYTES are parsed and validated together, in batches of at most
+# SMALL_BATCH_BYTES, so thousands of tiny shards do not pay the per-DataFrame overhead each
+SMALL_FILE_BYTES = 64 << 10
+SMALL_BATCH_BYTES = 16 << 20
+
 SCHEMAS = {
     "pharmacies": {
         "chain": "string",
@@ -28,77 +47,731 @@ SCHEMAS = {
     }
 }
 
-def load_data(layout: str, file_format: str, data_path: str = "data/input/{layout}") -> pd.DataFrame:
+def open_file(path: str):
     """
-    Loads and validates data for the given layout ('pharmacies', 'claims', or 'reverts').
+    Opens an input file as text, decompressing it if its name ends with a known compression
+    extension (see `COMPRESSIONS`).
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        file: Text file object.
+    """
+    opener = COMPRESSIONS.get(os.path.splitext(path)[1], open)
+    return opener(path, "rt", encoding="utf-8")
+
+def read_json(source, layout: str) -> pd.DataFrame:
+    """
+    Reads a JSON array of records without type inference.
+
+    Values keep the types of the JSON document: strings stay strings (so identifiers keep their
+    leading zeros) and numbers are read as numbers, so `validate_frame` only needs to convert the
+    columns that do not already have their schema type.
 
     Parameters:
+        source (str | file): Path to the file or file object.
         layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
-        file_format (str): File format ('json' or 'csv').
-        data_path (str): Base path to the data folder.
+
+    Returns:
+        pd.DataFrame: Raw data.
+
+    Raises:
+        ValueError: If the document is not valid JSON or not an array of records.
+    """
+    if isinstance(source, str):
+        with open_file(source) as f:
+            records = json.load(f)
+    else:
+        records = json.load(source)
+    if not isinstance(records, list):
+        raise ValueError("Expected a JSON array of records.")
+    return records_frame(records, layout)
+
+def records_frame(records: list, layout: str) -> pd.DataFrame:
+    """
+    Builds a raw DataFrame from decoded JSON records, keeping the types of the JSON values.
+
+    Parameters:
+        records (list): Decoded records (dictionaries).
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+
+    Returns:
+        pd.DataFrame: Raw data, with the columns of the layout if there are no records.
+    """
+    return pd.DataFrame.from_records(records) if records else pd.DataFrame(columns=list(SCHEMAS[layout]))
+
+def read_csv(source, layout: str) -> pd.DataFrame:
+    """
+    Reads a CSV file, with the string columns of the layout read as strings rather than inferred.
+
+    Parameters:
+        source (str | file): Path to the file or file object.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+
+    Returns:
+        pd.DataFrame: Raw data.
+    """
+    dtypes = {col: str for col, col_type in SCHEMAS[layout].items() if col_type == "string"}
+    return pd.read_csv(source, dtype=dtypes)
+
+FILE_FORMATS = {
+    "json": read_json,
+    "csv": read_csv
+}
+
+def coerce_column(values: pd.Series, col_type: str) -> pd.Series:
+    """
+    Converts a raw column to its schema type; values that cannot be converted become null.
+
+    Columns that were read with their schema type are returned as they are. Timestamps are
+    parsed as ISO 8601.
+
+    Parameters:
+        values (pd.Series): Raw column.
+        col_type (str): Schema type ('string', 'float', 'int' or 'datetime').
+
+    Returns:
+        pd.Series: Converted column.
+    """
+    if col_type == "datetime":
+        if pd.api.types.is_datetime64_dtype(values.dtype):
+            return values
+        return pd.to_datetime(values, format="ISO8601", errors="coerce")
+    if col_type in ["float", "int"]:
+        if pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            return values
+        return pd.to_numeric(values, errors="coerce")
+    if isinstance(values.dtype, pd.StringDtype):
+        return values
+    return values.astype("string")
+
+# Low-cardinality key columns, stored as categoricals sharing one dictionary per column
+KEY_COLUMNS = ["npi", "ndc", "chain"]
+
+# Id columns, stored as packed fixed-size keys (see `dedup.pack_ids`), so a revert's claim_id
+# equals its claim's id
+UUID_COLUMNS = {
+    "claims": ["id"],
+    "reverts": ["id", "claim_id"]
+}
+
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+_HEX_VALUES[np.frombuffer(b"0123456789abcdef", dtype=np.uint8)] = np.arange(16)
+_HEX_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+_UUID_HEX_POSITIONS = [i for i in range(36) if i not in (8, 13, 18, 23)]
+
+def parse_uuids(values) -> tuple:
+    """
+    Packs the canonical UUID strings (xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx) of an array into
+    128-bit integers, flagging the values that are not canonical UUIDs.
+
+    Parameters:
+        values: Array-like of strings.
+
+    Returns:
+        tuple: `(packed, valid)`; `packed` is an array of shape (n, 2) with the high and low 64
+            bits of each UUID, and `valid` a boolean mask of the values that are canonical UUIDs.
+            Rows of `packed` for other values are meaningless.
+    """
+    raw = np.asarray(values, dtype=str)
+    valid = np.char.str_len(raw) == 36
+    # Code points, so that values with non-ASCII characters are flagged rather than rejected
+    chars = np.ascontiguousarray(raw.astype("U36")).view(np.uint32).reshape(-1, 36)
+    chars = np.minimum(chars, 255)
+    nibbles = _HEX_VALUES[chars[:, _UUID_HEX_POSITIONS]]
+    valid &= (nibbles != 255).all(axis=1) & (chars[:, [8, 13, 18, 23]] == ord("-")).all(axis=1)
+    nibbles = nibbles.astype(np.uint8)
+    packed = np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+    return packed.view(">u8").astype(np.uint64), valid
+
+def validate_frame(df: pd.DataFrame, layout: str, source: str, quarantine_dir: str = None, sources: list = None) -> pd.DataFrame:
+    """
+    Coerces a raw DataFrame to the schema of the given layout and drops invalid rows.
+
+    Rejected rows are summarized in the log (see `validation.report`) and, with a
+    `quarantine_dir`, written there in bulk, once per file they came from.
+
+    Parameters:
+        df (pd.DataFrame): Raw data as read from a file.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        source (str): Name of the file the data came from, used in log messages.
+        quarantine_dir (str): Directory where rejected rows are written.
+        sources (list): If the rows were concatenated from several files, `(name, first_index)`
+            of each file in index order; the rows of a file are those from its `first_index` up
+            to the next file's.
 
     Returns:
         pd.DataFrame: DataFrame with only the columns defined in the schema; invalid rows are removed.
     """
-    path = os.path.join(data_path.format(layout=layout), f'*.{file_format}')
-    dataframes = []
+    for col in SCHEMAS[layout].keys():
+        if col not in df.columns:
+            logging.warning(f"Column '{col}' missing in file {source}. Creating column with NA values.")
+            df[col] = pd.NA
+
+    with instrumentation.stage("coerce", layout=layout, file=source, rows_in=len(df)) as record:
+        coerced = pd.DataFrame(
+            {col: coerce_column(df[col], col_type) for col, col_type in SCHEMAS[layout].items()},
+            index=df.index
+        )
+
+        rejections = validation.find_rejections(df, coerced, SCHEMAS[layout])
+        invalid_mask = rejections.any(axis=1)
+        record["rows_out"] = int((~invalid_mask).sum())
+    if invalid_mask.any():
+        rejected = df.loc[invalid_mask, list(SCHEMAS[layout].keys())]
+        rejections = rejections[invalid_mask]
+        if sources is None:
+            validation.report(rejected, rejections, layout, source, quarantine_dir)
+        else:
+            names = [name for name, _ in sources]
+            bounds = np.searchsorted(rejected.index.to_numpy(), [start for _, start in sources] + [np.inf])
+            for name, start, end in zip(names, bounds[:-1], bounds[1:]):
+                if end > start:
+                    validation.report(rejected.iloc[start:end], rejections.iloc[start:end], layout, name, quarantine_dir)
+
+    return coerced[~invalid_mask]
+
+def filter_rows(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """
+    Keeps only the raw rows whose values are in the allowed values of each filtered column.
+
+    Values are compared as strings, the same way `validate_frame` coerces string columns, so
+    raw rows can be filtered before they are coerced and validated.
+
+    Parameters:
+        df (pd.DataFrame): Raw data as read from a file.
+        filters (dict): Allowed values per column, e.g. `{"npi": {...}}`.
+
+    Returns:
+        pd.DataFrame: The rows of `df` that pass every filter.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for col, values in filters.items():
+        if col not in df.columns:
+            return df.iloc[0:0]
+        mask &= df[col].astype("string").isin(values).to_numpy(dtype=bool, na_value=False)
+    return df[mask]
+
+def load_file(item: str, layout: str, file_format: str, cache_dir: str = None, quarantine_dir: str = None, filters: dict = None) -> tuple:
+    """
+    Reads, coerces and validates a single file.
+
+    This is the unit of work handed to each ingestion worker, so it only depends on its arguments.
+    With a `cache_dir`, files whose content was already validated are read from the cache instead.
+
+    Parameters:
+        item (str): Path to the file.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        file_format (str): File format ('json' or 'csv').
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        filters (dict): If set, only rows passing these filters are coerced and validated (see `filter_rows`).
+
+    Returns:
+        tuple: `(df_valid, total_rows)`; `df_valid` is `None` if the file could not be read.
+    """
+    with instrumentation.stage("load_file", layout=layout, file=item, bytes_read=os.path.getsize(item)) as record:
+        df_valid, total_rows = _read_file(item, layout, file_format, cache_dir, quarantine_dir, filters, record)
+        record["rows_in"] = total_rows
+        record["rows_out"] = 0 if df_valid is None else len(df_valid)
+    return df_valid, total_rows
+
+def _read_file(item: str, layout: str, file_format: str, cache_dir: str, quarantine_dir: str, filters: dict, record: dict) -> tuple:
+    if cache_dir:
+        digest = cache.content_key(item, cache_dir)
+        df_valid, total_rows = cache.read_entry(layout, digest, cache_dir)
+        if df_valid is not None:
+            logging.info(f"Reading file from cache: {item}")
+            record["cached"] = True
+            return df_valid, total_rows
+
+    logging.info(f"Reading file: {item}")
+    try:
+        df = FILE_FORMATS[file_format](item, layout)
+    except Exception as e:
+        logging.error(f"Error reading file {item}: {e}")
+        return None, 0
+
+    if filters:
+        df_kept = filter_rows(df, filters)
+        record["rows_filtered"] = len(df) - len(df_kept)
+        df_valid = validate_frame(df_kept, layout, item, quarantine_dir)
+    else:
+        df_valid = validate_frame(df, layout, item, quarantine_dir)
+    if cache_dir:
+        cache.write_entry(df_valid, len(df), layout, digest, cache_dir)
+    return df_valid, len(df)
+
+def load_batch(items: list, layout: str, file_format: str, cache_dir: str = None, quarantine_dir: str = None, filters: dict = None) -> tuple:
+    """
+    Reads several small files, then coerces and validates their rows in a single call.
+
+    Rows keep the order of the files. Files that cannot be read are logged and skipped. With a
+    `cache_dir`, cached files are read from the cache and the others are cached one by one, as
+    with `load_file`. Valid and total rows are logged for each file, and rejected rows are
+    reported and quarantined under the name of the file they came from.
+
+    Parameters:
+        items (list): Paths to the files.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        file_format (str): File format ('json' or 'csv').
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        filters (dict): If set, only rows passing these filters are coerced and validated (see `filter_rows`).
+
+    Returns:
+        tuple: `(df_valid, total_rows, unreadable)`; `df_valid` is `None` if no file could be read.
+    """
+    source = f"{items[0]}+{len(items) - 1}"
+    bytes_read = sum(os.path.getsize(item) for item in items)
+    with instrumentation.stage("load_batch", layout=layout, file=source, files=len(items), bytes_read=bytes_read) as record:
+        pieces = [None] * len(items)
+        total_rows = unreadable = 0
+        parsed, raw_frames, digests = [], [], {}
+        for i, item in enumerate(items):
+            if cache_dir:
+                digests[i] = cache.content_key(item, cache_dir)
+                df_valid, rows = cache.read_entry(layout, digests[i], cache_dir)
+                if df_valid is not None:
+                    logging.info(f"File {item} read from cache: {len(df_valid)} valid rows out of {rows}.")
+                    pieces[i] = df_valid
+                    total_rows += rows
+                    continue
+            try:
+                raw_frames.append(FILE_FORMATS[file_format](item, layout))
+            except Exception as e:
+                logging.error(f"Error reading file {item}: {e}")
+                unreadable += 1
+                continue
+            parsed.append(i)
+
+        if parsed:
+            lengths = [len(df) for df in raw_frames]
+            starts = np.cumsum([0] + lengths)
+            df = pd.concat(raw_frames, ignore_index=True)
+            total_rows += len(df)
+            if filters:
+                df_kept = filter_rows(df, filters)
+                record["rows_filtered"] = len(df) - len(df_kept)
+                df = df_kept
+            sources = [(items[i], starts[j]) for j, i in enumerate(parsed)]
+            df_valid = validate_frame(df, layout, source, quarantine_dir, sources)
+            # Validation keeps the row order, so each file's rows are a contiguous slice
+            bounds = np.searchsorted(df_valid.index.to_numpy(), starts)
+            for j, i in enumerate(parsed):
+                pieces[i] = df_valid.iloc[bounds[j]:bounds[j + 1]]
+                logging.info(f"File {items[i]}: {len(pieces[i])} valid rows out of {lengths[j]}.")
+                if cache_dir:
+                    cache.write_entry(pieces[i], lengths[j], layout, digests[i], cache_dir)
+
+        pieces = [piece for piece in pieces if piece is not None]
+        df_valid = pd.concat(pieces, ignore_index=True) if pieces else None
+        record["rows_in"] = total_rows
+        record["rows_out"] = 0 if df_valid is None else len(df_valid)
+        record["files_unreadable"] = unreadable
+    return df_valid, total_rows, unreadable
+
+def encode_frame(df: pd.DataFrame, layout: str) -> pd.DataFrame:
+    """
+    Converts the key columns of a loaded layout to categoricals, each with the categories of its
+    own values, and packs its id columns into 17-byte keys (see `dedup.pack_ids`). Frames encoded
+    separately are combined with `concat_frames` and aligned across layouts with `encode_data`.
+
+    Parameters:
+        df (pd.DataFrame): Validated data.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
 
-    for item in glob.glob(path):
-        logging.info(f"Reading file: {item}")
+    Returns:
+        pd.DataFrame: The data, with encoded columns.
+    """
+    columns = [col for col in KEY_COLUMNS if col in df.columns]
+    encoded = df.astype({col: "category" for col in columns}, copy=False) if columns else df.copy(deep=False)
+    for col in UUID_COLUMNS.get(layout, []):
+        if col in encoded.columns:
+            encoded[col] = pd.Series(dedup.pack_ids(encoded[col]), index=encoded.index)
+    return encoded
+
+def _build_frame(columns: dict, index=None) -> pd.DataFrame:
+    """
+    Builds a DataFrame around existing columns without copying them. Packed id columns are
+    inserted one by one, since the DataFrame constructor would convert them to Python objects.
+    """
+    df = pd.DataFrame(
+        {col: values for col, values in columns.items() if values.dtype != dedup.ID_DTYPE}, index=index, copy=False
+    )
+    for position, (col, values) in enumerate(columns.items()):
+        if values.dtype == dedup.ID_DTYPE:
+            df.insert(position, col, values)
+    return df
+
+def concat_frames(dataframes: list) -> pd.DataFrame:
+    """
+    Concatenates DataFrames with the same columns, combining categorical columns on the union of
+    their categories rather than decoding them back to strings as `pd.concat` does.
+
+    Parameters:
+        dataframes (list): DataFrames to concatenate.
+
+    Returns:
+        pd.DataFrame: The concatenated data.
+    """
+    columns = {}
+    for col in dataframes[0].columns:
+        parts = [df[col] for df in dataframes]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[col] = pd.Series(pd.api.types.union_categoricals(parts), copy=False)
+        else:
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return _build_frame(columns)
+
+def _load_unit(items: list, layout: str, file_format: str, cache_dir: str, quarantine_dir: str, filters: dict, encode: bool, id_partition: tuple) -> tuple:
+    """
+    Loads one unit of work of `load_files`: a single file, or a batch of small files.
+    """
+    if len(items) > 1:
+        df_valid, total_rows, unreadable = load_batch(items, layout, file_format, cache_dir, quarantine_dir, filters)
+    else:
+        df_valid, total_rows = load_file(items[0], layout, file_format, cache_dir, quarantine_dir, filters)
+        unreadable = int(df_valid is None)
+    if id_partition and df_valid is not None and not df_valid.empty:
+        part, parts = id_partition
+        df_valid = df_valid[dedup.key_partition(dedup.pack_ids(df_valid["id"]), parts) == part]
+    if encode and df_valid is not None:
+        df_valid = encode_frame(df_valid, layout)
+    return df_valid, total_rows, unreadable
+
+def stat_sizes(items: list) -> list:
+    """
+    Returns the size in bytes of each file, calling `os.stat` from a pool of threads.
+
+    Parameters:
+        items (list): Paths of the files.
+
+    Returns:
+        list: Size of each file; files that cannot be stat'ed have size 0.
+    """
+    def size(item):
         try:
-            df = FILE_FORMATS[file_format](item)
-        except Exception as e:
-            logging.error(f"Error reading file {item}: {e}")
+            return os.stat(item).st_size
+        except OSError:
+            return 0
+
+    if len(items) < LISTING_THREADS:
+        return [size(item) for item in items]
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        return list(executor.map(size, items))
+
+def plan_units(items: list, sizes: list) -> list:
+    """
+    Groups files into units of work: empty files are dropped, consecutive small files are batched
+    together (see `SMALL_FILE_BYTES` and `SMALL_BATCH_BYTES`) and other files are read one by one.
+
+    Parameters:
+        items (list): Paths of the files, in load order.
+        sizes (list): Size of each file in bytes.
+
+    Returns:
+        list: Units of work, each a list of paths, in load order.
+    """
+    units, batch, batch_bytes = [], [], 0
+    for item, size in zip(items, sizes):
+        if size == 0:
             continue
+        if size >= SMALL_FILE_BYTES:
+            if batch:
+                units.append(batch)
+                batch, batch_bytes = [], 0
+            units.append([item])
+            continue
+        if batch and batch_bytes + size > SMALL_BATCH_BYTES:
+            units.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        units.append(batch)
+    return units
+
+def layout_sources(data_path, layout: str) -> list:
+    """
+    Returns the directories and glob patterns where the files of a layout are found.
+
+    Parameters:
+        data_path (str | list | dict): A path template or list of templates, in which '{layout}'
+            is replaced by the layout name, or a dict of paths or lists of paths by layout, which
+            are used as they are. Layouts missing from the dict are read from `DEFAULT_DATA_PATH`.
+
+    Returns:
+        list: Directories and glob patterns of the layout.
+    """
+    if isinstance(data_path, dict):
+        if layout in data_path:
+            paths = data_path[layout]
+            return [paths] if isinstance(paths, str) else list(paths)
+        data_path = DEFAULT_DATA_PATH
+    templates = [data_path] if isinstance(data_path, str) else list(data_path)
+    # Only the '{layout}' placeholder is substituted, so other braces in paths are kept as they are
+    return [template.replace("{layout}", layout) for template in templates]
+
+def _scan_dir(path: str) -> tuple:
+    """
+    Lists the files and subdirectories of a directory.
+    """
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+    except OSError as e:
+        logging.error(f"Error listing directory {path}: {e}")
+    return files, subdirs
+
+def _is_input_file(path: str, file_format: str) -> bool:
+    name = os.path.basename(path)
+    root, ext = os.path.splitext(name)
+    if ext in COMPRESSIONS:
+        name = root
+    return name.endswith(f".{file_format}")
+
+def list_files(layout: str, file_format: str, data_path=DEFAULT_DATA_PATH) -> list:
+    """
+    Lists the input files of the given layout in a deterministic order.
+
+    Each source is either a directory, searched recursively, or a glob pattern (`**` matches
+    any number of subdirectories); directories matched by a pattern are searched too. Files
+    named `*.<file_format>`, optionally followed by a compression extension (`.gz`, `.bz2`),
+    are listed. Directories are listed by a pool of threads, level by level, so trees with many
+    subdirectories are not walked one directory at a time.
+
+    Parameters:
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        file_format (str): File format ('json' or 'csv').
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `layout_sources`).
+
+    Returns:
+        list: Sorted list of file paths, without duplicates.
+    """
+    files, dirs = set(), []
+    for source in layout_sources(data_path, layout):
+        if any(char in source for char in "*?["):
+            matches = glob.glob(source, recursive=True)
+        else:
+            matches = [source] if os.path.exists(source) else []
+        if not matches:
+            logging.warning(f"No {layout} files found at {source}.")
+        for match in matches:
+            if os.path.isdir(match):
+                dirs.append(match)
+            elif os.path.isfile(match):
+                files.add(os.path.normpath(match))
+
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        while dirs:
+            subdirs = []
+            for dir_files, dir_subdirs in executor.map(_scan_dir, dirs):
+                files.update(os.path.normpath(path) for path in dir_files)
+                subdirs.extend(dir_subdirs)
+            dirs = subdirs
 
-        for col in SCHEMAS[layout].keys():
-            if col not in df.columns:
-                logging.warning(f"Column '{col}' missing in file {item}. Creating column with NA values.")
-                df[col] = pd.NA
-
-        for col, col_type in SCHEMAS[layout].items():
-            if col_type == "datetime":
-                df[col] = pd.to_datetime(df[col], errors='coerce')
-            elif col_type in ["float", "int"]:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            elif col_type == "string":
-                df[col] = df[col].astype("string")
-
-        df = df[list(SCHEMAS[layout].keys())]
-
-        required_cols = list(SCHEMAS[layout].keys())
-        invalid_mask = df[required_cols].isna().any(axis=1)
-        invalid_count = invalid_mask.sum()
-        if invalid_count > 0:
-            logging.warning(f"{invalid_count} ROW(S) WITH ISSUES in file {item}")
-            for idx, row in df[invalid_mask].iterrows():
-                logging.warning("==========================================")
-                logging.warning(f"PROBLEMATIC ROW - Index: {idx}")
-                logging.warning(row.to_dict())
-                logging.warning("==========================================")
-
-        df_valid = df.dropna(subset=required_cols)
-        logging.info(f"File {item}: {len(df_valid)} valid rows out of {len(df)}.")
+    return sorted(path for path in files if _is_input_file(path, file_format))
+
+def load_files(items: list, layout: str, file_format: str, workers: int = 1, cache_dir: str = None, quarantine_dir: str = None, filters: dict = None, encode: bool = False, id_partition: tuple = None) -> pd.DataFrame:
+    """
+    Loads and validates the given files of a layout and concatenates them.
+
+    Files are stat'ed first: empty files are skipped without being opened and small files are
+    read in batches (see `plan_units`); the counts are logged in one summary line per layout and
+    recorded in the `scan_files` stage. With `workers` greater than 1, files and batches are
+    parsed, coerced and validated in a process pool and the parent only concatenates the results.
+
+    Parameters:
+        items (list): Paths of the files to read.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        file_format (str): File format ('json' or 'csv').
+        workers (int): Number of worker processes used to read files.
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        filters (dict): If set, only rows passing these filters are kept (see `filter_rows`). Rows
+            are filtered in the workers, before coercion.
+        encode (bool): If set, key and id columns are encoded as each file or batch is
+            loaded (see `encode_frame`), so the full string columns are never materialized.
+        id_partition (tuple): If set, `(part, parts)`: only rows whose id falls in hash partition
+            `part` of `parts` are kept (see `dedup.key_partition`). Rows are selected in the
+            workers, once validated, so the cache still holds whole files.
+
+    Returns:
+        pd.DataFrame: DataFrame with only the columns defined in the schema; invalid rows are removed.
+    """
+    if cache_dir and filters:
+        # Filtered data is cached apart from the unfiltered data of the same files
+        cache_dir = os.path.join(cache_dir, "filtered", cache.filters_digest(filters))
+
+    with instrumentation.stage("scan_files", layout=layout, files=len(items)) as record:
+        sizes = stat_sizes(items)
+        units = plan_units(items, sizes)
+        batches = [unit for unit in units if len(unit) > 1]
+        record["files_empty"] = sizes.count(0)
+        record["files_batched"] = sum(len(unit) for unit in batches)
+        record["batches"] = len(batches)
+
+    if workers > 1 and len(units) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(units))) as executor:
+            results = instrumentation.map_workers(
+                executor,
+                _load_unit, units, repeat(layout), repeat(file_format), repeat(cache_dir), repeat(quarantine_dir), repeat(filters), repeat(encode), repeat(id_partition)
+            )
+    else:
+        results = [_load_unit(unit, layout, file_format, cache_dir, quarantine_dir, filters, encode, id_partition) for unit in units]
+
+    dataframes = []
+    unreadable = 0
+    for unit, (df_valid, total_rows, unit_unreadable) in zip(units, results):
+        unreadable += unit_unreadable
+        if df_valid is None:
+            continue
+        if len(unit) == 1:
+            # Batches log their counts per file as they are read
+            logging.info(f"File {unit[0]}: {len(df_valid)} valid rows out of {total_rows}.")
         dataframes.append(df_valid)
 
+    logging.info(
+        f"Files for {layout}: {len(items)} found, {record['files_empty']} empty skipped, "
+        f"{record['files_batched']} small read in {record['batches']} batch(es), {unreadable} unreadable."
+    )
+
     if dataframes:
-        final_df = pd.concat(dataframes, ignore_index=True)
-        logging.info(f"Data for {layout} loaded and validated:")
-        logging.info(final_df.head())
+        final_df = concat_frames(dataframes) if encode else pd.concat(dataframes, ignore_index=True)
+        logging.info(f"Data for {layout} loaded and validated: {len(final_df)} rows.")
         return final_df
     else:
         logging.error(f"No valid data found for {layout}.")
         return pd.DataFrame()
 
-def load_all_data() -> dict:
+def load_data(layout: str, file_format: str, data_path=DEFAULT_DATA_PATH, workers: int = 1, cache_dir: str = None, quarantine_dir: str = None, filters: dict = None, encode: bool = False) -> pd.DataFrame:
+    """
+    Loads and validates data for the given layout ('pharmacies', 'claims', or 'reverts').
+
+    Parameters:
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        file_format (str): File format ('json' or 'csv').
+        data_path (str | list | dict): Directories and glob patterns of the input files (see `layout_sources`).
+        workers (int): Number of worker processes used to read files.
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        filters (dict): If set, only rows passing these filters are kept (see `filter_rows`).
+        encode (bool): If set, key and id columns are encoded (see `encode_frame`).
+
+    Returns:
+        pd.DataFrame: DataFrame with only the columns defined in the schema; invalid rows are removed.
+    """
+    with instrumentation.stage("load_data", layout=layout) as record:
+        items = list_files(layout, file_format, data_path)
+        record["files"] = len(items)
+        df = load_files(items, layout, file_format, workers, cache_dir, quarantine_dir, filters, encode)
+        record["rows_out"] = len(df)
+    return df
+
+def _distinct_values(values: pd.Series) -> np.ndarray:
+    """
+    Returns the distinct values of a column, read from its categories if it is encoded.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.categories.to_numpy(dtype=object)
+    return values.dropna().unique().astype(str).astype(object)
+
+def encode_data(data: dict) -> dict:
+    """
+    Encodes the key and id columns of loaded data, with categories shared across layouts.
+
+    Key columns (npi, ndc, chain) become categoricals with the same sorted categories in every
+    layout, so joins and groupbys work on integer codes. Id columns (claim and revert ids) are
+    packed into 17-byte keys (see `dedup.pack_ids`), which only depend on the id, so a revert's
+    claim_id equals the claim's id. Outputs decode categoricals back to strings when they are
+    serialized; ids are not written to any output.
+
+    Columns already encoded while loading (see `encode_frame`) are recoded from their categories
+    without being decoded, and frames are rebuilt around the encoded columns rather than copied.
+
+    Parameters:
+        data (dict): Validated DataFrames keyed by layout, as returned by `load_all_data`.
+
+    Returns:
+        dict: DataFrames keyed by layout, with encoded key and id columns.
+    """
+    encoded = {layout: {} for layout in data}
+    for col in KEY_COLUMNS:
+        columns = [layout for layout, df in data.items() if col in df.columns]
+        if not columns:
+            continue
+        categories = pd.Index(np.concatenate([_distinct_values(data[layout][col]) for layout in columns])).unique()
+        dtype = pd.CategoricalDtype(categories.sort_values())
+        for layout in columns:
+            encoded[layout][col] = data[layout][col].astype(dtype)
+    for layout, cols in UUID_COLUMNS.items():
+        for col in cols:
+            if layout in data and col in data[layout].columns and data[layout][col].dtype != dedup.ID_DTYPE:
+                encoded[layout][col] = pd.Series(dedup.pack_ids(data[layout][col]), index=data[layout].index)
+
+    return {
+        layout: _build_frame({col: encoded[layout].get(col, df[col]) for col in df.columns}, df.index)
+        if encoded[layout] else df
+        for layout, df in data.items()
+    }
+
+def pharmacy_filter(pharmacies_df: pd.DataFrame) -> dict:
+    """
+    Builds the filter that keeps only claims of pharmacies in the pharmacy dataset.
+
+    Parameters:
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+
+    Returns:
+        dict: Filter to pass to `load_data` (see `filter_rows`).
+    """
+    return {"npi": set(pharmacies_df["npi"].dropna()) if not pharmacies_df.empty else set()}
+
+def load_all_data(workers: int = 1, cache_dir: str = None, encode: bool = False, quarantine_dir: str = None, pharmacy_only: bool = False, deduplicate: str = None, data_path=DEFAULT_DATA_PATH) -> dict:
     """
     Loads data for 'pharmacies', 'claims', and 'reverts'.
 
+    Parameters:
+        workers (int): Number of worker processes used to read files of each layout.
+        cache_dir (str): Directory of the validated-data cache.
+        encode (bool): If set, key and id columns are encoded while each file is loaded,
+            then aligned across layouts (see `encode_data`).
+        quarantine_dir (str): Directory where rejected rows are written.
+        pharmacy_only (bool): If set, claims of pharmacies missing from the pharmacy dataset are
+            dropped while reading, before they are coerced, and reverts of those claims are dropped
+            once loaded.
+        deduplicate (str): If set, claims with the same id are counted once, keeping the "first"
+            one in shard order or the "latest" one by timestamp (see `dedup.drop_duplicates`).
+        data_path (str | list | dict): Directories and glob patterns of the input files (see `layout_sources`).
+
     Returns:
         dict: A dictionary with keys 'pharmacies', 'claims', and 'reverts' each containing the corresponding DataFrame.
     """
+    options = {"data_path": data_path, "workers": workers, "cache_dir": cache_dir, "quarantine_dir": quarantine_dir, "encode": encode}
     data = {}
-    data["pharmacies"] = load_data("pharmacies", "csv")
-    data["claims"] = load_data("claims", "json")
-    data["reverts"] = load_data("reverts", "json")
+    data["pharmacies"] = load_data("pharmacies", "csv", **options)
+    claims_filter = pharmacy_filter(data["pharmacies"]) if pharmacy_only else None
+    data["claims"] = load_data("claims", "json", filters=claims_filter, **options)
+    if deduplicate:
+        with instrumentation.stage("dedup", rows_in=len(data["claims"])) as record:
+            data["claims"], _ = dedup.drop_duplicates(data["claims"], deduplicate)
+            record["rows_out"] = len(data["claims"])
+    data["reverts"] = load_data("reverts", "json", **options)
+    if pharmacy_only and not data["reverts"].empty:
+        # Reverts are matched here rather than filtered in the readers, which would have to be sent
+        # every claim id
+        with instrumentation.stage("filter_reverts", rows_in=len(data["reverts"])) as record:
+            claim_ids = data["claims"]["id"] if not data["claims"].empty else []
+            data["reverts"] = data["reverts"][data["reverts"]["claim_id"].isin(claim_ids)].reset_index(drop=True)
+            record["rows_out"] = len(data["reverts"])
+    if encode:
+        data = encode_data(data)
     return data
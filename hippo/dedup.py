@@ -0,0 +1,156 @@
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from hippo import data_loader
+from hippo.constants import DEDUP_KEEP
+
+# Packed ids are 17-byte strings, compared bytewise: a kind byte, which tells canonical UUIDs,
+# packed losslessly, from other ids, packed as a digest, so the two can never collide, then 128
+# big-endian bits. Fixed-size byte strings sort much faster than structured arrays
+ID_DTYPE = np.dtype("S17")
+UUID_KIND = 0
+DIGEST_KIND = 1
+
+# The two newest runs of an id index are merged while the older one is at most this many times
+# larger, so a batch is not inserted into the whole index and each id is merged O(log n) times
+MERGE_RATIO = 2
+
+def empty_index() -> list:
+    """
+    Returns an id index with no ids.
+
+    An id index is a list of sorted runs of `ID_DTYPE` keys with no id in common, newest last.
+    Indexes are never modified in place: `add` returns a new list, so an earlier index can be
+    kept to roll back to.
+    """
+    return []
+
+def pack_ids(ids) -> np.ndarray:
+    """
+    Packs ids into fixed-size keys.
+
+    Canonical UUIDs are packed losslessly with `data_loader.parse_uuids`. Other ids are packed
+    as their 128-bit BLAKE2 digest, which is slower. The key of an id only depends on the id, so
+    it is the same whatever the batch or run it arrives in.
+
+    Parameters:
+        ids (array-like): Ids as strings, or already packed (see `data_loader.encode_frame`).
+
+    Returns:
+        np.ndarray: Array of `ID_DTYPE` keys.
+    """
+    if getattr(ids, "dtype", None) == ID_DTYPE:
+        return np.asarray(ids)
+    ids = np.asarray(ids, dtype=str)
+    packed, valid = data_loader.parse_uuids(ids)
+    keys = np.empty((len(ids), 17), dtype=np.uint8)
+    keys[:, 0] = np.where(valid, UUID_KIND, DIGEST_KIND)
+    keys[:, 1:] = packed.astype(">u8").view(np.uint8).reshape(-1, 16)
+    if not valid.all():
+        digests = b"".join(
+            hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest() for value in ids[~valid]
+        )
+        keys[~valid, 1:] = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 16)
+    return keys.view(ID_DTYPE).ravel()
+
+def key_partition(keys: np.ndarray, partitions: int) -> np.ndarray:
+    """
+    Assigns packed ids to hash partitions.
+
+    The partition only depends on the key, read from its first 64 bits after the kind byte,
+    which are random for UUIDs and digests alike, so every copy of a claim falls in the same
+    partition on any machine.
+
+    Parameters:
+        keys (np.ndarray): Array of `ID_DTYPE` keys.
+        partitions (int): Number of partitions.
+
+    Returns:
+        np.ndarray: Partition of each key, between 0 and `partitions` - 1.
+    """
+    high = np.ascontiguousarray(keys.view(np.uint8).reshape(-1, 17)[:, 1:9]).view(">u8").ravel()
+    return (high % partitions).astype(np.int64)
+
+def contains(index: list, keys: np.ndarray) -> np.ndarray:
+    """
+    Checks which keys are in an id index, with a binary search per key and run.
+
+    Parameters:
+        index (list): Sorted runs of `ID_DTYPE` keys (see `empty_index`).
+        keys (np.ndarray): Keys to look up.
+
+    Returns:
+        np.ndarray: Boolean mask, `True` for keys found in the index.
+    """
+    found = np.zeros(len(keys), dtype=bool)
+    for run in index:
+        if not len(run) or not len(keys):
+            continue
+        positions = np.searchsorted(run, keys)
+        in_run = positions < len(run)
+        in_run[in_run] = run[positions[in_run]] == keys[in_run]
+        found |= in_run
+    return found
+
+def add(index: list, keys: np.ndarray) -> list:
+    """
+    Adds keys that are not in the index yet as a new run, then merges the newest runs (see
+    `MERGE_RATIO`).
+
+    Parameters:
+        index (list): Sorted runs of `ID_DTYPE` keys (see `empty_index`).
+        keys (np.ndarray): Keys to add.
+
+    Returns:
+        list: The new index; `index` itself is left unchanged.
+    """
+    keys = np.unique(keys)
+    keys = keys[~contains(index, keys)]
+    if not len(keys):
+        return index
+    runs = index + [keys]
+    while len(runs) > 1 and len(runs[-2]) <= MERGE_RATIO * len(runs[-1]):
+        # Runs are sorted and disjoint, which a stable sort merges in linear time
+        runs[-2:] = [np.sort(np.concatenate(runs[-2:]), kind="stable")]
+    return runs
+
+def drop_duplicates(claims_df: pd.DataFrame, keep: str = "first", index: list = None) -> tuple:
+    """
+    Drops claims whose id was already seen, in the same data or in a persisted id index.
+
+    Duplicates within `claims_df` are resolved according to `keep`:
+      - "first": the first occurrence in load order (shard order) is kept
+      - "latest": the occurrence with the latest timestamp is kept
+    Claims whose id is in `index` are always dropped, since they were already counted.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        keep (str): Which occurrence of a duplicated claim to keep, "first" or "latest".
+        index (list): Id index of claims seen before, if any (see `empty_index`).
+
+    Returns:
+        tuple: `(claims_df, index)`, the claims without duplicates in their original order and
+            the index updated with their ids.
+    """
+    if keep not in DEDUP_KEEP:
+        raise ValueError(f"Unknown de-duplication policy: {keep}")
+    index = empty_index() if index is None else index
+    if claims_df.empty:
+        return claims_df, index
+
+    keys = pack_ids(claims_df["id"])
+    order = np.arange(len(keys))
+    if keep == "latest":
+        order = np.argsort(-claims_df["timestamp"].to_numpy().astype("int64"), kind="stable")
+    _, first = np.unique(keys[order], return_index=True)
+    kept = np.zeros(len(keys), dtype=bool)
+    kept[order[first]] = True
+    kept &= ~contains(index, keys)
+
+    dropped = len(claims_df) - int(kept.sum())
+    if dropped:
+        logging.info(f"{dropped} duplicate claim(s) dropped.")
+    return claims_df[kept], add(index, keys[kept])
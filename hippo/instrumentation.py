@@ -0,0 +1,191 @@
+import cProfile
+import json
+import logging
+import marshal
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from itertools import repeat
+
+REPORT_FILE = "run_report.json"
+PROFILE_DIR = "profiles"
+
+_records = []
+# cProfile stats of profiled stages, by position of their record in `_records`
+_profiles = {}
+_lock = threading.Lock()
+_local = threading.local()
+_profiling = False
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of the process so far, in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def reset(profile: bool = False):
+    """
+    Clears the recorded stages and sets whether stages are profiled with cProfile.
+
+    Parameters:
+        profile (bool): If set, the outermost stage of each thread is profiled.
+    """
+    global _profiling
+    with _lock:
+        _records.clear()
+        _profiles.clear()
+        _profiling = profile
+
+@contextmanager
+def stage(name: str, **fields):
+    """
+    Records the wall time, CPU time and peak RSS of a pipeline stage.
+
+    The yielded record can be updated by the stage, e.g. with `rows_out`. CPU time is that of the
+    whole process, so it includes concurrent stages; peak RSS is the process high-water mark at
+    the end of the stage.
+
+    Parameters:
+        name (str): Name of the stage.
+        **fields: Additional fields of the record (e.g. layout, file, rows_in, bytes_read).
+
+    Yields:
+        dict: The record of the stage.
+    """
+    record = {"stage": name, **fields}
+    depth = getattr(_local, "depth", 0)
+    profiler = cProfile.Profile() if _profiling and depth == 0 else None
+
+    _local.depth = depth + 1
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler per process
+            logging.warning(f"Stage {name} not profiled: another stage is being profiled.")
+            profiler = None
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+        record["wall_s"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_s"] = round(time.process_time() - cpu_start, 4)
+        record["peak_rss_bytes"] = peak_rss()
+        _local.depth = depth
+        if profiler:
+            profiler.create_stats()
+        with _lock:
+            if profiler:
+                _profiles[len(_records)] = profiler.stats
+            _records.append(record)
+
+def records() -> list:
+    """
+    Returns a copy of the stages recorded since the last `reset`, in completion order.
+    """
+    with _lock:
+        return [dict(record) for record in _records]
+
+def extend(report: dict):
+    """
+    Adds stages recorded elsewhere, e.g. in a worker process, with their profiles.
+
+    Parameters:
+        report (dict): Keys 'records', as returned by `records`, and 'profiles', cProfile stats
+            by position in 'records', as returned by `collect`.
+    """
+    with _lock:
+        offset = len(_records)
+        _records.extend(report["records"])
+        for position, stats in report["profiles"].items():
+            _profiles[offset + position] = stats
+
+def collect(profile: bool, func, *args) -> tuple:
+    """
+    Calls `func` in a worker process and returns its result together with the stages it recorded
+    and their profiles, so the parent can merge them into its own report with `extend`.
+
+    Only the stages of this call are returned and then dropped, so neither the records of earlier
+    calls in the same worker nor those inherited from a forked parent are reported twice.
+
+    Parameters:
+        profile (bool): Whether the parent profiles stages; the outermost stage of the call is
+            then profiled, as a top-level stage of the parent would be.
+        func (callable): Function to call.
+        *args: Arguments of the function.
+
+    Returns:
+        tuple: `(result, report)`, the report as expected by `extend`.
+    """
+    global _profiling
+    _profiling = profile
+    _local.depth = 0
+    with _lock:
+        start = len(_records)
+    result = func(*args)
+    with _lock:
+        report = {
+            "records": [dict(record) for record in _records[start:]],
+            "profiles": {position - start: _profiles.pop(position) for position in sorted(_profiles) if position >= start},
+        }
+        del _records[start:]
+    return result, report
+
+def map_workers(executor, func, *iterables) -> list:
+    """
+    Calls `func` in the worker processes of an executor, as `executor.map` does, and merges the
+    stages recorded by the workers into the report of this process (see `collect`).
+
+    Parameters:
+        executor (concurrent.futures.Executor): Pool of worker processes.
+        func (callable): Function to call.
+        *iterables: Arguments of the calls.
+
+    Returns:
+        list: Results of the calls, in order.
+    """
+    results = []
+    for result, report in executor.map(collect, repeat(_profiling), repeat(func), *iterables):
+        results.append(result)
+        extend(report)
+    return results
+
+def write_report(output_dir: str, command: str = None) -> str:
+    """
+    Writes the recorded stages as a JSON run report in the output directory, and the cProfile
+    stats of profiled stages to its `profiles` subdirectory.
+
+    Parameters:
+        output_dir (str): Directory where the report is written.
+        command (str): Name of the command that was run.
+
+    Returns:
+        str: Path of the report.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with _lock:
+        stages = [dict(record) for record in _records]
+        profiles = dict(_profiles)
+
+    if profiles:
+        os.makedirs(os.path.join(output_dir, PROFILE_DIR), exist_ok=True)
+    for index, stats in profiles.items():
+        path = os.path.join(output_dir, PROFILE_DIR, f"{index:03d}-{stages[index]['stage']}.prof")
+        # Same format as `cProfile.Profile.dump_stats`, readable with `pstats`
+        with open(path, "wb") as f:
+            marshal.dump(stats, f)
+        stages[index]["profile"] = path
+
+    report = {"command": command, "peak_rss_bytes": peak_rss(), "stages": stages}
+    path = os.path.join(output_dir, REPORT_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, default=str)
+    os.replace(path + ".tmp", path)
+    logging.info(f"Run report saved to {path}")
+    return path
@@ -0,0 +1,340 @@
+import glob
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+
+from hippo import data_loader, dedup, instrumentation, metrics, quantities, recommendations, sketches
+
+DEFAULT_EXCHANGE_DIR = "data/exchange"
+DEFAULT_HASH_PARTITIONS = 16
+
+# Key columns of each partial aggregate; results are sorted by them after the reduce
+PARTIAL_KEYS = {
+    "metrics": ["npi", "ndc"],
+    "top_chains": ["ndc", "chain"],
+    "quantities": ["ndc", "quantity"],
+    "price_sketch": ["npi", "ndc", "bucket"],
+    "chain_price_sketch": ["ndc", "chain", "bucket"],
+    "quantity_sketch": ["ndc", "quantity"],
+}
+
+_MANIFEST_FILE = re.compile(r"task=(\d+)\.json$")
+
+def ndc_partition(ndcs: pd.Series, hash_partitions: int) -> pd.Series:
+    """
+    Assigns drugs to hash partitions.
+
+    The hash only depends on the ndc string, so every map task, on any machine, sends the
+    aggregates of a drug to the same partition.
+
+    Parameters:
+        ndcs (pd.Series): Drug identifiers.
+        hash_partitions (int): Number of partitions.
+
+    Returns:
+        pd.Series: Partition of each drug, between 0 and `hash_partitions` - 1.
+    """
+    hashes = pd.util.hash_array(ndcs.astype(str).to_numpy(dtype=object))
+    return pd.Series(hashes % hash_partitions, index=ndcs.index)
+
+def partition_path(exchange_dir: str, partition: int, task: int) -> str:
+    """
+    Returns the path of the partial aggregates of one hash partition written by one map task.
+
+    Parameters:
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        partition (int): Hash partition.
+        task (int): Map task.
+
+    Returns:
+        str: Path of the partition file.
+    """
+    return os.path.join(exchange_dir, f"partition={partition:05d}", f"task={task:05d}.pkl")
+
+def manifest_path(exchange_dir: str, task: int) -> str:
+    """
+    Returns the path of the manifest of a map task, written once all its partitions are.
+
+    Parameters:
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        task (int): Map task.
+
+    Returns:
+        str: Path of the manifest file.
+    """
+    return os.path.join(exchange_dir, "tasks", f"task={task:05d}.json")
+
+def _write_atomic(path: str, write):
+    """
+    Calls `write` on a temporary path and renames it to `path`, so readers never see a partial file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def task_shards(items: list, task: int, tasks: int) -> list:
+    """
+    Returns the shards processed by a map task: every `tasks`-th shard of the sorted listing,
+    starting at the `task`-th.
+
+    Parameters:
+        items (list): Paths of all claims shards.
+        task (int): Map task, between 0 and `tasks` - 1.
+        tasks (int): Number of map tasks.
+
+    Returns:
+        list: Paths of the shards of the task.
+    """
+    if not 0 <= task < tasks:
+        raise ValueError(f"Task {task} is not between 0 and {tasks - 1}")
+    return sorted(items)[task::tasks]
+
+def map_task(task: int = 0, tasks: int = 1, exchange_dir: str = DEFAULT_EXCHANGE_DIR, hash_partitions: int = DEFAULT_HASH_PARTITIONS, data_path=data_loader.DEFAULT_DATA_PATH, workers: int = 1, cache_dir: str = None, quarantine_dir: str = None, pharmacy_only: bool = False, deduplicate: str = None, sketch: bool = False) -> dict:
+    """
+    Map phase: aggregates the claims shards of one task and writes the partial aggregates of each
+    hash partition of ndc to the exchange directory.
+
+    Pharmacies and reverts are small next to the claims and are read whole by every task, so each
+    claim is matched against all reverts as in a single-node run. Partial aggregates are written
+    as `partition=<p>/task=<task>.pkl`, then the task manifest; a task that is run again replaces
+    its files.
+
+    With `deduplicate`, claims are split between tasks by a hash of their id rather than by
+    shard: every task reads all the shards and keeps the claims whose id falls in its partition
+    (see `dedup.key_partition`). Every copy of a claim is then seen by the same task, whose
+    de-duplication gives the same result as a single-node run.
+
+    Parameters:
+        task (int): Map task, between 0 and `tasks` - 1.
+        tasks (int): Number of map tasks sharing the claims shards.
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        hash_partitions (int): Number of hash partitions of ndc; must be the same for all tasks.
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `data_loader.layout_sources`).
+        workers (int): Number of worker processes used to read files.
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        pharmacy_only (bool): If set, claims of pharmacies missing from the pharmacy dataset are
+            dropped before they are coerced.
+        deduplicate (str): If set, claims with the same id are counted once, keeping the "first"
+            one in shard order or the "latest" one by timestamp (see `dedup.drop_duplicates`).
+        sketch (bool): If set, unit price sketches are also written (see `sketches`). Quantity
+            histograms are always exact, so the reduce derives the quantity sketches from them.
+
+    Returns:
+        dict: The task manifest, with the task, number of tasks and hash partitions, the shards
+            read, the number of claims aggregated and the partition files written.
+    """
+    options = {"data_path": data_path, "workers": workers, "cache_dir": cache_dir, "quarantine_dir": quarantine_dir}
+    pharmacies_df = data_loader.load_data("pharmacies", "csv", **options)
+    reverts_df = data_loader.load_data("reverts", "json", **options)
+    if reverts_df.empty:
+        logging.error("No reverts data found.")
+
+    items = data_loader.list_files("claims", "json", data_path)
+    shards = task_shards(items, task, tasks)
+    # Copies of a claim may be in the shards of any task, so with de-duplication tasks split
+    # claims by id instead
+    items, id_partition = (items, (task, tasks)) if deduplicate else (shards, None)
+    logging.info(f"Map task {task} of {tasks}: {len(items)} claims file(s).")
+    claims_filter = data_loader.pharmacy_filter(pharmacies_df) if pharmacy_only else None
+    claims_df = (
+        data_loader.load_files(items, "claims", "json", workers, cache_dir, quarantine_dir, claims_filter, id_partition=id_partition)
+        if items else pd.DataFrame()
+    )
+    if deduplicate and not claims_df.empty:
+        claims_df, _ = dedup.drop_duplicates(claims_df, deduplicate)
+
+    partials = {}
+    with instrumentation.stage("map", task=task, rows_in=len(claims_df)) as record:
+        if not claims_df.empty:
+            claims_df = metrics.flag_reverts(claims_df, reverts_df)
+            claims_df = claims_df.assign(unit_price=claims_df["price"] / claims_df["quantity"])
+            partials["metrics"] = metrics.partial_metrics(claims_df, reverts_df)
+            if not pharmacies_df.empty:
+                partials["top_chains"] = recommendations.partial_top_chains(claims_df, pharmacies_df)
+            partials["quantities"] = quantities.partial_quantities(claims_df)
+            if sketch:
+                partials["price_sketch"] = sketches.partial_price_sketch(claims_df)
+                partials["chain_price_sketch"] = sketches.chain_price_sketch(partials["price_sketch"], pharmacies_df)
+
+        assigned = {
+            name: ndc_partition(partial["ndc"], hash_partitions)
+            for name, partial in partials.items() if not partial.empty
+        }
+        files = {}
+        for partition in range(hash_partitions):
+            frames = {name: partials[name][parts == partition] for name, parts in assigned.items()}
+            frames = {name: frame.reset_index(drop=True) for name, frame in frames.items() if not frame.empty}
+            if not frames:
+                continue
+            path = partition_path(exchange_dir, partition, task)
+            _write_atomic(path, lambda tmp_path: pd.to_pickle(frames, tmp_path))
+            files[partition] = os.path.relpath(path, exchange_dir)
+        record["rows_out"] = sum(len(partial) for partial in partials.values())
+        record["files_written"] = len(files)
+
+    manifest = {
+        "task": task,
+        "tasks": tasks,
+        "hash_partitions": hash_partitions,
+        "sketch": sketch,
+        "deduplicate": deduplicate,
+        "shards": items,
+        "claims": len(claims_df),
+        "files": files,
+    }
+
+    def write_manifest(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+
+    _write_atomic(manifest_path(exchange_dir, task), write_manifest)
+    logging.info(f"Map task {task} of {tasks}: {len(claims_df)} claims written to {len(files)} partition(s).")
+    return manifest
+
+def read_manifests(exchange_dir: str = DEFAULT_EXCHANGE_DIR) -> list:
+    """
+    Reads the manifests of the map tasks and checks that all tasks of the same job finished.
+
+    Parameters:
+        exchange_dir (str): Directory shared by the map and reduce phases.
+
+    Returns:
+        list: Manifests ordered by task.
+
+    Raises:
+        ValueError: If no task finished, tasks are missing, or tasks disagree on the number of
+            tasks, hash partitions, sketches or de-duplication.
+    """
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(exchange_dir, "tasks", "task=*.json"))):
+        if _MANIFEST_FILE.search(path):
+            with open(path, encoding="utf-8") as f:
+                manifests.append(json.load(f))
+    if not manifests:
+        raise ValueError(f"No map task found in {exchange_dir}.")
+
+    layouts = {(m["tasks"], m["hash_partitions"], m.get("sketch", False), m.get("deduplicate")) for m in manifests}
+    if len(layouts) > 1:
+        raise ValueError(f"Map tasks in {exchange_dir} were run with different tasks, partitions, sketch or de-duplication options: {sorted(layouts, key=str)}.")
+    tasks = manifests[0]["tasks"]
+    missing = sorted(set(range(tasks)) - {m["task"] for m in manifests})
+    if missing:
+        raise ValueError(f"Map tasks {missing} of {tasks} have not finished in {exchange_dir}.")
+    return manifests
+
+def reduce_partition(exchange_dir: str, paths: list) -> dict:
+    """
+    Merges the partial aggregates written by the map tasks for one hash partition.
+
+    If the map tasks computed unit price sketches, the heavy-hitter quantity sketch is derived
+    from the merged quantity histogram, as a single-node run would.
+
+    Parameters:
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        paths (list): Partition files of the map tasks, relative to `exchange_dir`.
+
+    Returns:
+        dict: Merged partial aggregates of the partition, by name.
+    """
+    frames = {}
+    for path in paths:
+        for name, frame in pd.read_pickle(os.path.join(exchange_dir, path)).items():
+            frames.setdefault(name, []).append(frame)
+
+    merge = {
+        "metrics": metrics.merge_partial_metrics,
+        "top_chains": recommendations.merge_partial_top_chains,
+        "quantities": quantities.merge_partial_quantities,
+        "price_sketch": sketches.merge_price_sketches,
+        "chain_price_sketch": lambda partials: sketches.merge_price_sketches(partials, ["ndc", "chain"]),
+    }
+    merged = {name: merge[name](partials) for name, partials in frames.items()}
+    if "price_sketch" in merged and "quantities" in merged:
+        merged["quantity_sketch"] = sketches.truncate_quantities(merged["quantities"])
+    return merged
+
+def reduce_partials(exchange_dir: str = DEFAULT_EXCHANGE_DIR, workers: int = 1) -> dict:
+    """
+    Reduce phase: merges the partial aggregates of every hash partition and returns the partial
+    aggregates of the whole job, ready to be passed to the `finalize_*` functions.
+
+    Partitions hold disjoint drugs, so they are merged independently (in a process pool with
+    `workers` greater than 1) and concatenated in key order, as a single-node run would group them.
+
+    Parameters:
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        workers (int): Number of worker processes merging partitions.
+
+    Returns:
+        dict: A dictionary with keys 'metrics', 'top_chains' and 'quantities', and if the map
+            tasks computed sketches, 'price_sketch', 'chain_price_sketch' and 'quantity_sketch'.
+
+    Raises:
+        ValueError: If the manifests of the map tasks are missing or disagree (see `read_manifests`).
+    """
+    manifests = read_manifests(exchange_dir)
+    names = ["metrics", "top_chains", "quantities"]
+    if manifests[0].get("sketch"):
+        names += ["price_sketch", "chain_price_sketch", "quantity_sketch"]
+
+    by_partition = {}
+    for manifest in manifests:
+        for partition, path in manifest["files"].items():
+            by_partition.setdefault(int(partition), []).append(path)
+    partitions = sorted(by_partition)
+
+    with instrumentation.stage("reduce", partitions=len(partitions), tasks=len(manifests)) as record:
+        if workers > 1 and len(partitions) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(partitions))) as executor:
+                results = instrumentation.map_workers(
+                    executor, reduce_partition, repeat(exchange_dir), [by_partition[p] for p in partitions]
+                )
+        else:
+            results = [reduce_partition(exchange_dir, by_partition[p]) for p in partitions]
+
+        partials = {}
+        for name in names:
+            frames = [result[name] for result in results if name in result and not result[name].empty]
+            partials[name] = (
+                pd.concat(frames, ignore_index=True).sort_values(PARTIAL_KEYS[name], ignore_index=True)
+                if frames else pd.DataFrame()
+            )
+        record["rows_out"] = len(partials["metrics"])
+    logging.info(f"Reduced {len(partitions)} partition(s) written by {len(manifests)} map task(s).")
+    return partials
+
+def run_local(tasks: int, exchange_dir: str = DEFAULT_EXCHANGE_DIR, hash_partitions: int = DEFAULT_HASH_PARTITIONS, workers: int = 1, data_path=data_loader.DEFAULT_DATA_PATH, cache_dir: str = None, quarantine_dir: str = None, pharmacy_only: bool = False, deduplicate: str = None, sketch: bool = False) -> list:
+    """
+    Runs the map tasks of a job on this machine, `workers` tasks at a time in separate processes.
+
+    Parameters:
+        tasks (int): Number of map tasks.
+        exchange_dir (str): Directory shared by the map and reduce phases.
+        hash_partitions (int): Number of hash partitions of ndc.
+        workers (int): Number of map tasks run at the same time.
+        data_path (str | list | dict): Directories and glob patterns of the input files.
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        pharmacy_only (bool): If set, claims of pharmacies missing from the pharmacy dataset are dropped.
+        deduplicate (str): If set, claims with the same id are counted once across all tasks.
+        sketch (bool): If set, unit price sketches are also written.
+
+    Returns:
+        list: Manifests of the map tasks, ordered by task.
+    """
+    # Manifests of an earlier job with more tasks would otherwise be merged with this one
+    for path in glob.glob(os.path.join(exchange_dir, "tasks", "task=*.json")):
+        os.remove(path)
+
+    args = (tasks, exchange_dir, hash_partitions, data_path, 1, cache_dir, quarantine_dir, pharmacy_only, deduplicate, sketch)
+    if workers > 1 and tasks > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, tasks)) as executor:
+            return instrumentation.map_workers(executor, map_task, range(tasks), *[repeat(arg) for arg in args])
+    return [map_task(task, *args) for task in range(tasks)]
@@ -1,7 +1,196 @@
+import numpy as np
 import pandas as pd
 import logging
 
-def compute_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame) -> pd.DataFrame:
+REVERT_DUPLICATES = ("drop", "count")
+
+# Price sums are rounded to this many decimals before they are averaged and rounded for output.
+# Partial aggregates merged in a different order (state, streaming and map/reduce runs) differ
+# by a few ulps, which would otherwise flip values that round on a tie, such as 2.115
+SUM_DECIMALS = 9
+
+def revert_index(reverts_df: pd.DataFrame, duplicates: str = "drop") -> pd.Series:
+    """
+    Builds a hashed index from claim id to the number of reverts attributed to that claim.
+
+    Duplicate reverts (several reverts for the same claim, usually the same revert event
+    delivered more than once) are handled according to `duplicates`:
+      - "drop": a claim counts as reverted at most once, since a claim can only be invalidated once
+      - "count": every revert event is counted
+
+    Parameters:
+        reverts_df (pd.DataFrame): Validated reverts data.
+        duplicates (str): Duplicate reverts policy, "drop" or "count".
+
+    Returns:
+        pd.Series: Number of reverts indexed by claim id.
+    """
+    if duplicates not in REVERT_DUPLICATES:
+        raise ValueError(f"Unknown duplicate reverts policy: {duplicates}")
+    if reverts_df.empty:
+        return pd.Series(dtype="int64")
+    claim_ids = reverts_df["claim_id"]
+    if claim_ids.dtype.kind == "S":
+        # Packed ids (see `data_loader.encode_frame`) are indexed as bytes, since a pandas index
+        # cannot hold fixed-size byte strings
+        claim_ids = claim_ids.astype(object)
+    if duplicates == "drop":
+        claim_ids = pd.Index(claim_ids.unique())
+        return pd.Series(np.ones(len(claim_ids), dtype="int64"), index=claim_ids)
+    return claim_ids.value_counts()
+
+def lookup_reverts(claim_ids: pd.Series, index: pd.Series) -> np.ndarray:
+    """
+    Looks up the number of reverts of each claim in an index built by `revert_index`.
+
+    Parameters:
+        claim_ids (pd.Series): Claim ids to look up.
+        index (pd.Series): Number of reverts indexed by claim id.
+
+    Returns:
+        np.ndarray: Number of reverts of each claim, 0 for claims that were not reverted.
+    """
+    if index.empty:
+        return np.zeros(len(claim_ids), dtype="int64")
+    ids = claim_ids.to_numpy()
+    if ids.dtype.kind == "S":
+        # Packed ids are looked up with a binary search in the reverted ids, rather than
+        # converted to a Python object per claim
+        keys = index.index.to_numpy().astype(ids.dtype)
+        order = np.argsort(keys)
+        found = np.minimum(np.searchsorted(keys, ids, sorter=order), len(keys) - 1)
+        positions = np.where(keys[order[found]] == ids, order[found], -1)
+    else:
+        positions = index.index.get_indexer(claim_ids)
+    return np.where(positions >= 0, index.to_numpy()[positions], 0)
+
+def flag_reverts(claims_df: pd.DataFrame, reverts_df: pd.DataFrame = None, duplicates: str = "drop") -> pd.DataFrame:
+    """
+    Adds a `reverted` column with the number of reverts of each claim, unless it is already there.
+
+    The lookup is done once per claim, so metrics, recommendations and common quantities computed
+    on the returned claims share it. Without reverts, no claim is reverted.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data.
+        duplicates (str): Duplicate reverts policy, see `revert_index`.
+
+    Returns:
+        pd.DataFrame: Claims with a `reverted` column.
+    """
+    if "reverted" in claims_df.columns:
+        return claims_df
+    if reverts_df is None or reverts_df.empty:
+        return claims_df.assign(reverted=np.zeros(len(claims_df), dtype="int64"))
+    return claims_df.assign(reverted=lookup_reverts(claims_df["id"], revert_index(reverts_df, duplicates)))
+
+def net_of_reverts(partial: pd.DataFrame, column: str, reverted_column: str) -> pd.Series:
+    """
+    Subtracts the contribution of reverted claims from an aggregate column.
+
+    Partials written before reverted contributions were tracked have no `reverted_column`;
+    their values are returned unchanged.
+
+    Parameters:
+        partial (pd.DataFrame): Partial aggregates.
+        column (str): Gross aggregate column.
+        reverted_column (str): Column holding the contribution of reverted claims.
+
+    Returns:
+        pd.Series: Net aggregate.
+    """
+    if reverted_column not in partial.columns:
+        return partial[column]
+    return partial[column] - partial[reverted_column]
+
+def partial_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame, duplicates: str = "drop") -> pd.DataFrame:
+    """
+    Computes mergeable per (npi, ndc) aggregates for a batch of claims.
+
+    Partial aggregates of different batches can be combined with `merge_partial_metrics`
+    and turned into the final metrics with `finalize_metrics`. Besides the gross aggregates,
+    the contribution of reverted claims (each counted once) is kept, so metrics can be
+    computed net of reverts.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        duplicates (str): Duplicate reverts policy, see `revert_index`.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns npi, ndc, fills, total_price, unit_price_sum, reverted,
+            reverted_fills, reverted_price and reverted_unit_price_sum.
+    """
+    claims_df = flag_reverts(claims_df, reverts_df, duplicates)
+    if "unit_price" in claims_df.columns:
+        unit_price = claims_df["unit_price"]
+    else:
+        unit_price = claims_df["price"] / claims_df["quantity"]
+    is_reverted = claims_df["reverted"].to_numpy() > 0
+    claims_df = claims_df.assign(
+        unit_price=unit_price,
+        reverted_fills=is_reverted.astype("int64"),
+        reverted_price=np.where(is_reverted, claims_df["price"], 0.0),
+        reverted_unit_price=np.where(is_reverted, unit_price, 0.0)
+    )
+
+    return claims_df.groupby(["npi", "ndc"], observed=True).agg(
+        fills=("id", "count"),
+        total_price=("price", "sum"),
+        unit_price_sum=("unit_price", "sum"),
+        reverted=("reverted", "sum"),
+        reverted_fills=("reverted_fills", "sum"),
+        reverted_price=("reverted_price", "sum"),
+        reverted_unit_price_sum=("reverted_unit_price", "sum")
+    ).reset_index()
+
+def merge_partial_metrics(partials: list) -> pd.DataFrame:
+    """
+    Combines partial aggregates computed by `partial_metrics` on different batches.
+
+    Parameters:
+        partials (list): List of partial aggregate DataFrames.
+
+    Returns:
+        pd.DataFrame: A single partial aggregate DataFrame.
+    """
+    partials = [partial for partial in partials if not partial.empty]
+    if not partials:
+        return pd.DataFrame()
+    return pd.concat(partials, ignore_index=True).groupby(["npi", "ndc"], observed=True).sum().reset_index()
+
+def finalize_metrics(partial: pd.DataFrame, net: bool = False) -> pd.DataFrame:
+    """
+    Turns partial aggregates into the final metrics.
+
+    Parameters:
+        partial (pd.DataFrame): Partial aggregates, as returned by `partial_metrics` or `merge_partial_metrics`.
+        net (bool): If set, reverted claims are excluded from fills, total_price and avg_price.
+
+    Returns:
+        pd.DataFrame: DataFrame with computed metrics.
+    """
+    if partial.empty:
+        return pd.DataFrame()
+
+    metrics = partial[["npi", "ndc"]].copy()
+    if net:
+        metrics["fills"] = net_of_reverts(partial, "fills", "reverted_fills").astype(int)
+        metrics["total_price"] = net_of_reverts(partial, "total_price", "reverted_price")
+        unit_price_sum = net_of_reverts(partial, "unit_price_sum", "reverted_unit_price_sum")
+    else:
+        metrics["fills"] = partial["fills"]
+        metrics["total_price"] = partial["total_price"]
+        unit_price_sum = partial["unit_price_sum"]
+    metrics["avg_price"] = unit_price_sum.round(SUM_DECIMALS) / metrics["fills"]
+    metrics["reverted"] = partial["reverted"].astype(int)
+    # Adding 0.0 turns the -0.0 left by subtracting reverted prices into 0.0
+    metrics["total_price"] = metrics["total_price"].round(SUM_DECIMALS).round(2) + 0.0
+    metrics["avg_price"] = metrics["avg_price"].round(2) + 0.0
+    return metrics
+
+def compute_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame, duplicates: str = "drop", net: bool = False) -> pd.DataFrame:
     """
     Computes metrics based on claims and reverts data.
 
@@ -11,9 +200,13 @@ def compute_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame) -> pd.Dat
       - avg_price: average unit price (rounded)
       - reverted: count of reverts
 
+    With `net`, reverted claims are excluded from fills, total_price and avg_price.
+
     Parameters:
         claims_df (pd.DataFrame): Validated claims data.
         reverts_df (pd.DataFrame): Validated reverts data.
+        duplicates (str): Duplicate reverts policy, see `revert_index`.
+        net (bool): If set, metrics are computed net of reverts.
 
     Returns:
         pd.DataFrame: DataFrame with computed metrics.
@@ -22,35 +215,7 @@ def compute_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame) -> pd.Dat
         logging.error("Claims DataFrame is empty.")
         return pd.DataFrame()
 
-    claims_df["unit_price"] = claims_df["price"] / claims_df["quantity"]
-
-    metrics_claims = claims_df.groupby(["npi", "ndc"]).agg(
-        fills=("id", "count"),
-        total_price=("price", "sum"),
-        avg_price=("unit_price", "mean")
-    ).reset_index()
-
-    if not reverts_df.empty:
-        claims_reverts = claims_df[["id", "npi", "ndc"]].merge(
-            reverts_df,
-            left_on="id",
-            right_on="claim_id",
-            how="left"
-        )
-        reverts_count = claims_reverts.groupby(["npi", "ndc"]).apply(
-            lambda df: df["claim_id"].notna().sum()
-        ).reset_index(name="reverted")
-    else:
+    if reverts_df.empty and "reverted" not in claims_df.columns:
         logging.error("No reverts data found.")
-        reverts_count = pd.DataFrame(columns=["npi", "ndc", "reverted"])
 
-    metrics = metrics_claims.merge(
-        reverts_count,
-        on=["npi", "ndc"],
-        how="left"
-    )
-    metrics["reverted"] = metrics["reverted"].fillna(0).astype(int)
-    metrics["total_price"] = metrics["total_price"].round(2)
-    metrics["avg_price"] = metrics["avg_price"].round(2)
-
-    return metrics
+    return finalize_metrics(partial_metrics(claims_df, reverts_df, duplicates), net)
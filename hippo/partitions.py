@@ -0,0 +1,198 @@
+import glob
+import logging
+import os
+import re
+
+import pandas as pd
+
+from hippo import instrumentation
+from hippo.constants import GRANULARITIES
+
+DEFAULT_PARTITION_DIR = "data/partitions"
+
+_PARTITION_FILE = re.compile(r"date=(\d{4}-\d{2}-\d{2})\.pkl$")
+
+def partition_path(partition_dir: str, layout: str, date: str) -> str:
+    """
+    Returns the path of the partition of a layout for one day.
+
+    Parameters:
+        partition_dir (str): Directory of the partitioned storage.
+        layout (str): Data type ('claims' or 'reverts').
+        date (str): Day of the partition, as YYYY-MM-DD.
+
+    Returns:
+        str: Path of the partition file.
+    """
+    return os.path.join(partition_dir, layout, f"date={date}.pkl")
+
+def list_partitions(partition_dir: str, layout: str) -> dict:
+    """
+    Lists the partitions of a layout.
+
+    Parameters:
+        partition_dir (str): Directory of the partitioned storage.
+        layout (str): Data type ('claims' or 'reverts').
+
+    Returns:
+        dict: Partition file paths keyed by day (YYYY-MM-DD), in date order.
+    """
+    found = {}
+    for path in sorted(glob.glob(os.path.join(partition_dir, layout, "date=*.pkl"))):
+        match = _PARTITION_FILE.search(path)
+        if match:
+            found[match.group(1)] = path
+    return found
+
+def write_partitions(claims_df: pd.DataFrame, reverts_df: pd.DataFrame, partition_dir: str = DEFAULT_PARTITION_DIR) -> dict:
+    """
+    Writes validated claims and reverts to one file per day and layout.
+
+    Claims are partitioned by their timestamp. A revert is stored in the partition of the claim
+    it reverts, so the reverts of the claims of a window are read together with them; reverts of
+    unknown claims are not stored since they never count. Partitions of days that are no longer
+    present are removed.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data.
+        partition_dir (str): Directory of the partitioned storage.
+
+    Returns:
+        dict: Number of partitions written per layout.
+    """
+    claim_dates = claims_df["timestamp"].dt.strftime("%Y-%m-%d")
+    frames = {"claims": claims_df.assign(_date=claim_dates)}
+    if reverts_df.empty:
+        frames["reverts"] = pd.DataFrame(columns=["id", "claim_id", "timestamp", "_date"])
+    else:
+        dates_by_id = pd.Series(claim_dates.to_numpy(), index=claims_df["id"].to_numpy())
+        dates_by_id = dates_by_id[~dates_by_id.index.duplicated()]
+        reverts_dates = dates_by_id.reindex(reverts_df["claim_id"].to_numpy()).to_numpy()
+        frames["reverts"] = reverts_df.assign(_date=reverts_dates).dropna(subset=["_date"])
+
+    written = {}
+    for layout, df in frames.items():
+        with instrumentation.stage("write_partitions", layout=layout, rows_in=len(df)) as record:
+            os.makedirs(os.path.join(partition_dir, layout), exist_ok=True)
+            stale = list_partitions(partition_dir, layout)
+            for date, partition in df.groupby("_date", sort=True):
+                path = partition_path(partition_dir, layout, date)
+                partition.drop(columns="_date").reset_index(drop=True).to_pickle(path + ".tmp")
+                os.replace(path + ".tmp", path)
+                stale.pop(date, None)
+            for path in stale.values():
+                os.remove(path)
+            written[layout] = df["_date"].nunique()
+            record["partitions"] = written[layout]
+        logging.info(f"{written[layout]} {layout} partition(s) written to {os.path.join(partition_dir, layout)}")
+    return written
+
+def read_partitions(layout: str, partition_dir: str = DEFAULT_PARTITION_DIR, since: str = None, until: str = None) -> pd.DataFrame:
+    """
+    Reads the partitions of a layout that overlap a time window, without touching the others.
+
+    Parameters:
+        layout (str): Data type ('claims' or 'reverts').
+        partition_dir (str): Directory of the partitioned storage.
+        since (str): Start of the window (inclusive), as a date or timestamp.
+        until (str): End of the window (exclusive), as a date or timestamp.
+
+    Returns:
+        pd.DataFrame: Events of the partitions read; claims are also filtered to the exact window.
+    """
+    since_day = pd.Timestamp(since).strftime("%Y-%m-%d") if since else None
+    until_ts = pd.Timestamp(until) if until else None
+    with instrumentation.stage("read_partitions", layout=layout) as record:
+        paths = [
+            path for date, path in list_partitions(partition_dir, layout).items()
+            if (since_day is None or date >= since_day) and (until_ts is None or pd.Timestamp(date) < until_ts)
+        ]
+        record["files"] = len(paths)
+        record["bytes_read"] = sum(os.path.getsize(path) for path in paths)
+        if not paths:
+            logging.error(f"No {layout} partitions found in {partition_dir} for the requested window.")
+            return pd.DataFrame()
+        df = pd.concat([pd.read_pickle(path) for path in paths], ignore_index=True)
+        if layout == "claims":
+            df = filter_window(df, since, until)
+        record["rows_out"] = len(df)
+    logging.info(f"Data for {layout} read from {len(paths)} partition(s): {len(df)} rows.")
+    return df
+
+def filter_window(claims_df: pd.DataFrame, since: str = None, until: str = None) -> pd.DataFrame:
+    """
+    Keeps the claims whose timestamp is within a time window.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        since (str): Start of the window (inclusive), as a date or timestamp.
+        until (str): End of the window (exclusive), as a date or timestamp.
+
+    Returns:
+        pd.DataFrame: Claims within the window.
+    """
+    if claims_df.empty:
+        return claims_df
+    mask = pd.Series(True, index=claims_df.index)
+    if since:
+        mask &= claims_df["timestamp"] >= pd.Timestamp(since)
+    if until:
+        mask &= claims_df["timestamp"] < pd.Timestamp(until)
+    return claims_df[mask]
+
+def periods(timestamps: pd.Series, granularity: str) -> pd.Series:
+    """
+    Returns the period of each timestamp, as the YYYY-MM-DD date of the period start.
+
+    Weeks start on Monday.
+
+    Parameters:
+        timestamps (pd.Series): Timestamps.
+        granularity (str): 'day', 'week' or 'month'.
+
+    Returns:
+        pd.Series: Period start of each timestamp.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity: {granularity}")
+    if granularity == "day":
+        start = timestamps.dt.floor("D")
+    elif granularity == "week":
+        start = timestamps.dt.to_period("W-SUN").dt.start_time
+    else:
+        start = timestamps.dt.to_period("M").dt.start_time
+    return start.dt.strftime("%Y-%m-%d")
+
+def rollup(compute, claims_df: pd.DataFrame, granularity: str, *args):
+    """
+    Runs a computation on the claims of each period and labels its results with the period.
+
+    Reverts and pharmacies passed in `args` are shared by all periods; reverts only count for the
+    claims they revert, so they need no splitting.
+
+    Parameters:
+        compute (callable): Computation taking the claims as first argument, such as
+            `metrics.compute_metrics` or `recommendations.compute_top_chains`.
+        claims_df (pd.DataFrame): Validated claims data.
+        granularity (str): 'day', 'week' or 'month'.
+        *args: Remaining arguments of the computation.
+
+    Returns:
+        pd.DataFrame | list: Results of all periods, with a leading 'period' column (DataFrame
+            results) or key (list results).
+    """
+    if claims_df.empty:
+        return compute(claims_df, *args)
+
+    results = []
+    for period, claims in claims_df.groupby(periods(claims_df["timestamp"], granularity), sort=True):
+        results.append((period, compute(claims, *args)))
+
+    if isinstance(results[0][1], pd.DataFrame):
+        frames = [
+            result.assign(period=period)[["period", *result.columns]]
+            for period, result in results if not result.empty
+        ]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return [{"period": period, **item} for period, result in results for item in result]
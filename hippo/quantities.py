@@ -1,13 +1,89 @@
+import numpy as np
 import pandas as pd
-import json
 import logging
 
-def compute_common_quantities(claims_df: pd.DataFrame) -> list:
+from hippo import metrics, writers
+
+def partial_quantities(claims_df: pd.DataFrame, reverts_df: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Computes a mergeable (ndc, quantity) frequency table for a batch of claims.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ndc, quantity, count and reverted_count.
+    """
+    claims_df = metrics.flag_reverts(claims_df, reverts_df)
+    is_reverted = (claims_df["reverted"].to_numpy() > 0).astype("int64")
+    return claims_df.assign(reverted_count=is_reverted).groupby(["ndc", "quantity"], observed=True).agg(
+        count=("reverted_count", "size"),
+        reverted_count=("reverted_count", "sum")
+    ).reset_index()
+
+def merge_partial_quantities(partials: list) -> pd.DataFrame:
+    """
+    Combines frequency tables computed by `partial_quantities` on different batches.
+
+    Parameters:
+        partials (list): List of frequency table DataFrames.
+
+    Returns:
+        pd.DataFrame: A single frequency table DataFrame.
+    """
+    partials = [partial for partial in partials if not partial.empty]
+    if not partials:
+        return pd.DataFrame()
+    return pd.concat(partials, ignore_index=True).groupby(["ndc", "quantity"], observed=True).sum().reset_index()
+
+def finalize_common_quantities(freq: pd.DataFrame, top_n: int = None, net: bool = False) -> list:
+    """
+    Orders the prescription quantities of each drug by frequency from a frequency table.
+
+    The table is ordered with a single sort over (ndc, count descending, quantity), so quantities
+    with the same frequency are always listed from the smallest to the largest.
+
+    Parameters:
+        freq (pd.DataFrame): Frequency table, as returned by `partial_quantities` or `merge_partial_quantities`.
+        top_n (int): If set, maximum number of quantities listed per drug.
+        net (bool): If set, reverted claims are not counted.
+
+    Returns:
+        list: A list of dictionaries in the same format as `compute_common_quantities`.
+    """
+    if freq.empty:
+        return []
+
+    if net:
+        freq = freq.assign(count=metrics.net_of_reverts(freq, "count", "reverted_count"))
+        freq = freq[freq["count"] > 0]
+
+    freq = freq.sort_values(["ndc", "count", "quantity"], ascending=[True, False, True])
+    if top_n is not None:
+        freq = freq[freq.groupby("ndc", observed=True).cumcount() < top_n]
+
+    ndcs = freq["ndc"].to_numpy()
+    quantities_list = freq["quantity"].tolist()
+    starts = np.flatnonzero(np.r_[True, ndcs[1:] != ndcs[:-1]]).tolist() + [len(ndcs)]
+
+    return [
+        {
+            "ndc": ndcs[start],
+            "most_prescribed_quantity": quantities_list[start:end]
+        }
+        for start, end in zip(starts[:-1], starts[1:])
+    ]
+
+def compute_common_quantities(claims_df: pd.DataFrame, top_n: int = None, reverts_df: pd.DataFrame = None, net: bool = False) -> list:
     """
     For each drug (ndc), identifies prescription quantities ordered by frequency (from highest to lowest).
 
     Parameters:
         claims_df (pd.DataFrame): Validated claims data.
+        top_n (int): If set, maximum number of quantities listed per drug.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        net (bool): If set, reverted claims are not counted.
 
     Returns:
         list: A list of dictionaries in the format:
@@ -20,18 +96,7 @@ def compute_common_quantities(claims_df: pd.DataFrame) -> list:
         logging.error("Insufficient claims data to compute common prescription quantities.")
         return []
 
-    freq = claims_df.groupby(["ndc", "quantity"]).size().reset_index(name="count")
-
-    top_quantities = []
-    for ndc, group in freq.groupby("ndc"):
-        group_sorted = group.sort_values("count", ascending=False)
-        quantities_list = group_sorted["quantity"].tolist()
-        top_quantities.append({
-            "ndc": ndc,
-            "most_prescribed_quantity": quantities_list
-        })
-
-    return top_quantities
+    return finalize_common_quantities(partial_quantities(claims_df, reverts_df), top_n, net)
 
 def save_common_quantities(top_quantities: list, output_file: str = "output/most_prescribed_quantities.json"):
     """
@@ -41,5 +106,4 @@ def save_common_quantities(top_quantities: list, output_file: str = "output/most
         top_quantities (list): List of prescription quantities per drug.
         output_file (str): Path to the output file.
     """
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(top_quantities, f, indent=4)
+    writers.write_records(top_quantities, output_file)
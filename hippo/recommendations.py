@@ -1,14 +1,137 @@
+import numpy as np
 import pandas as pd
-import json
 import logging
 
-def compute_top_chains(claims_df: pd.DataFrame, pharmacies_df: pd.DataFrame) -> list:
+from hippo import metrics, writers
+
+def partial_top_chains(claims_df: pd.DataFrame, pharmacies_df: pd.DataFrame, reverts_df: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Computes mergeable per (ndc, chain) unit price aggregates for a batch of claims.
+
+    The contribution of reverted claims is kept apart, so chains can be ranked net of reverts.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ndc, chain, unit_price_sum, unit_price_count,
+            reverted_unit_price_sum and reverted_unit_price_count.
+    """
+    claims_with_chain = metrics.flag_reverts(claims_df, reverts_df).merge(pharmacies_df, on="npi", how="left")
+
+    if "unit_price" not in claims_with_chain.columns:
+        claims_with_chain["unit_price"] = claims_with_chain["price"] / claims_with_chain["quantity"]
+    is_reverted = claims_with_chain["reverted"].to_numpy() > 0
+    claims_with_chain["reverted_unit_price"] = np.where(is_reverted, claims_with_chain["unit_price"], 0.0)
+    claims_with_chain["reverted_count"] = is_reverted.astype("int64")
+
+    return claims_with_chain.groupby(["ndc", "chain"], observed=True).agg(
+        unit_price_sum=("unit_price", "sum"),
+        unit_price_count=("unit_price", "count"),
+        reverted_unit_price_sum=("reverted_unit_price", "sum"),
+        reverted_unit_price_count=("reverted_count", "sum")
+    ).reset_index()
+
+def partial_top_chains_from_metrics(metrics_partial: pd.DataFrame, pharmacies_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Derives per (ndc, chain) unit price aggregates from per (npi, ndc) metrics aggregates.
+
+    Used when claims are no longer available, e.g. when only persisted aggregates are kept.
+
+    Parameters:
+        metrics_partial (pd.DataFrame): Partial aggregates, as returned by `metrics.partial_metrics`.
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+
+    Returns:
+        pd.DataFrame: DataFrame in the same format as `partial_top_chains`.
+    """
+    if metrics_partial.empty or pharmacies_df.empty:
+        return pd.DataFrame()
+
+    with_chain = metrics_partial.merge(pharmacies_df, on="npi", how="left")
+    return with_chain.groupby(["ndc", "chain"], observed=True).agg(
+        unit_price_sum=("unit_price_sum", "sum"),
+        unit_price_count=("fills", "sum"),
+        reverted_unit_price_sum=("reverted_unit_price_sum", "sum"),
+        reverted_unit_price_count=("reverted_fills", "sum")
+    ).reset_index()
+
+def merge_partial_top_chains(partials: list) -> pd.DataFrame:
     """
-    For each drug (ndc), computes the top 2 chains (obtained via npi) with the lowest average unit price.
+    Combines partial aggregates computed by `partial_top_chains` on different batches.
+
+    Parameters:
+        partials (list): List of partial aggregate DataFrames.
+
+    Returns:
+        pd.DataFrame: A single partial aggregate DataFrame.
+    """
+    partials = [partial for partial in partials if not partial.empty]
+    if not partials:
+        return pd.DataFrame()
+    return pd.concat(partials, ignore_index=True).groupby(["ndc", "chain"], observed=True).sum().reset_index()
+
+def finalize_top_chains(partial: pd.DataFrame, top_k: int = 2, min_fills: int = 1, net: bool = False) -> list:
+    """
+    Selects the top `top_k` chains with the lowest average unit price for each drug from partial aggregates.
+
+    Chains are ranked with a single sort over (ndc, avg_unit_price, chain), so ties on the
+    average price are broken by chain name.
+
+    Parameters:
+        partial (pd.DataFrame): Partial aggregates, as returned by `partial_top_chains` or `merge_partial_top_chains`.
+        top_k (int): Maximum number of chains per drug.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        net (bool): If set, reverted claims are excluded from the averages and from `min_fills`.
+
+    Returns:
+        list: A list of dictionaries in the same format as `compute_top_chains`.
+    """
+    if partial.empty:
+        return []
+
+    if net:
+        unit_price_sum = metrics.net_of_reverts(partial, "unit_price_sum", "reverted_unit_price_sum")
+        unit_price_count = metrics.net_of_reverts(partial, "unit_price_count", "reverted_unit_price_count")
+    else:
+        unit_price_sum, unit_price_count = partial["unit_price_sum"], partial["unit_price_count"]
+
+    ranked = (unit_price_count >= min_fills) & (unit_price_count > 0)
+    group_chain = partial.loc[ranked, ["ndc", "chain"]]
+    group_chain = group_chain.assign(
+        avg_unit_price=unit_price_sum[ranked].round(metrics.SUM_DECIMALS) / unit_price_count[ranked]
+    ).sort_values(["ndc", "avg_unit_price", "chain"])
+    top = group_chain[group_chain.groupby("ndc", observed=True).cumcount() < top_k]
+
+    ndcs = top["ndc"].to_numpy()
+    names = top["chain"].tolist()
+    prices = [round(price, 2) for price in top["avg_unit_price"].tolist()]
+    starts = np.flatnonzero(np.r_[True, ndcs[1:] != ndcs[:-1]]).tolist() + [len(ndcs)]
+
+    return [
+        {
+            "ndc": ndcs[start],
+            "chain": [
+                {"name": name, "avg_price": price}
+                for name, price in zip(names[start:end], prices[start:end])
+            ]
+        }
+        for start, end in zip(starts[:-1], starts[1:])
+    ]
+
+def compute_top_chains(claims_df: pd.DataFrame, pharmacies_df: pd.DataFrame, top_k: int = 2, min_fills: int = 1, reverts_df: pd.DataFrame = None, net: bool = False) -> list:
+    """
+    For each drug (ndc), computes the top `top_k` chains (obtained via npi) with the lowest average unit price.
 
     Parameters:
         claims_df (pd.DataFrame): Validated claims data.
         pharmacies_df (pd.DataFrame): Validated pharmacies data.
+        top_k (int): Maximum number of chains per drug.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        net (bool): If set, reverted claims are excluded from the averages.
 
     Returns:
         list: A list of dictionaries in the format:
@@ -24,26 +147,7 @@ def compute_top_chains(claims_df: pd.DataFrame, pharmacies_df: pd.DataFrame) ->
         logging.error("Insufficient data to compute Top 2 Chains per Drug.")
         return []
 
-    claims_with_chain = claims_df.merge(pharmacies_df, on="npi", how="left")
-
-    if "unit_price" not in claims_with_chain.columns:
-        claims_with_chain["unit_price"] = claims_with_chain["price"] / claims_with_chain["quantity"]
-
-    group_chain = claims_with_chain.groupby(["ndc", "chain"]).agg(
-        avg_unit_price=("unit_price", "mean")
-    ).reset_index()
-
-    top_chains = []
-    for ndc, group in group_chain.groupby("ndc"):
-        group_sorted = group.sort_values("avg_unit_price")
-        top_2 = group_sorted.head(2)
-        chain_list = [
-            {"name": row["chain"], "avg_price": round(row["avg_unit_price"], 2)}
-            for _, row in top_2.iterrows()
-        ]
-        top_chains.append({"ndc": ndc, "chain": chain_list})
-
-    return top_chains
+    return finalize_top_chains(partial_top_chains(claims_df, pharmacies_df, reverts_df), top_k, min_fills, net)
 
 def save_top_chains(top_chains: list, output_file: str = "output/top_chains.json"):
     """
@@ -53,5 +157,4 @@ def save_top_chains(top_chains: list, output_file: str = "output/top_chains.json
         top_chains (list): List of top chains per drug.
         output_file (str): Path to the output file.
     """
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(top_chains, f, indent=4)
+    writers.write_records(top_chains, output_file)
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+from hippo import data_loader, instrumentation, metrics, quantities, recommendations, state
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_RELOAD_INTERVAL = 10.0
+
+# Maximum number of keys returned by /keys
+MAX_KEYS = 10_000
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+def input_signature(data_path=data_loader.DEFAULT_DATA_PATH) -> tuple:
+    """
+    Describes the input files, so that new, changed or removed shards can be detected.
+
+    Parameters:
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `data_loader.layout_sources`).
+
+    Returns:
+        tuple: (layout, path, size, mtime) of every input file.
+    """
+    signature = []
+    for layout, file_format in [("pharmacies", "csv"), ("claims", "json"), ("reverts", "json")]:
+        for item in data_loader.list_files(layout, file_format, data_path):
+            try:
+                stat = os.stat(item)
+            except OSError:
+                continue
+            signature.append((layout, item, stat.st_size, stat.st_mtime))
+    return tuple(signature)
+
+def build_partials(load_options: dict = None, state_dir: str = None) -> dict:
+    """
+    Computes the partial aggregates of all outputs, from all input files or, with a `state_dir`,
+    incrementally from the input files that are new since the previous build.
+
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        state_dir (str): Directory of the persisted state.
+
+    Returns:
+        dict: A dictionary with keys 'metrics', 'top_chains' and 'quantities'.
+    """
+    load_options = load_options or {}
+    if state_dir:
+        return state.incremental_aggregates(
+            state_dir,
+            load_options.get("data_path", data_loader.DEFAULT_DATA_PATH),
+            workers=load_options.get("workers", 1),
+            cache_dir=load_options.get("cache_dir"),
+            quarantine_dir=load_options.get("quarantine_dir"),
+            pharmacy_only=load_options.get("pharmacy_only", False),
+            deduplicate=load_options.get("deduplicate")
+        )
+
+    data = data_loader.load_all_data(**load_options)
+    claims_df, reverts_df, pharmacies_df = data["claims"], data["reverts"], data["pharmacies"]
+    if claims_df.empty:
+        return {"metrics": pd.DataFrame(), "top_chains": pd.DataFrame(), "quantities": pd.DataFrame()}
+    claims_df = metrics.flag_reverts(claims_df, reverts_df)
+    return {
+        "metrics": metrics.partial_metrics(claims_df, reverts_df),
+        "top_chains": (
+            recommendations.partial_top_chains(claims_df, pharmacies_df)
+            if not pharmacies_df.empty else pd.DataFrame()
+        ),
+        "quantities": quantities.partial_quantities(claims_df),
+    }
+
+def build_index(partials: dict, min_fills: int = 1, net: bool = True) -> dict:
+    """
+    Finalizes partial aggregates into lookup tables.
+
+    Chains and quantities are ranked in full, so queries can ask for any number of them.
+
+    Parameters:
+        partials (dict): Partial aggregates, as returned by `build_partials`.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        net (bool): If set, reverted claims are excluded; otherwise gross numbers are kept.
+
+    Returns:
+        dict: A dictionary with keys:
+            - 'metrics': metrics record by (npi, ndc)
+            - 'top_chains': ranked chains by ndc
+            - 'quantities': quantities ordered by frequency by ndc
+            - 'loaded_at': time of the build, in seconds since the epoch
+    """
+    metrics_df = metrics.finalize_metrics(partials["metrics"], net)
+    # Metrics of fully reverted claims have no average price; JSON has no NaN, so it is sent as null
+    metrics_df = metrics_df.astype(object).where(metrics_df.notna(), None)
+    top_chains_partial = partials["top_chains"]
+    top_k = top_chains_partial["chain"].nunique() if not top_chains_partial.empty else 0
+    top_chains = recommendations.finalize_top_chains(top_chains_partial, top_k, min_fills, net)
+    common_quantities = quantities.finalize_common_quantities(partials["quantities"], None, net)
+    return {
+        "metrics": {(str(record["npi"]), str(record["ndc"])): record for record in metrics_df.to_dict("records")},
+        "top_chains": {str(item["ndc"]): item["chain"] for item in top_chains},
+        "quantities": {str(item["ndc"]): item["most_prescribed_quantity"] for item in common_quantities},
+        "loaded_at": time.time(),
+    }
+
+def _count(params: dict, name: str, default):
+    """
+    Reads a count query parameter, which must be a positive integer if given.
+    """
+    if name not in params:
+        return default
+    value = int(params[name][0])
+    if value < 1:
+        raise ValueError(f"{name} must be positive")
+    return value
+
+def query(index: dict, path: str, params: dict, top_k: int = 2) -> tuple:
+    """
+    Answers a query from the lookup tables.
+
+    Routes:
+      - /health: load time and number of entries of each table
+      - /keys?limit=N: up to N ndcs and (npi, ndc) pairs that have answers
+      - /top-chains/<ndc>?k=N: the N chains with the lowest average price for a drug
+      - /metrics/<npi>/<ndc>: metrics of a pharmacy for a drug
+      - /quantities/<ndc>?n=N: the N most prescribed quantities of a drug
+
+    Parameters:
+        index (dict): Lookup tables, as returned by `build_index`.
+        path (str): Path of the request.
+        params (dict): Query parameters, as returned by `urllib.parse.parse_qs`.
+        top_k (int): Number of chains returned when `k` is not given.
+
+    Returns:
+        tuple: `(status, payload)`; status 400 if `k`, `n` or `limit` is not a positive integer.
+    """
+    parts = [unquote(part) for part in path.strip("/").split("/")]
+    try:
+        if parts == ["health"]:
+            return 200, {
+                "status": "ok",
+                "loaded_at": index["loaded_at"],
+                "metrics": len(index["metrics"]),
+                "top_chains": len(index["top_chains"]),
+                "quantities": len(index["quantities"]),
+            }
+        if parts == ["keys"]:
+            limit = min(_count(params, "limit", 100), MAX_KEYS)
+            return 200, {
+                "ndcs": list(index["top_chains"])[:limit],
+                "pairs": [list(pair) for pair in list(index["metrics"])[:limit]],
+            }
+        if len(parts) == 2 and parts[0] == "top-chains":
+            chains = index["top_chains"].get(parts[1])
+            if chains is None:
+                return 404, {"error": f"No recommendations for ndc {parts[1]}."}
+            k = _count(params, "k", top_k)
+            return 200, {"ndc": parts[1], "chain": chains[:k]}
+        if len(parts) == 3 and parts[0] == "metrics":
+            record = index["metrics"].get((parts[1], parts[2]))
+            if record is None:
+                return 404, {"error": f"No metrics for npi {parts[1]} and ndc {parts[2]}."}
+            return 200, record
+        if len(parts) == 2 and parts[0] == "quantities":
+            most_prescribed = index["quantities"].get(parts[1])
+            if most_prescribed is None:
+                return 404, {"error": f"No quantities for ndc {parts[1]}."}
+            n = _count(params, "n", len(most_prescribed))
+            return 200, {"ndc": parts[1], "most_prescribed_quantity": most_prescribed[:n]}
+    except ValueError:
+        return 400, {"error": "Query parameters must be positive integers."}
+    return 404, {"error": f"Unknown path {path}."}
+
+async def reload(app: dict, force: bool = False) -> bool:
+    """
+    Rebuilds the lookup tables if the input files changed, or unconditionally with `force`.
+
+    Listing and aggregation run in a thread, so queries are answered from the previous tables
+    until the new ones replace them. A failed rebuild keeps the previous tables.
+
+    Parameters:
+        app (dict): Service state, see `serve`.
+        force (bool): If set, the tables are rebuilt even if no input file changed.
+
+    Returns:
+        bool: `True` if the tables were replaced.
+    """
+    loop = asyncio.get_running_loop()
+    async with app["lock"]:
+        data_path = app["load_options"].get("data_path", data_loader.DEFAULT_DATA_PATH)
+        signature = await loop.run_in_executor(None, input_signature, data_path)
+        if not force and signature == app["signature"]:
+            return False
+        logging.info("Input files changed. Reloading." if not force else "Reloading.")
+        start = time.perf_counter()
+        try:
+            index = await loop.run_in_executor(None, _build, app)
+        except Exception as e:
+            logging.error(f"Reload failed, still serving the previous data: {e}")
+            return False
+        app["index"], app["signature"] = index, signature
+        logging.info(f"Reloaded in {time.perf_counter() - start:.2f}s: {len(index['metrics'])} (npi, ndc) pairs, {len(index['top_chains'])} ndcs.")
+        return True
+
+def _build(app: dict) -> dict:
+    # Each build starts a new set of stage records, so a long-running service does not accumulate them
+    instrumentation.reset()
+    return build_index(build_partials(app["load_options"], app["state_dir"]), app["min_fills"], app["net"])
+
+async def _watch(app: dict, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await reload(app)
+
+async def _respond(app: dict, method: str, target: str) -> tuple:
+    url = urlsplit(target)
+    if url.path.rstrip("/") == "/reload":
+        if method != "POST":
+            return 405, {"error": "Use POST to reload."}
+        reloaded = await reload(app, force=True)
+        return 200, {"reloaded": reloaded, "loaded_at": app["index"]["loaded_at"]}
+    if method != "GET":
+        return 405, {"error": f"Method {method} not allowed."}
+    return query(app["index"], url.path, parse_qs(url.query), app["top_k"])
+
+async def handle_connection(app: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Serves the HTTP/1.1 requests of one connection, keeping it open between requests unless the
+    client asks to close it.
+
+    Each response carries the time spent answering it, in microseconds, in an
+    `X-Handler-Time-Us` header.
+    """
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+            start = time.perf_counter()
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ", 2)
+            except ValueError:
+                break
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                if name:
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length") or 0)
+            if length:
+                await reader.readexactly(length)
+
+            try:
+                status, payload = await _respond(app, method, target)
+            except Exception as e:
+                logging.error(f"Error answering {method} {target}: {e}")
+                status, payload = 500, {"error": "Internal error."}
+            body = json.dumps(payload).encode("utf-8")
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            elapsed_us = int((time.perf_counter() - start) * 1e6)
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"X-Handler-Time-Us: {elapsed_us}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def _serve(app: dict, host: str, port: int, reload_interval: float):
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(app, reader, writer), host, port)
+    logging.info(f"Serving on http://{host}:{port}")
+    watcher = asyncio.create_task(_watch(app, reload_interval)) if reload_interval > 0 else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if watcher:
+            watcher.cancel()
+
+def serve(load_options: dict = None, state_dir: str = None, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, top_k: int = 2, min_fills: int = 1, net: bool = True, reload_interval: float = DEFAULT_RELOAD_INTERVAL):
+    """
+    Loads the data once and answers queries over HTTP from lookup tables kept in memory.
+
+    Every `reload_interval` seconds, the input files are listed again and the tables are rebuilt
+    if a shard was added, changed or removed; `POST /reload` rebuilds them at once. With a
+    `state_dir`, rebuilds only read the new shards (see `state.incremental_aggregates`).
+
+    Parameters:
+        load_options (dict): Keyword arguments passed to `data_loader.load_all_data` (e.g. workers, cache_dir, encode).
+        state_dir (str): Directory of the persisted state.
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        top_k (int): Number of chains returned when a query does not give `k`.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        net (bool): If set, reverted claims are excluded; otherwise gross numbers are kept.
+        reload_interval (float): Seconds between checks for new input files; 0 disables them.
+    """
+    app = {
+        "load_options": load_options or {},
+        "state_dir": state_dir,
+        "top_k": top_k,
+        "min_fills": min_fills,
+        "net": net,
+        "lock": None,
+    }
+    app["signature"] = input_signature(app["load_options"].get("data_path", data_loader.DEFAULT_DATA_PATH))
+    app["index"] = _build(app)
+    logging.info(f"Loaded {len(app['index']['metrics'])} (npi, ndc) pairs and {len(app['index']['top_chains'])} ndcs.")
+
+    async def main():
+        app["lock"] = asyncio.Lock()
+        await _serve(app, host, port, reload_interval)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("Service stopped.")
@@ -0,0 +1,374 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from hippo import metrics, quantities, recommendations
+
+# Relative accuracy of the unit price quantiles: a reported quantile is within 1% of the
+# unit price of the requested rank
+RELATIVE_ACCURACY = 0.01
+# Maximum number of buckets kept per key; beyond it, the lowest buckets are collapsed together.
+# At 1% accuracy, 1024 buckets span unit prices from x to about 8e8 * x, so collapsing only
+# happens for keys with extreme price ranges and then raises the lowest quantiles
+MAX_BUCKETS = 1024
+# Number of quantities tracked per drug by the heavy-hitter sketch
+QUANTITY_COUNTERS = 64
+# Reported unit price quantiles, by output field
+QUANTILES = {"median_price": 0.5, "p90_price": 0.9}
+# Bucket of zero (and negative) unit prices, below every other bucket
+ZERO_BUCKET = np.iinfo("int32").min
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = np.log(_GAMMA)
+
+def bucket_index(values) -> np.ndarray:
+    """
+    Maps unit prices to the buckets of a logarithmic histogram.
+
+    Bucket `i` holds the values in (gamma^(i-1), gamma^i], with gamma = (1 + a) / (1 - a) and `a`
+    the relative accuracy, so every value of a bucket is within `a` of `bucket_value(i)`.
+
+    Parameters:
+        values (pd.Series | np.ndarray): Unit prices.
+
+    Returns:
+        np.ndarray: Bucket of each value, `ZERO_BUCKET` for values that are not positive.
+    """
+    values = np.asarray(values, dtype="float64")
+    positive = values > 0
+    logs = np.log(np.where(positive, values, 1.0)) / _LOG_GAMMA
+    return np.where(positive, np.ceil(logs), ZERO_BUCKET).astype("int32")
+
+def bucket_value(buckets) -> np.ndarray:
+    """
+    Returns the representative unit price of each bucket, as assigned by `bucket_index`.
+
+    Parameters:
+        buckets (pd.Series | np.ndarray): Bucket indices.
+
+    Returns:
+        np.ndarray: Unit price of each bucket, 0 for `ZERO_BUCKET`.
+    """
+    buckets = np.asarray(buckets, dtype="int64")
+    zero = buckets == ZERO_BUCKET
+    return np.where(zero, 0.0, 2 * np.power(_GAMMA, np.where(zero, 0, buckets)) / (_GAMMA + 1))
+
+def collapse_buckets(sketch: pd.DataFrame, keys: list, max_buckets: int = MAX_BUCKETS) -> pd.DataFrame:
+    """
+    Bounds the number of buckets per key by merging the lowest buckets of keys that have more
+    than `max_buckets` into their `max_buckets`-th highest bucket.
+
+    Parameters:
+        sketch (pd.DataFrame): Sketch with one row per key and bucket.
+        keys (list): Key columns of the sketch.
+        max_buckets (int): Maximum number of buckets per key.
+
+    Returns:
+        pd.DataFrame: Sketch with at most `max_buckets` buckets per key.
+    """
+    rank = sketch.groupby(keys, observed=True).cumcount(ascending=False)
+    if not (rank >= max_buckets).any():
+        return sketch
+    floor = sketch["bucket"].where(rank == max_buckets - 1)
+    floor = floor.groupby([sketch[key] for key in keys], observed=True).transform("max")
+    sketch = sketch.assign(bucket=np.where(rank >= max_buckets, floor, sketch["bucket"]).astype("int32"))
+    return sketch.groupby([*keys, "bucket"], observed=True).sum().reset_index()
+
+def partial_price_sketch(claims_df: pd.DataFrame, reverts_df: pd.DataFrame = None, max_buckets: int = MAX_BUCKETS) -> pd.DataFrame:
+    """
+    Computes mergeable per (npi, ndc) unit price sketches for a batch of claims.
+
+    A sketch is a histogram of unit prices over logarithmic buckets (see `bucket_index`). Bucket
+    counts add up, so sketches of different batches or runs merge exactly, and reverted claims
+    are counted apart so quantiles can be computed net of reverts.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        max_buckets (int): Maximum number of buckets per key.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns npi, ndc, bucket, count and reverted_count.
+    """
+    claims_df = metrics.flag_reverts(claims_df, reverts_df)
+    if "unit_price" in claims_df.columns:
+        unit_price = claims_df["unit_price"]
+    else:
+        unit_price = claims_df["price"] / claims_df["quantity"]
+    sketch = claims_df[["npi", "ndc"]].assign(
+        bucket=bucket_index(unit_price),
+        count=np.ones(len(claims_df), dtype="int64"),
+        reverted_count=(claims_df["reverted"].to_numpy() > 0).astype("int64")
+    ).groupby(["npi", "ndc", "bucket"], observed=True).sum().reset_index()
+    return collapse_buckets(sketch, ["npi", "ndc"], max_buckets)
+
+def chain_price_sketch(price_sketch: pd.DataFrame, pharmacies_df: pd.DataFrame, max_buckets: int = MAX_BUCKETS) -> pd.DataFrame:
+    """
+    Derives per (ndc, chain) unit price sketches from per (npi, ndc) sketches.
+
+    Parameters:
+        price_sketch (pd.DataFrame): Sketches, as returned by `partial_price_sketch`.
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+        max_buckets (int): Maximum number of buckets per key.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ndc, chain, bucket, count and reverted_count.
+    """
+    if price_sketch.empty or pharmacies_df.empty:
+        return pd.DataFrame()
+
+    with_chain = price_sketch.merge(pharmacies_df, on="npi", how="left")
+    sketch = with_chain.groupby(["ndc", "chain", "bucket"], observed=True).agg(
+        count=("count", "sum"),
+        reverted_count=("reverted_count", "sum")
+    ).reset_index()
+    return collapse_buckets(sketch, ["ndc", "chain"], max_buckets)
+
+def merge_price_sketches(partials: list, keys: list = None, max_buckets: int = MAX_BUCKETS) -> pd.DataFrame:
+    """
+    Combines unit price sketches computed on different batches.
+
+    Parameters:
+        partials (list): List of sketch DataFrames.
+        keys (list): Key columns of the sketches, (npi, ndc) by default.
+        max_buckets (int): Maximum number of buckets per key.
+
+    Returns:
+        pd.DataFrame: A single sketch DataFrame.
+    """
+    keys = keys or ["npi", "ndc"]
+    partials = [partial for partial in partials if not partial.empty]
+    if not partials:
+        return pd.DataFrame()
+    merged = pd.concat(partials, ignore_index=True).groupby([*keys, "bucket"], observed=True).sum().reset_index()
+    return collapse_buckets(merged, keys, max_buckets)
+
+def price_quantiles(sketch: pd.DataFrame, keys: list, net: bool = False) -> pd.DataFrame:
+    """
+    Computes the unit price quantiles listed in `QUANTILES` from sketches.
+
+    The quantile q of n prices is the price of rank q * (n - 1), counted from 0, read from the
+    bucket holding that rank.
+
+    Parameters:
+        sketch (pd.DataFrame): Sketches, as returned by `partial_price_sketch` or `chain_price_sketch`.
+        keys (list): Key columns of the sketches.
+        net (bool): If set, reverted claims are not counted.
+
+    Returns:
+        pd.DataFrame: DataFrame with the key columns and one column per quantile, rounded to 2 decimals.
+    """
+    columns = [*keys, *QUANTILES]
+    if sketch.empty:
+        return pd.DataFrame(columns=columns)
+
+    count = metrics.net_of_reverts(sketch, "count", "reverted_count") if net else sketch["count"]
+    sketch = sketch[keys + ["bucket"]].assign(count=count)
+    sketch = sketch[sketch["count"] > 0].sort_values([*keys, "bucket"])
+    grouped = sketch.groupby(keys, observed=True)["count"]
+    cumulative = grouped.cumsum()
+    total = grouped.transform("sum")
+
+    result = None
+    for name, q in QUANTILES.items():
+        hit = sketch[cumulative > q * (total - 1)]
+        first = hit.groupby(keys, observed=True).head(1)
+        first = first[keys].assign(**{name: np.round(bucket_value(first["bucket"]), 2)})
+        result = first if result is None else result.merge(first, on=keys)
+    return result.reset_index(drop=True)[columns]
+
+def add_price_quantiles(metrics_df: pd.DataFrame, sketch: pd.DataFrame, net: bool = False) -> pd.DataFrame:
+    """
+    Adds the unit price quantiles of each (npi, ndc) to metrics.
+
+    Parameters:
+        metrics_df (pd.DataFrame): Metrics, as returned by `metrics.finalize_metrics`.
+        sketch (pd.DataFrame): Per (npi, ndc) sketches, as returned by `partial_price_sketch`.
+        net (bool): If set, reverted claims are not counted.
+
+    Returns:
+        pd.DataFrame: Metrics with one more column per quantile.
+    """
+    if metrics_df.empty:
+        return metrics_df
+    return metrics_df.merge(price_quantiles(sketch, ["npi", "ndc"], net), on=["npi", "ndc"], how="left")
+
+def add_chain_price_quantiles(top_chains: list, sketch: pd.DataFrame, net: bool = False) -> list:
+    """
+    Adds the unit price quantiles of each (ndc, chain) to recommendations.
+
+    Parameters:
+        top_chains (list): Recommendations, as returned by `recommendations.finalize_top_chains`.
+        sketch (pd.DataFrame): Per (ndc, chain) sketches, as returned by `chain_price_sketch`.
+        net (bool): If set, reverted claims are not counted.
+
+    Returns:
+        list: Recommendations whose chains have one more key per quantile.
+    """
+    table = price_quantiles(sketch, ["ndc", "chain"], net)
+    lookup = {
+        (ndc, chain): values
+        for ndc, chain, *values in zip(*(table[column].tolist() for column in table.columns))
+    }
+    for item in top_chains:
+        for chain in item["chain"]:
+            values = lookup.get((item["ndc"], chain["name"]), [None] * len(QUANTILES))
+            chain.update(zip(QUANTILES, values))
+    return top_chains
+
+def truncate_quantities(freq: pd.DataFrame, counters: int = QUANTITY_COUNTERS) -> pd.DataFrame:
+    """
+    Bounds a (ndc, quantity) frequency table to `counters` quantities per drug with the
+    Misra-Gries summary, the mergeable counterpart of space-saving.
+
+    For drugs with more than `counters` quantities, the count of the (`counters` + 1)-th most
+    frequent quantity is subtracted from every count and only positive counts are kept. Counts
+    are then underestimated by at most n / (`counters` + 1) for n claims of the drug, the order of
+    the kept quantities is unchanged, and every quantity more frequent than that bound is kept.
+    Drugs with at most `counters` quantities are exact.
+
+    Parameters:
+        freq (pd.DataFrame): Frequency table, as returned by `quantities.partial_quantities`.
+        counters (int): Maximum number of quantities per drug.
+
+    Returns:
+        pd.DataFrame: Frequency table with at most `counters` quantities per drug.
+    """
+    if freq.empty:
+        return freq
+    freq = freq.sort_values(["ndc", "count", "quantity"], ascending=[True, False, True])
+    rank = freq.groupby("ndc", observed=True).cumcount()
+    if not (rank >= counters).any():
+        return freq.reset_index(drop=True)
+
+    cut = freq["count"].where(rank == counters)
+    cut = cut.groupby(freq["ndc"], observed=True).transform("max").fillna(0).astype("int64")
+    count = freq["count"] - cut
+    freq = freq.assign(count=count, reverted_count=np.minimum(freq["reverted_count"], count))
+    return freq[(rank < counters) & (count > 0)].reset_index(drop=True)
+
+def partial_quantity_sketch(claims_df: pd.DataFrame, reverts_df: pd.DataFrame = None, counters: int = QUANTITY_COUNTERS) -> pd.DataFrame:
+    """
+    Computes mergeable heavy-hitter quantity sketches for a batch of claims.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        counters (int): Maximum number of quantities per drug.
+
+    Returns:
+        pd.DataFrame: Frequency table in the format of `quantities.partial_quantities`, with at
+            most `counters` quantities per drug.
+    """
+    return truncate_quantities(quantities.partial_quantities(claims_df, reverts_df), counters)
+
+def merge_quantity_sketches(partials: list, counters: int = QUANTITY_COUNTERS) -> pd.DataFrame:
+    """
+    Combines heavy-hitter quantity sketches computed on different batches.
+
+    Parameters:
+        partials (list): List of sketch DataFrames.
+        counters (int): Maximum number of quantities per drug.
+
+    Returns:
+        pd.DataFrame: A single sketch DataFrame.
+    """
+    return truncate_quantities(quantities.merge_partial_quantities(partials), counters)
+
+def finalize_metrics(partial: pd.DataFrame, sketch: pd.DataFrame, net: bool = False) -> pd.DataFrame:
+    """
+    Turns partial aggregates into metrics like `metrics.finalize_metrics`, with the median and
+    90th percentile unit price of each (npi, ndc).
+
+    Parameters:
+        partial (pd.DataFrame): Partial aggregates, as returned by `metrics.partial_metrics`.
+        sketch (pd.DataFrame): Per (npi, ndc) sketches, as returned by `partial_price_sketch`.
+        net (bool): If set, reverted claims are excluded.
+
+    Returns:
+        pd.DataFrame: DataFrame with computed metrics and columns median_price and p90_price.
+    """
+    return add_price_quantiles(metrics.finalize_metrics(partial, net), sketch, net)
+
+def finalize_top_chains(partial: pd.DataFrame, sketch: pd.DataFrame, top_k: int = 2, min_fills: int = 1, net: bool = False) -> list:
+    """
+    Selects top chains like `recommendations.finalize_top_chains`, with the median and 90th
+    percentile unit price of each listed chain.
+
+    Parameters:
+        partial (pd.DataFrame): Partial aggregates, as returned by `recommendations.partial_top_chains`.
+        sketch (pd.DataFrame): Per (ndc, chain) sketches, as returned by `chain_price_sketch`.
+        top_k (int): Maximum number of chains per drug.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        net (bool): If set, reverted claims are excluded from the averages and quantiles.
+
+    Returns:
+        list: A list of dictionaries in the format of `compute_top_chains`.
+    """
+    return add_chain_price_quantiles(recommendations.finalize_top_chains(partial, top_k, min_fills, net), sketch, net)
+
+def compute_metrics(claims_df: pd.DataFrame, reverts_df: pd.DataFrame, duplicates: str = "drop", net: bool = False) -> pd.DataFrame:
+    """
+    Computes metrics like `metrics.compute_metrics`, with the median and 90th percentile unit
+    price of each (npi, ndc).
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        reverts_df (pd.DataFrame): Validated reverts data.
+        duplicates (str): Duplicate reverts policy, see `metrics.revert_index`.
+        net (bool): If set, metrics are computed net of reverts.
+
+    Returns:
+        pd.DataFrame: DataFrame with computed metrics and columns median_price and p90_price.
+    """
+    if claims_df.empty:
+        return metrics.compute_metrics(claims_df, reverts_df, duplicates, net)
+
+    claims_df = metrics.flag_reverts(claims_df, reverts_df, duplicates)
+    metrics_df = metrics.compute_metrics(claims_df, reverts_df, duplicates, net)
+    return add_price_quantiles(metrics_df, partial_price_sketch(claims_df), net)
+
+def compute_top_chains(claims_df: pd.DataFrame, pharmacies_df: pd.DataFrame, top_k: int = 2, min_fills: int = 1, reverts_df: pd.DataFrame = None, net: bool = False) -> list:
+    """
+    Computes top chains like `recommendations.compute_top_chains`, with the median and 90th
+    percentile unit price of each listed chain.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+        top_k (int): Maximum number of chains per drug.
+        min_fills (int): Minimum number of claims of a drug a chain needs to be ranked.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        net (bool): If set, reverted claims are excluded from the averages and quantiles.
+
+    Returns:
+        list: A list of dictionaries in the format of `recommendations.compute_top_chains`, whose
+            chains also have the keys median_price and p90_price.
+    """
+    if claims_df.empty or pharmacies_df.empty:
+        return recommendations.compute_top_chains(claims_df, pharmacies_df, top_k, min_fills, reverts_df, net)
+
+    claims_df = metrics.flag_reverts(claims_df, reverts_df)
+    top_chains = recommendations.compute_top_chains(claims_df, pharmacies_df, top_k, min_fills, None, net)
+    return add_chain_price_quantiles(top_chains, chain_price_sketch(partial_price_sketch(claims_df), pharmacies_df), net)
+
+def compute_common_quantities(claims_df: pd.DataFrame, top_n: int = None, reverts_df: pd.DataFrame = None, net: bool = False) -> list:
+    """
+    Lists the most prescribed quantities of each drug like `quantities.compute_common_quantities`,
+    from a heavy-hitter sketch with `QUANTITY_COUNTERS` quantities per drug.
+
+    Parameters:
+        claims_df (pd.DataFrame): Validated claims data.
+        top_n (int): If set, maximum number of quantities listed per drug.
+        reverts_df (pd.DataFrame): Validated reverts data, used if claims have no `reverted` column.
+        net (bool): If set, reverted claims are not counted.
+
+    Returns:
+        list: A list of dictionaries in the format of `quantities.compute_common_quantities`.
+    """
+    if claims_df.empty:
+        logging.error("Insufficient claims data to compute common prescription quantities.")
+        return []
+
+    return quantities.finalize_common_quantities(partial_quantity_sketch(claims_df, reverts_df), top_n, net)
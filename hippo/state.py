@@ -0,0 +1,318 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from hippo import claims_index, data_loader, dedup, metrics, quantities, recommendations, sketches
+
+DEFAULT_STATE_DIR = "data/state"
+STATE_FILE = "state.pkl"
+STATE_VERSION = 8
+
+# Pending reverts are dropped once claims this much newer than the revert have been consumed:
+# a claim precedes its revert, so a claim that has not arrived by then is not expected to
+PENDING_REVERT_EXPIRY = pd.Timedelta(days=180)
+
+def empty_state() -> dict:
+    """
+    Creates the state of a run that has not consumed any input file yet.
+
+    Returns:
+        dict: A dictionary with keys:
+            - 'files': {layout: {path: {"size": <bytes>, "mtime": <mtime>}}} of consumed input files
+            - 'metrics': per (npi, ndc) aggregates, as returned by `metrics.partial_metrics`
+            - 'quantities': per (ndc, quantity) counts, as returned by `quantities.partial_quantities`
+            - 'price_sketch': per (npi, ndc) unit price sketches, as returned by `sketches.partial_price_sketch`
+            - 'claims_index': npi, ndc, quantity, price, unit price and number of attributed
+              reverts of every consumed claim by packed id, used to attribute late reverts and
+              to drop redelivered claims (see `claims_index.empty_index`)
+            - 'pending_reverts': claim_id and timestamp of reverts whose claim has not been seen
+              yet (see `compact_pending`)
+            - 'watermark': timestamp of the latest consumed claim
+            - 'version': format version of the state
+    """
+    return {
+        "version": STATE_VERSION,
+        "files": {"claims": {}, "reverts": {}},
+        "metrics": pd.DataFrame(),
+        "quantities": pd.DataFrame(),
+        "price_sketch": pd.DataFrame(),
+        "claims_index": claims_index.empty_index(),
+        "pending_reverts": pd.DataFrame(columns=["claim_id", "timestamp"]),
+        "watermark": pd.NaT,
+    }
+
+def load_state(state_dir: str = DEFAULT_STATE_DIR) -> dict:
+    """
+    Loads the persisted aggregate state, or an empty state if there is none.
+
+    Parameters:
+        state_dir (str): Directory where the state is persisted.
+
+    Returns:
+        dict: State in the format described in `empty_state`.
+    """
+    path = os.path.join(state_dir, STATE_FILE)
+    if not os.path.exists(path):
+        logging.info(f"No state found in {state_dir}. Starting from scratch.")
+        return empty_state()
+    state = pd.read_pickle(path)
+    if state.get("version") != STATE_VERSION:
+        logging.warning(f"State in {state_dir} was written by an older version. Starting from scratch.")
+        return empty_state()
+    state["claims_index"] = claims_index.load(state["claims_index"], os.path.join(state_dir, claims_index.INDEX_DIR))
+    return state
+
+def save_state(state: dict, state_dir: str = DEFAULT_STATE_DIR):
+    """
+    Persists the aggregate state.
+
+    New chunks of the claims index are written to their own files first, so a run only writes
+    the claims it consumed, plus the chunks it compacted. The rest of the state is then written
+    to a temporary file and renamed, so an interrupted run never leaves aggregates and the list
+    of consumed files out of sync.
+
+    Parameters:
+        state (dict): State in the format described in `empty_state`.
+        state_dir (str): Directory where the state is persisted.
+    """
+    index_dir = os.path.join(state_dir, claims_index.INDEX_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, STATE_FILE)
+    saved = {**state, "claims_index": claims_index.save(state["claims_index"], index_dir)}
+    pd.to_pickle(saved, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    claims_index.remove_stale(saved["claims_index"], index_dir)
+
+def new_files(state: dict, layout: str, items: list) -> list:
+    """
+    Returns the files that were not consumed by previous runs.
+
+    Consumed files are expected to be immutable; if one changed since it was consumed, a warning
+    is logged and it is not processed again.
+
+    Parameters:
+        state (dict): State in the format described in `empty_state`.
+        layout (str): Data type ('claims' or 'reverts').
+        items (list): Paths of the files currently available.
+
+    Returns:
+        list: Paths of the files that still have to be processed.
+    """
+    consumed = state["files"][layout]
+    pending = []
+    for item in items:
+        stat = os.stat(item)
+        if item not in consumed:
+            pending.append(item)
+        elif consumed[item] != {"size": stat.st_size, "mtime": stat.st_mtime}:
+            logging.warning(f"File {item} changed after being processed. Ignoring the changes.")
+    return pending
+
+def merge_events(state: dict, claims_df: pd.DataFrame, reverts_df: pd.DataFrame, duplicates: str = "drop", sketch: bool = True) -> dict:
+    """
+    Merges new claims and reverts into the aggregate state.
+
+    Reverts of claims consumed in previous runs are attributed through the claims index, and
+    reverts whose claim has not arrived yet are kept as pending until it does, or until they
+    expire (see `compact_pending`). A claim whose id was already consumed also carries the
+    reverts attributed to that id, so the aggregates match a run over all the inputs. The cost of a call depends on the new events, not on the history:
+    the claims index is only searched for the ids of new reverts and new claims.
+
+    Parameters:
+        state (dict): State in the format described in `empty_state`.
+        claims_df (pd.DataFrame): Validated new claims data.
+        reverts_df (pd.DataFrame): Validated new reverts data.
+        duplicates (str): Duplicate reverts policy, see `metrics.revert_index`.
+        sketch (bool): If not set, unit price sketches are not maintained, for callers that
+            know they will never need them.
+
+    Returns:
+        dict: The updated state.
+    """
+    # Empty frames are left out of concatenations, whose result dtypes they would otherwise affect
+    candidates = state["pending_reverts"]
+    if candidates.empty:
+        candidates = reverts_df[["claim_id", "timestamp"]].reset_index(drop=True) if not reverts_df.empty else candidates
+    elif not reverts_df.empty:
+        candidates = pd.concat([candidates, reverts_df[["claim_id", "timestamp"]]], ignore_index=True)
+    pending = np.ones(len(candidates), dtype=bool)
+
+    partials = [state["metrics"]]
+    index = state["claims_index"]
+    # Pending reverts were already missing from the claims index, which only grows, so it only
+    # needs to be searched when new reverts arrive. Reverts found there still apply to new claims
+    # with the same id, as they would in a run over all the inputs
+    late = candidates.iloc[:0]
+    if not reverts_df.empty and not candidates.empty:
+        found = claims_index.contains(index, dedup.pack_ids(candidates["claim_id"]))
+        late = candidates[found]
+        pending &= ~found
+
+    new_claims = None
+    if not claims_df.empty:
+        keys = dedup.pack_ids(claims_df["id"])
+        claims_df = metrics.flag_reverts(claims_df, candidates, duplicates)
+        # Redelivered claims also carry the reverts attributed to their id in earlier runs
+        attributed = claims_index.attributed_reverts(index, keys)
+        reverted = claims_df["reverted"].to_numpy()
+        reverted = np.maximum(reverted, attributed) if duplicates == "drop" else reverted + attributed
+        claims_df = claims_df.assign(reverted=reverted, unit_price=claims_df["price"] / claims_df["quantity"])
+        partials.append(metrics.partial_metrics(claims_df, candidates, duplicates))
+        state["quantities"] = quantities.merge_partial_quantities(
+            [state["quantities"], quantities.partial_quantities(claims_df)]
+        )
+        if sketch:
+            state["price_sketch"] = sketches.merge_price_sketches(
+                [state["price_sketch"], sketches.partial_price_sketch(claims_df)]
+            )
+        new_claims = claims_df
+        pending &= ~candidates["claim_id"].isin(claims_df["id"]).to_numpy()
+        latest = claims_df["timestamp"].max()
+        state["watermark"] = latest if pd.isna(state["watermark"]) else max(state["watermark"], latest)
+
+    if not late.empty:
+        counts = metrics.revert_index(late, duplicates)
+        matched = claims_index.find(index, dedup.pack_ids(counts.index))
+        added = counts.to_numpy()[matched["query"].to_numpy()]
+        if duplicates == "drop":
+            added = np.where(matched["reverted"] > 0, 0, added)
+        newly_reverted = (matched["reverted"].to_numpy() == 0) & (added > 0)
+        claims_index.add_reverted(index, matched["row"].to_numpy(), added)
+
+        late_counts = matched[["npi", "ndc"]].assign(
+            reverted=added,
+            reverted_fills=newly_reverted.astype("int64"),
+            reverted_price=np.where(newly_reverted, matched["price"], 0.0),
+            reverted_unit_price_sum=np.where(newly_reverted, matched["unit_price"], 0.0)
+        )
+        late_counts = late_counts.groupby(["npi", "ndc"], observed=True).sum().reset_index()
+        late_counts[["fills", "total_price", "unit_price_sum"]] = 0
+        partials.append(late_counts)
+
+        late_quantities = matched[["ndc", "quantity"]].assign(count=0, reverted_count=newly_reverted.astype("int64"))
+        late_quantities = late_quantities.groupby(["ndc", "quantity"], observed=True).sum().reset_index()
+        state["quantities"] = quantities.merge_partial_quantities([state["quantities"], late_quantities])
+
+        if sketch:
+            late_sketch = matched[["npi", "ndc"]].assign(
+                bucket=sketches.bucket_index(matched["unit_price"]), count=0, reverted_count=newly_reverted.astype("int64")
+            )
+            late_sketch = late_sketch.groupby(["npi", "ndc", "bucket"], observed=True).sum().reset_index()
+            state["price_sketch"] = sketches.merge_price_sketches([state["price_sketch"], late_sketch])
+
+    state["metrics"] = metrics.merge_partial_metrics(partials)
+    state["pending_reverts"] = compact_pending(candidates[pending], state["watermark"], duplicates)
+    if new_claims is not None:
+        claims_index.append(index, keys, new_claims)
+    return state
+
+def compact_pending(pending: pd.DataFrame, watermark: pd.Timestamp, duplicates: str = "drop") -> pd.DataFrame:
+    """
+    Drops the pending reverts that can no longer change the aggregates, so that reverts of claims
+    that never arrive, or are filtered out, do not accumulate in the state.
+
+    Reverts older than `PENDING_REVERT_EXPIRY` before the watermark expire. With the "drop"
+    policy, a claim counts as reverted at most once, so a single revert is kept per claim.
+
+    Parameters:
+        pending (pd.DataFrame): claim_id and timestamp of the reverts whose claim was not seen.
+        watermark (pd.Timestamp): Timestamp of the latest consumed claim, `NaT` if there is none.
+        duplicates (str): Duplicate reverts policy, see `metrics.revert_index`.
+
+    Returns:
+        pd.DataFrame: The reverts that remain pending.
+    """
+    if pending.empty:
+        return pending.reset_index(drop=True)
+    if not pd.isna(watermark):
+        expired = (pending["timestamp"] < watermark - PENDING_REVERT_EXPIRY).to_numpy()
+        if expired.any():
+            logging.warning(
+                f"{int(expired.sum())} pending revert(s) expired: their claim was not seen within "
+                f"{PENDING_REVERT_EXPIRY.days} days."
+            )
+            pending = pending[~expired]
+    if duplicates == "drop":
+        # The latest revert of a claim is kept, the one that would expire last
+        pending = pending.sort_values("timestamp", kind="stable").drop_duplicates("claim_id", keep="last")
+    return pending.reset_index(drop=True)
+
+def drop_consumed(state: dict, claims_df: pd.DataFrame, keep: str = "first") -> pd.DataFrame:
+    """
+    Drops claims whose id was already consumed, in this run or an earlier one, and duplicates
+    among the new claims (see `dedup.drop_duplicates`).
+
+    Parameters:
+        state (dict): State in the format described in `empty_state`.
+        claims_df (pd.DataFrame): Validated new claims data.
+        keep (str): Which occurrence of a claim duplicated among the new claims to keep.
+
+    Returns:
+        pd.DataFrame: The claims that were not consumed yet.
+    """
+    if claims_df.empty:
+        return claims_df
+    consumed = claims_index.contains(state["claims_index"], dedup.pack_ids(claims_df["id"]))
+    if consumed.any():
+        logging.info(f"{int(consumed.sum())} claim(s) already consumed dropped.")
+    claims_df, _ = dedup.drop_duplicates(claims_df[~consumed], keep)
+    return claims_df
+
+def incremental_aggregates(state_dir: str = DEFAULT_STATE_DIR, data_path=data_loader.DEFAULT_DATA_PATH, workers: int = 1, cache_dir: str = None, quarantine_dir: str = None, pharmacy_only: bool = False, deduplicate: str = None, sketch: bool = False) -> dict:
+    """
+    Processes only the input files that are new since the previous run, merges them into the
+    persisted state and returns the partial aggregates of the whole history.
+
+    Parameters:
+        state_dir (str): Directory where the state is persisted.
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `data_loader.layout_sources`).
+        workers (int): Number of worker processes used to read files.
+        cache_dir (str): Directory of the validated-data cache.
+        quarantine_dir (str): Directory where rejected rows are written.
+        pharmacy_only (bool): If set, claims of pharmacies missing from the pharmacy dataset are
+            dropped before they are coerced.
+        deduplicate (str): If set, new claims whose id was already consumed, in this run or an
+            earlier one, are dropped. Consumed claims are never retracted, so "latest" only applies
+            among the claims of a run.
+        sketch (bool): If set, the unit price and heavy-hitter quantity sketches are also returned.
+            Unit price sketches are kept in the state on every run, so they cover the whole history.
+
+    Returns:
+        dict: A dictionary with keys 'metrics', 'top_chains' and 'quantities' each containing the
+            partial aggregates, ready to be passed to the corresponding `finalize_*` function, and
+            with `sketch`, keys 'price_sketch', 'chain_price_sketch' and 'quantity_sketch'.
+    """
+    state = load_state(state_dir)
+    pharmacies_df = data_loader.load_data("pharmacies", "csv", data_path, cache_dir=cache_dir, quarantine_dir=quarantine_dir)
+    filters = {"claims": data_loader.pharmacy_filter(pharmacies_df) if pharmacy_only else None, "reverts": None}
+
+    loaded = {}
+    for layout in ["claims", "reverts"]:
+        items = new_files(state, layout, data_loader.list_files(layout, "json", data_path))
+        logging.info(f"{len(items)} new {layout} file(s) to process.")
+        loaded[layout] = (
+            data_loader.load_files(items, layout, "json", workers, cache_dir, quarantine_dir, filters[layout])
+            if items else pd.DataFrame()
+        )
+        for item in items:
+            stat = os.stat(item)
+            state["files"][layout][item] = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if deduplicate:
+        loaded["claims"] = drop_consumed(state, loaded["claims"], deduplicate)
+    state = merge_events(state, loaded["claims"], loaded["reverts"])
+    save_state(state, state_dir)
+
+    partials = {
+        "metrics": state["metrics"],
+        "top_chains": recommendations.partial_top_chains_from_metrics(state["metrics"], pharmacies_df),
+        "quantities": state["quantities"],
+    }
+    if sketch:
+        partials["price_sketch"] = state["price_sketch"]
+        partials["chain_price_sketch"] = sketches.chain_price_sketch(state["price_sketch"], pharmacies_df)
+        partials["quantity_sketch"] = sketches.truncate_quantities(state["quantities"])
+    return partials
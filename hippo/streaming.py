@@ -0,0 +1,274 @@
+import json
+import logging
+import re
+
+import pandas as pd
+
+from hippo import data_loader, dedup, metrics, quantities, recommendations, sketches
+
+DEFAULT_BATCH_SIZE = 100_000
+DEFAULT_CHUNK_SIZE = 1 << 20
+MAX_RECORD_SIZE = 1 << 20
+
+# Batch partials of a file are merged this many at a time, rather than into the running
+# aggregates after every batch, so small batches do not re-merge the whole aggregates each time
+MERGE_BATCHES = 16
+
+# Merge function of each kind of partial aggregate
+MERGES = {
+    "metrics": metrics.merge_partial_metrics,
+    "top_chains": recommendations.merge_partial_top_chains,
+    "quantities": quantities.merge_partial_quantities,
+    "price_sketch": sketches.merge_price_sketches,
+    "quantity_sketch": sketches.merge_quantity_sketches,
+}
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_records(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Yields each element of a top-level JSON array, decoded, reading the file incrementally.
+
+    Only `chunk_size` characters (plus the record being decoded) are held in memory at a time;
+    records longer than `MAX_RECORD_SIZE` characters are rejected as malformed.
+
+    Parameters:
+        path (str): Path to a file containing a JSON array, possibly compressed (see `data_loader.open_file`).
+        chunk_size (int): Number of characters read from the file at a time.
+
+    Yields:
+        object: One decoded array element, a dictionary for well-formed records.
+
+    Raises:
+        ValueError: If the file does not contain a well-formed JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    offset = 0
+    expected = "start"
+
+    with data_loader.open_file(path) as f:
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer) and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                offset += pos
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            if expected == "end":
+                if pos < len(buffer):
+                    raise ValueError(f"Extra data after JSON array at offset {offset + pos}")
+                return
+            if pos == len(buffer):
+                raise ValueError("Unexpected end of JSON array")
+
+            char = buffer[pos]
+            if expected == "start":
+                if char != "[":
+                    raise ValueError("File does not contain a JSON array")
+                pos += 1
+                expected = "first"
+            elif char == "]" and expected in ("first", "separator"):
+                pos += 1
+                expected = "end"
+            elif expected == "separator":
+                if char != ",":
+                    raise ValueError(f"Expected ',' or ']' at offset {offset + pos}")
+                pos += 1
+                expected = "value"
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    end = None
+                if end is None or (end == len(buffer) and not eof):
+                    if eof or len(buffer) - pos > MAX_RECORD_SIZE:
+                        raise ValueError(f"Malformed JSON record at offset {offset + pos}")
+                    chunk = f.read(chunk_size)
+                    eof = not chunk
+                    offset += pos
+                    buffer, pos = buffer[pos:] + chunk, 0
+                    continue
+                yield value
+                pos = end
+                expected = "separator"
+
+def _parse_batch(records: list, layout: str, source: str, offset: int, quarantine_dir: str = None, filters: dict = None) -> pd.DataFrame:
+    """
+    Builds and validates a batch of decoded JSON records as `data_loader.load_data` does for a file.
+    """
+    df = data_loader.records_frame(records, layout)
+    df.index += offset
+    if filters:
+        df = data_loader.filter_rows(df, filters)
+    return data_loader.validate_frame(df, layout, f"{source}#{offset}", quarantine_dir)
+
+def input_files(layout: str, data_path=data_loader.DEFAULT_DATA_PATH) -> list:
+    """
+    Lists the non-empty JSON files of a layout, in load order.
+
+    Parameters:
+        layout (str): Data type (e.g., 'claims', 'reverts').
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `data_loader.layout_sources`).
+
+    Returns:
+        list: Paths of the files; empty files are skipped without being opened.
+    """
+    items = data_loader.list_files(layout, "json", data_path)
+    sizes = data_loader.stat_sizes(items)
+    if sizes.count(0):
+        logging.info(f"Files for {layout}: {len(items)} found, {sizes.count(0)} empty skipped.")
+    return [item for item, size in zip(items, sizes) if size]
+
+def iter_file_batches(item: str, layout: str, batch_size: int = DEFAULT_BATCH_SIZE, quarantine_dir: str = None, filters: dict = None):
+    """
+    Yields validated DataFrames of at most `batch_size` rows of a JSON file.
+
+    The file is read incrementally, so memory use depends on the batch size and not on the file
+    size. A file that turns out to be malformed raises after some of its batches were yielded,
+    and the caller is expected to discard them, as a file loaded whole is rejected entirely.
+
+    Parameters:
+        item (str): Path to the file.
+        layout (str): Data type (e.g., 'claims', 'reverts').
+        batch_size (int): Maximum number of records per batch.
+        quarantine_dir (str): Directory where rejected rows are written, one file per batch.
+        filters (dict): If set, only rows passing these filters are kept (see `data_loader.filter_rows`).
+
+    Yields:
+        pd.DataFrame: Validated batch with only the columns defined in the schema.
+
+    Raises:
+        OSError: If the file cannot be read.
+        ValueError: If the file does not contain a well-formed JSON array.
+    """
+    logging.info(f"Streaming file: {item}")
+    records = []
+    total_rows = valid_rows = 0
+    for record in iter_json_records(item):
+        records.append(record)
+        if len(records) == batch_size:
+            batch = _parse_batch(records, layout, item, total_rows, quarantine_dir, filters)
+            total_rows += len(records)
+            valid_rows += len(batch)
+            records = []
+            yield batch
+
+    if records:
+        batch = _parse_batch(records, layout, item, total_rows, quarantine_dir, filters)
+        total_rows += len(records)
+        valid_rows += len(batch)
+        yield batch
+    logging.info(f"File {item}: {valid_rows} valid rows out of {total_rows}.")
+
+def batch_partials(batch: pd.DataFrame, reverts_df: pd.DataFrame, index: pd.Series, pharmacies_df: pd.DataFrame, sketch: bool = False) -> dict:
+    """
+    Computes the partial aggregates of a batch of claims.
+
+    Parameters:
+        batch (pd.DataFrame): Validated claims.
+        reverts_df (pd.DataFrame): Claim ids of all reverts.
+        index (pd.Series): Revert counts by claim id, as returned by `metrics.revert_index`.
+        pharmacies_df (pd.DataFrame): Validated pharmacies data.
+        sketch (bool): If set, unit price and quantity sketches are computed instead of the exact
+            quantities.
+
+    Returns:
+        dict: Partial aggregates of the batch, by key of `MERGES`.
+    """
+    batch = batch.assign(
+        unit_price=batch["price"] / batch["quantity"],
+        reverted=metrics.lookup_reverts(batch["id"], index)
+    )
+    partials = {"metrics": metrics.partial_metrics(batch, reverts_df)}
+    if not pharmacies_df.empty:
+        partials["top_chains"] = recommendations.partial_top_chains(batch, pharmacies_df)
+    if sketch:
+        partials["price_sketch"] = sketches.partial_price_sketch(batch)
+        partials["quantity_sketch"] = sketches.partial_quantity_sketch(batch)
+    else:
+        partials["quantities"] = quantities.partial_quantities(batch)
+    return partials
+
+def stream_aggregates(batch_size: int = DEFAULT_BATCH_SIZE, data_path=data_loader.DEFAULT_DATA_PATH, quarantine_dir: str = None, pharmacy_only: bool = False, deduplicate: str = None, sketch: bool = False) -> dict:
+    """
+    Computes the partial aggregates of metrics, recommendations and common quantities in one
+    pass over the claims, one batch at a time.
+
+    Pharmacies are loaded whole and only the `claim_id` column of reverts is kept, so peak memory
+    is set by the batch size and the number of aggregated keys rather than by the number of claims.
+    The partials of a file are merged every `MERGE_BATCHES` batches, and into the running
+    aggregates once the file was read to the end, so a malformed file is discarded entirely
+    whatever the batch size.
+
+    Parameters:
+        batch_size (int): Maximum number of records per batch.
+        data_path (str | list | dict): Directories and glob patterns of the input files (see
+            `data_loader.layout_sources`).
+        quarantine_dir (str): Directory where rejected rows are written.
+        pharmacy_only (bool): If set, claims of pharmacies missing from the pharmacy dataset are
+            dropped before they are coerced.
+        deduplicate (str): If set, claims whose id was seen in an earlier batch are dropped. Only
+            "first" can be honoured one batch at a time; "latest" falls back to it.
+        sketch (bool): If set, unit price sketches are also computed, and quantities are counted
+            with a bounded heavy-hitter sketch instead of an exact frequency table (see `sketches`).
+
+    Returns:
+        dict: A dictionary with keys 'metrics', 'top_chains' and 'quantities' each containing the
+            merged partial aggregates, ready to be passed to the corresponding `finalize_*` function,
+            and with `sketch`, keys 'price_sketch', 'chain_price_sketch' and 'quantity_sketch' ('quantities'
+            is then empty).
+    """
+    if deduplicate == "latest":
+        logging.warning("Streaming keeps the first occurrence of duplicated claims, not the latest.")
+    pharmacies_df = data_loader.load_data("pharmacies", "csv", data_path, quarantine_dir=quarantine_dir)
+
+    reverts = []
+    for item in input_files("reverts", data_path):
+        try:
+            reverts.extend(batch[["claim_id"]] for batch in iter_file_batches(item, "reverts", batch_size, quarantine_dir))
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading file {item}: {e}")
+    reverts_df = pd.concat(reverts, ignore_index=True) if reverts else pd.DataFrame()
+    if reverts_df.empty:
+        logging.error("No reverts data found.")
+
+    index = metrics.revert_index(reverts_df)
+    seen_ids = dedup.empty_index()
+    totals = {key: pd.DataFrame() for key in MERGES}
+    claims_filter = data_loader.pharmacy_filter(pharmacies_df) if pharmacy_only else None
+    for item in input_files("claims", data_path):
+        pending = {key: [] for key in MERGES}
+        file_ids = seen_ids
+        try:
+            for batch in iter_file_batches(item, "claims", batch_size, quarantine_dir, claims_filter):
+                if deduplicate:
+                    batch, file_ids = dedup.drop_duplicates(batch, "first", file_ids)
+                if batch.empty:
+                    continue
+                for key, partial in batch_partials(batch, reverts_df, index, pharmacies_df, sketch).items():
+                    pending[key].append(partial)
+                    if len(pending[key]) == MERGE_BATCHES:
+                        pending[key] = [MERGES[key](pending[key])]
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading file {item}: {e}. Discarding the rows already read from it.")
+            continue
+
+        seen_ids = file_ids
+        for key, parts in pending.items():
+            if parts:
+                totals[key] = MERGES[key]([totals[key]] + parts)
+
+    partials = {
+        "metrics": totals["metrics"],
+        "top_chains": totals["top_chains"],
+        "quantities": totals["quantities"],
+    }
+    if sketch:
+        partials["price_sketch"] = totals["price_sketch"]
+        partials["chain_price_sketch"] = sketches.chain_price_sketch(totals["price_sketch"], pharmacies_df)
+        partials["quantity_sketch"] = totals["quantity_sketch"]
+    return partials
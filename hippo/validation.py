@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+
+import pandas as pd
+
+# Columns whose coerced value must be strictly positive
+POSITIVE_COLUMNS = ["quantity"]
+
+# Maximum number of rejected rows written to the log for each file
+MAX_SAMPLE_ROWS = 5
+
+# Number of hex digits of the path hash in quarantine file names
+QUARANTINE_HASH_LENGTH = 12
+
+def find_rejections(raw: pd.DataFrame, coerced: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """
+    Finds why rows fail validation, one vectorized check per column and reason.
+
+    Reasons are:
+      - missing: the field is absent or null
+      - non_numeric: a price or quantity that cannot be parsed as a number
+      - unparseable_timestamp: a timestamp that cannot be parsed as a datetime
+      - non_positive: a quantity that is zero or negative
+
+    Parameters:
+        raw (pd.DataFrame): Data as read from the file, with every schema column present.
+        coerced (pd.DataFrame): The same data coerced to the schema types.
+        schema (dict): Column types of the layout, as defined in `data_loader.SCHEMAS`.
+
+    Returns:
+        pd.DataFrame: Boolean DataFrame with one column per "<column>:<reason>" check, `True` where the row is rejected.
+    """
+    checks = {}
+    for col, col_type in schema.items():
+        raw_missing = raw[col].isna()
+        checks[f"{col}:missing"] = raw_missing
+        unparsed = coerced[col].isna() & ~raw_missing
+        if col_type in ["float", "int"]:
+            checks[f"{col}:non_numeric"] = unparsed
+        elif col_type == "datetime":
+            checks[f"{col}:unparseable_timestamp"] = unparsed
+        if col in POSITIVE_COLUMNS:
+            checks[f"{col}:non_positive"] = (coerced[col] <= 0).fillna(False)
+    return pd.DataFrame(checks, index=raw.index)
+
+def summarize(rejections: pd.DataFrame) -> dict:
+    """
+    Counts rejected rows per "<column>:<reason>" check.
+
+    Parameters:
+        rejections (pd.DataFrame): Boolean DataFrame returned by `find_rejections`.
+
+    Returns:
+        dict: Number of rejected rows per check, only for checks that rejected at least one row.
+    """
+    counts = rejections.sum()
+    return {check: int(count) for check, count in counts[counts > 0].items()}
+
+def quarantine_path(quarantine_dir: str, layout: str, source: str) -> str:
+    """
+    Returns the path of the file where rejected rows of `source` are written.
+
+    The file is named after the source's base name, followed by a short hash of its absolute path,
+    so that files with the same name in different directories are quarantined separately.
+
+    Parameters:
+        quarantine_dir (str): Directory of quarantined rows.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        source (str): Name of the file the data came from.
+
+    Returns:
+        str: Path of the NDJSON quarantine file.
+    """
+    digest = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()[:QUARANTINE_HASH_LENGTH]
+    return os.path.join(quarantine_dir, layout, f"{os.path.basename(source)}.{digest}.rejected.ndjson")
+
+def write_quarantine(rejected: pd.DataFrame, rejections: pd.DataFrame, path: str):
+    """
+    Writes rejected rows as NDJSON in one call, with a `_reasons` field listing the failed checks.
+
+    Parameters:
+        rejected (pd.DataFrame): Rejected rows as read from the file.
+        rejections (pd.DataFrame): Boolean checks of the rejected rows, as returned by `find_rejections`.
+        path (str): Path of the quarantine file.
+    """
+    reasons = pd.Series("", index=rejected.index)
+    for check in rejections.columns:
+        reasons = reasons.mask(rejections[check], reasons + check + ";")
+    rejected = rejected.assign(_reasons=reasons.str.rstrip(";"))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rejected.to_json(path, orient="records", lines=True, date_format="iso", default_handler=str)
+
+def report(rejected: pd.DataFrame, rejections: pd.DataFrame, layout: str, source: str, quarantine_dir: str = None):
+    """
+    Logs a summary of the rejected rows of a file, with a capped sample, and optionally writes
+    all of them to a quarantine file.
+
+    Parameters:
+        rejected (pd.DataFrame): Rejected rows as read from the file.
+        rejections (pd.DataFrame): Boolean checks of the rejected rows, as returned by `find_rejections`.
+        layout (str): Data type (e.g., 'pharmacies', 'claims', 'reverts').
+        source (str): Name of the file the data came from.
+        quarantine_dir (str): If set, directory where rejected rows are written.
+    """
+    counts = ", ".join(f"{check}={count}" for check, count in summarize(rejections).items())
+    logging.warning(f"{len(rejected)} ROW(S) WITH ISSUES in file {source}: {counts}")
+    for idx, row in rejected.head(MAX_SAMPLE_ROWS).iterrows():
+        logging.warning(f"PROBLEMATIC ROW - Index: {idx} - {row.to_dict()}")
+    if len(rejected) > MAX_SAMPLE_ROWS:
+        logging.warning(f"{len(rejected) - MAX_SAMPLE_ROWS} more problematic row(s) in file {source} not shown.")
+
+    if quarantine_dir:
+        path = quarantine_path(quarantine_dir, layout, source)
+        write_quarantine(rejected, rejections, path)
+        logging.warning(f"Rejected rows of file {source} written to {path}")
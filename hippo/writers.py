@@ -0,0 +1,129 @@
+import gzip
+import json
+import os
+import textwrap
+from contextlib import contextmanager
+
+import pandas as pd
+
+from hippo.constants import OUTPUT_FORMATS
+
+DEFAULT_CHUNK_SIZE = 10_000
+
+_EXTENSIONS = {"pretty": ".json", "compact": ".json", "ndjson": ".ndjson"}
+
+def output_path(output_dir: str, name: str, output_format: str = "pretty", compress: bool = False) -> str:
+    """
+    Returns the path of an output file, with the extension of its format.
+
+    Parameters:
+        output_dir (str): Directory of the output files.
+        name (str): Name of the output without extension (e.g. 'metrics').
+        output_format (str): 'pretty', 'compact' or 'ndjson'.
+        compress (bool): If set, '.gz' is appended.
+
+    Returns:
+        str: Path of the output file.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return os.path.join(output_dir, name + _EXTENSIONS[output_format] + (".gz" if compress else ""))
+
+@contextmanager
+def atomic_open(path: str, compress: bool = False):
+    """
+    Opens a text file for writing that only appears at `path` once it is complete.
+
+    Data is written to a temporary file next to `path` and renamed over it on success; on error,
+    the temporary file is removed and any previous file at `path` is left untouched.
+
+    Parameters:
+        path (str): Final path of the file.
+        compress (bool): If set, the file is gzip-compressed.
+
+    Yields:
+        file: Text file object.
+    """
+    tmp_path = path + ".tmp"
+    f = gzip.open(tmp_path, "wt", encoding="utf-8") if compress else open(tmp_path, "w", encoding="utf-8")
+    try:
+        with f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _frame_chunks(df: pd.DataFrame, output_format: str, chunk_size: int):
+    """
+    Serializes a DataFrame as JSON records, `chunk_size` rows at a time.
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        if output_format == "ndjson":
+            text = chunk.to_json(orient="records", lines=True)
+            yield text if text.endswith("\n") else text + "\n"
+        elif output_format == "compact":
+            yield chunk.to_json(orient="records")[1:-1]
+        else:
+            # Strip the "[\n" and "\n]" around the records of the chunk
+            yield chunk.to_json(orient="records", indent=4)[2:-2]
+
+def _list_chunks(records: list, output_format: str, chunk_size: int):
+    """
+    Serializes a list of dictionaries as JSON records, `chunk_size` records at a time.
+    """
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        if output_format == "ndjson":
+            yield "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in chunk)
+        elif output_format == "compact":
+            yield ",".join(json.dumps(record, separators=(",", ":")) for record in chunk)
+        else:
+            yield ",\n".join(textwrap.indent(json.dumps(record, indent=4), "    ") for record in chunk)
+
+def write_records(records, path: str, output_format: str = "pretty", compress: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Writes records to a JSON or NDJSON file, serializing them in chunks so only one chunk of
+    text is held in memory at a time.
+
+    Formats:
+      - 'pretty': a JSON array indented by 4 spaces, as written by earlier releases
+      - 'compact': a JSON array without whitespace
+      - 'ndjson': one JSON record per line
+
+    The file is written atomically (see `atomic_open`).
+
+    Parameters:
+        records (pd.DataFrame | list): Records as DataFrame rows or a list of dictionaries.
+        path (str): Path of the output file.
+        output_format (str): 'pretty', 'compact' or 'ndjson'.
+        compress (bool): If set, the file is gzip-compressed.
+        chunk_size (int): Number of records serialized at a time.
+
+    Returns:
+        int: Number of records written.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if isinstance(records, pd.DataFrame):
+        chunks = _frame_chunks(records, output_format, chunk_size)
+    else:
+        chunks = _list_chunks(records, output_format, chunk_size)
+
+    separator = {"pretty": ",\n", "compact": ",", "ndjson": ""}[output_format]
+    with atomic_open(path, compress) as f:
+        if output_format == "ndjson":
+            for chunk in chunks:
+                f.write(chunk)
+        elif not len(records):
+            f.write("[]")
+        else:
+            f.write("[\n" if output_format == "pretty" else "[")
+            for i, chunk in enumerate(chunks):
+                if i:
+                    f.write(separator)
+                f.write(chunk)
+            f.write("\n]" if output_format == "pretty" else "]")
+    return len(records)
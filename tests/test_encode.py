@@ -0,0 +1,54 @@
+import unittest
+import uuid
+
+import pandas as pd
+
+from hippo import data_loader, metrics
+
+ROWS = 1000
+
+
+def claims(claim_ids: list) -> pd.DataFrame:
+    records = [
+        {"id": claim_id, "npi": f"{i % 10:010d}", "ndc": "00002323401", "price": 10.0, "quantity": 10, "timestamp": "2024-01-01T00:00:00"}
+        for i, claim_id in enumerate(claim_ids)
+    ]
+    return data_loader.validate_frame(pd.DataFrame(records), "claims", "test")
+
+
+def reverts(claim_ids: list) -> pd.DataFrame:
+    records = [
+        {"id": str(uuid.uuid4()), "claim_id": claim_id, "timestamp": "2024-01-02T00:00:00"}
+        for claim_id in claim_ids
+    ]
+    return data_loader.validate_frame(pd.DataFrame(records), "reverts", "test")
+
+
+class EncodeTest(unittest.TestCase):
+    def setUp(self):
+        claim_ids = [str(uuid.uuid4()) for _ in range(ROWS)] + ["not-a-uuid"]
+        self.data = {"claims": claims(claim_ids), "reverts": reverts(claim_ids[::10])}
+
+    def test_encoding_reduces_memory(self):
+        encoded = data_loader.encode_data({
+            layout: data_loader.encode_frame(df, layout) for layout, df in self.data.items()
+        })
+        for layout, df in self.data.items():
+            before = df.memory_usage(deep=True)
+            after = encoded[layout].memory_usage(deep=True)
+            for col in data_loader.UUID_COLUMNS[layout]:
+                self.assertLess(after[col], before[col] / 2, f"{layout}.{col}")
+            self.assertLess(after.sum(), before.sum(), layout)
+
+    def test_encoded_reverts_match_their_claims(self):
+        encoded = data_loader.encode_data(self.data)
+        for net in [True, False]:
+            pd.testing.assert_frame_equal(
+                metrics.compute_metrics(encoded["claims"], encoded["reverts"], net=net),
+                metrics.compute_metrics(self.data["claims"], self.data["reverts"], net=net),
+                check_dtype=False, check_categorical=False
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
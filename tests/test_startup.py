@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported before a command runs
+HEAVY_MODULES = ["pandas", "numpy"]
+
+# Runs `python -m hippo.cli --help`, then prints the modules it imported on a last line
+HELP_SCRIPT = """
+import runpy, sys
+sys.argv = ["hippo.cli", "--help"]
+try:
+    runpy.run_module("hippo.cli", run_name="__main__", alter_sys=True)
+except SystemExit:
+    pass
+print("imported:" + ",".join(sys.modules))
+"""
+
+
+class StartupTest(unittest.TestCase):
+    def test_help_does_not_import_heavy_modules(self):
+        result = subprocess.run(
+            [sys.executable, "-c", HELP_SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        output, imported = result.stdout.rsplit("imported:", 1)
+        self.assertIn("usage:", output)
+        imported = {name.split(".")[0] for name in imported.strip().split(",")}
+        self.assertEqual([name for name in HEAVY_MODULES if name in imported], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
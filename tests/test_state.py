@@ -0,0 +1,67 @@
+import tempfile
+import unittest
+
+import pandas as pd
+
+from hippo import data_loader, metrics, quantities, state
+
+
+def claims(*rows) -> pd.DataFrame:
+    records = [
+        {"id": claim_id, "npi": npi, "ndc": "00002323401", "price": price, "quantity": 10, "timestamp": "2024-01-01T00:00:00"}
+        for claim_id, npi, price in rows
+    ]
+    return data_loader.validate_frame(pd.DataFrame(records), "claims", "test")
+
+
+def reverts(*claim_ids) -> pd.DataFrame:
+    records = [
+        {"id": f"revert-{i}", "claim_id": claim_id, "timestamp": "2024-01-02T00:00:00"}
+        for i, claim_id in enumerate(claim_ids)
+    ]
+    return data_loader.validate_frame(pd.DataFrame(records, columns=list(data_loader.SCHEMAS["reverts"])), "reverts", "test")
+
+
+class RedeliveryTest(unittest.TestCase):
+    def run_twice(self, runs: list) -> dict:
+        """
+        Merges each (claims, reverts) pair in its own run, persisting the state in between.
+        """
+        with tempfile.TemporaryDirectory() as state_dir:
+            for claims_df, reverts_df in runs:
+                current = state.merge_events(state.load_state(state_dir), claims_df, reverts_df)
+                state.save_state(current, state_dir)
+            return state.load_state(state_dir)
+
+    def assert_matches_full_run(self, runs: list):
+        merged = self.run_twice(runs)
+        claims_df = pd.concat([claims_df for claims_df, _ in runs], ignore_index=True)
+        reverts_df = pd.concat([reverts_df for _, reverts_df in runs], ignore_index=True)
+        for net in [True, False]:
+            pd.testing.assert_frame_equal(
+                metrics.finalize_metrics(merged["metrics"], net).sort_values(["npi", "ndc"], ignore_index=True),
+                metrics.compute_metrics(claims_df, reverts_df, net=net).sort_values(["npi", "ndc"], ignore_index=True),
+                check_dtype=False
+            )
+            self.assertEqual(
+                quantities.finalize_common_quantities(merged["quantities"], net=net),
+                quantities.compute_common_quantities(claims_df, reverts_df=reverts_df, net=net)
+            )
+
+    def test_claim_redelivered_after_its_revert(self):
+        # The revert is attributed in the first run, the claim is delivered again in the second
+        self.assert_matches_full_run([
+            (claims(("a", "1111111111", 10.0), ("b", "1111111111", 20.0)), reverts("a")),
+            (claims(("a", "1111111111", 10.0), ("c", "2222222222", 30.0)), reverts()),
+        ])
+
+    def test_revert_of_redelivered_claim_arrives_with_it(self):
+        # Both copies of the claim are reverted, whichever run consumed them
+        self.assert_matches_full_run([
+            (claims(("a", "1111111111", 10.0), ("b", "1111111111", 20.0)), reverts()),
+            (claims(("a", "1111111111", 10.0)), reverts("a")),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()